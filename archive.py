@@ -0,0 +1,270 @@
+import os
+import json
+import numpy as np
+from typing import List, Tuple, Dict, Union
+
+class ExperimentArchive:
+    """
+    Append-only store of the outputs of an experiment, one chunk per step and phase ('prior' or 'post').
+
+    The archive is a directory holding a 'manifest.json' and, for each chunk, the simulations at the saved
+    locations (stored gauge major, (saved locations, members, time), so the series of one gauge are contiguous,
+    optional), their mean, standard deviation and other statistics (time, saved locations) and the ensemble
+    parameters (parameters, members).
+    Arrays are .npy files, read lazily through memory maps, or compressed .npz files (read whole) if 'compress'.
+    A chunk is added to the manifest only once its files are written, and the manifest is replaced atomically,
+    so a crash never leaves a partial chunk visible.
+
+    Args:
+        path (str): Directory of the archive, opened if it already exists.
+        sav_ids (np.ndarray, optional): Link IDs of the saved locations, required to create the archive.
+        dtype (str, optional): Type of the stored simulations, 'float64' (default) or 'float32'.
+        compress (bool, optional): Store compressed .npz files instead of memory mappable .npy files.
+    """
+
+    def __init__(self, path: str, sav_ids: np.ndarray = None, dtype: str = "float64", compress: bool = False):
+        self.path = path
+        manifest_name = os.path.join(path, "manifest.json")
+        if os.path.exists(manifest_name):
+            with open(manifest_name, 'r') as f:
+                self.manifest = json.load(f)
+        elif sav_ids is None:
+            raise FileNotFoundError("No experiment archive in " + path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {"sav_ids": [int(i) for i in sav_ids], "dtype": str(np.dtype(dtype)),
+                             "compress": bool(compress), "chunks": []}
+            self._write_manifest()
+        self.sav_ids = np.array(self.manifest["sav_ids"])
+
+    def _write_manifest(self) -> None:
+        name = os.path.join(self.path, "manifest.json")
+        with open(name + ".tmp", 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(name + ".tmp", name)
+
+    def _write_array(self, name: str, arr: np.ndarray) -> None:
+        # Written under a temporary name then renamed, np.save and np.savez keep names ending with their extension
+        name = os.path.join(self.path, name)
+        if self.manifest["compress"]:
+            np.savez_compressed(name + ".tmp.npz", data=arr)
+            os.replace(name + ".tmp.npz", name + ".npz")
+        else:
+            np.save(name + ".tmp.npy", arr)
+            os.replace(name + ".tmp.npy", name + ".npy")
+
+    def _read_array(self, name: str) -> np.ndarray:
+        name = os.path.join(self.path, name)
+        if self.manifest["compress"]:
+            with np.load(name + ".npz") as f:
+                return f["data"]
+        return np.load(name + ".npy", mmap_mode='r')
+
+    @staticmethod
+    def _chunk_name(step: int, phase: str) -> str:
+        return str(step) + "_" + phase
+
+    def chunks(self) -> List[Tuple[int, str]]:
+        """
+        Get the chunks in the archive.
+
+        Returns:
+            List[Tuple[int, str]]: (step, phase) of each chunk, in the order they were written.
+        """
+        return [(chunk["step"], chunk["phase"]) for chunk in self.manifest["chunks"]]
+
+    def append(self, step: int, phase: str, Y_plot: np.ndarray = None, X_params: np.ndarray = None,
+               Y_mean: np.ndarray = None, Y_std: np.ndarray = None, stats: Dict[str, np.ndarray] = None, offset: int = 0) -> None:
+        """
+        Add the outputs of a run, replacing the chunk of the same step and phase if there is one (e.g. after a resume).
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+            Y_plot (np.ndarray, optional): Simulations of every member at the saved locations (members, time, saved locations),
+                                           only statistics are stored if None.
+            X_params (np.ndarray, optional): Parameters of every member (parameters, members).
+            Y_mean (np.ndarray, optional): Ensemble mean (time, saved locations), from 'stats' or computed if not given.
+            Y_std (np.ndarray, optional): Ensemble standard deviation (time, saved locations), from 'stats' or computed if not given.
+            stats (Dict[str, np.ndarray], optional): Other statistics over the members, by name (e.g. 'min', 'q95'),
+                                                     each (time, saved locations), see RunningStatistics.summary.
+            offset (int, optional): Index of the first time of the run in the observations (runs of an assimilation window).
+
+        Returns:
+            None
+        """
+        name = self._chunk_name(step, phase)
+        if Y_plot is not None:
+            self._write_array(name + "_particles", np.ascontiguousarray(np.moveaxis(Y_plot, 2, 0), dtype=self.manifest["dtype"]))
+        stats = dict(stats or {})
+        if Y_mean is not None or "mean" not in stats:
+            stats["mean"] = np.mean(Y_plot, axis=0) if Y_mean is None else Y_mean
+        if Y_std is not None or "std" not in stats:
+            stats["std"] = np.std(Y_plot, axis=0) if Y_std is None else Y_std
+        for stat_name, values in stats.items():
+            self._write_array(name + "_" + stat_name, np.asarray(values))
+        if X_params is not None:
+            self._write_array(name + "_params", np.asarray(X_params))
+
+        ens = Y_plot.shape[0] if Y_plot is not None else (X_params.shape[1] if X_params is not None else None)
+        chunk = {"step": int(step), "phase": phase, "ens": ens, "offset": int(offset), "time": int(stats["mean"].shape[0]),
+                 "particles": Y_plot is not None, "params": X_params is not None, "stats": sorted(stats)}
+        self.manifest["chunks"] = [c for c in self.manifest["chunks"] if (c["step"], c["phase"]) != (step, phase)]
+        self.manifest["chunks"].append(chunk)
+        self._write_manifest()
+
+    def add_observations(self, data: np.ndarray) -> None:
+        """
+        Store the observations at the saved locations.
+
+        Args:
+            data (np.ndarray): Observations (time, saved locations).
+
+        Returns:
+            None
+        """
+        self._write_array("observations", np.asarray(data))
+        self.manifest["observations"] = True
+        self._write_manifest()
+
+    def observations(self) -> np.ndarray:
+        """
+        Get the observations at the saved locations.
+
+        Returns:
+            np.ndarray: Observations (time, saved locations).
+        """
+        return self._read_array("observations")
+
+    def gauge_index(self, link_id: int) -> int:
+        """
+        Get the position of a saved location in the stored arrays.
+
+        Args:
+            link_id (int): Link ID of the saved location.
+
+        Returns:
+            int: Index along the saved locations axis.
+        """
+        idx = np.flatnonzero(self.sav_ids == link_id)
+        if len(idx) == 0:
+            raise KeyError("Link " + str(link_id) + " is not a saved location of the archive")
+        return int(idx[0])
+
+    def _chunk(self, step: int, phase: str) -> dict:
+        for chunk in self.manifest["chunks"]:
+            if (chunk["step"], chunk["phase"]) == (step, phase):
+                return chunk
+        raise KeyError("No chunk for step " + str(step) + " " + phase + " in the archive")
+
+    def time_range(self, step: int, phase: str) -> Tuple[int, int]:
+        """
+        Get the times of a chunk in the observations. Runs of an assimilation window only cover part of them,
+        and the last 'post' run of a window (which ends at the start of the next window) only part of the window.
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+
+        Returns:
+            Tuple[int, int]: First and last (excluded) index of the chunk's times in the observations.
+        """
+        chunk = self._chunk(step, phase)
+        offset = chunk.get("offset", 0)
+        return offset, offset + chunk["time"]
+
+    def particles(self, step: int, phase: str, link_id: int = None) -> np.ndarray:
+        """
+        Get the simulations of every member for a chunk, without reading them until sliced (unless compressed).
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+            link_id (int, optional): Only return the simulations at this saved location.
+
+        Returns:
+            np.ndarray: Simulations (members, time, saved locations), or (members, time) for a single location.
+        """
+        if not self._chunk(step, phase).get("particles", True):
+            raise KeyError("The simulations of the members were not kept for step " + str(step) + " " + phase)
+        particles = self._read_array(self._chunk_name(step, phase) + "_particles")
+        if link_id is not None:
+            return particles[self.gauge_index(link_id)]
+        return np.moveaxis(particles, 0, 2)
+
+    def statistic(self, step: int, phase: str, stat: str) -> np.ndarray:
+        """
+        Get a statistic over the members of a chunk.
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+            stat (str): Name of the statistic, 'mean', 'std' or one of the chunk's other 'stats' (e.g. 'min', 'q95').
+
+        Returns:
+            np.ndarray: Statistic (time, saved locations).
+        """
+        if stat not in self._chunk(step, phase).get("stats", ["mean", "std"]):
+            raise KeyError("No statistic " + stat + " for step " + str(step) + " " + phase)
+        return self._read_array(self._chunk_name(step, phase) + "_" + stat)
+
+    def mean(self, step: int, phase: str) -> np.ndarray:
+        """
+        Get the ensemble mean of a chunk.
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+
+        Returns:
+            np.ndarray: Ensemble mean (time, saved locations).
+        """
+        return self.statistic(step, phase, "mean")
+
+    def std(self, step: int, phase: str) -> np.ndarray:
+        """
+        Get the ensemble standard deviation of a chunk.
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+
+        Returns:
+            np.ndarray: Ensemble standard deviation (time, saved locations).
+        """
+        return self.statistic(step, phase, "std")
+
+    def params(self, step: int, phase: str) -> np.ndarray:
+        """
+        Get the parameters of every member of a chunk.
+
+        Args:
+            step (int): Index of the step.
+            phase (str): 'prior' or 'post'.
+
+        Returns:
+            np.ndarray: Parameters (parameters, members).
+        """
+        return self._read_array(self._chunk_name(step, phase) + "_params")
+
+    def gauge_series(self, link_id: int, phase: str = "prior", stat: str = "mean") -> np.ndarray:
+        """
+        Get a statistic over the members at one saved location for every step of a phase.
+
+        Args:
+            link_id (int): Link ID of the saved location.
+            phase (str, optional): 'prior' or 'post'.
+            stat (str, optional): Name of the statistic, see statistic.
+
+        Returns:
+            np.ndarray: One row per step (steps, time), steps in increasing order, each chunk placed at its
+                        times in the observations (see time_range) and NaN outside them.
+        """
+        idx = self.gauge_index(link_id)
+        steps = sorted(step for step, chunk_phase in self.chunks() if chunk_phase == phase)
+        ranges = [self.time_range(step, phase) for step in steps]
+        n_time = max([end for _, end in ranges] + [self.observations().shape[0] if self.manifest.get("observations", False) else 0])
+        series = np.full((len(steps), n_time), np.nan)
+        for row, (step, (start, end)) in enumerate(zip(steps, ranges)):
+            series[row, start:end] = self.statistic(step, phase, stat)[:, idx]
+        return series
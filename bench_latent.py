@@ -0,0 +1,71 @@
+#!/usr/bin/python
+import sys
+import time
+import numpy as np
+
+from utils import process_json, get_subwatershed
+from latent import create_latent, convert_logical, unbounded_to_bounded, round_significant, parent_index
+
+# Benchmark of the latent to parameter transform (latent.transform_latent) at full Cedar River scale, all links
+# of example_files/test.rec with the subwatersheds of test.json, against the previous sparse matmul expansion
+# and per element string rounding.
+# Usage: python bench_latent.py [ens] [watershed_depth]
+
+def transform_reference(sparse_parent, latent_var, lb, ub):
+    # Previous implementation, sparse matmul then np.vectorize over np.format_float_positional
+    lv = (sparse_parent.T)@latent_var
+    transform_func = lambda x: float(np.format_float_positional(unbounded_to_bounded(x,lb,ub),precision=5,unique=False,fractional=False,trim='k'))
+    return np.vectorize(transform_func)(lv)
+
+def transform_new(link_parent, latent_var, lb, ub):
+    return round_significant(unbounded_to_bounded(latent_var,lb,ub), 5)[link_parent,:]
+
+def main(ens, watershed_depth=None):
+    test_dict = process_json('test.json')
+    if watershed_depth is not None:
+        test_dict['watershed_depth'] = watershed_depth
+    with open('example_files/test.rec', 'r') as f:
+        rec_lines = [line.strip() for line in f.readlines() if line.strip()]
+    id_list = np.sort(np.array([int(i) for i in rec_lines[3::2]]))
+    sparse_parent = get_subwatershed(test_dict, id_list)
+    latent_var = create_latent(test_dict, sparse_parent, ens)
+    print("links:", sparse_parent.shape[1], "subwatersheds:", sparse_parent.shape[0], "ensemble:", ens)
+
+    out_num = sparse_parent.shape[0]
+    loc = 0
+    time_ref = 0.0
+    time_new = 0.0
+    for i, dist in enumerate(convert_logical(test_dict["prm_dist"])):
+        if dist:
+            lb = float(test_dict['prm_lb'][i])
+            ub = float(test_dict['prm_ub'][i])
+            lv = latent_var[loc:(loc+out_num),:]
+
+            start = time.perf_counter()
+            ref = transform_reference(sparse_parent, lv, lb, ub)
+            time_ref += time.perf_counter() - start
+
+            start = time.perf_counter()
+            link_parent = parent_index(sparse_parent)
+            new = transform_new(link_parent, lv, lb, ub)
+            time_new += time.perf_counter() - start
+
+            assert np.array_equal(ref, new), "results differ for parameter " + str(i)
+            loc = loc + out_num
+
+    print("previous: %.3f s, vectorized: %.3f s, speedup: %.0fx (identical output)" % (time_ref, time_new, time_ref / time_new))
+
+    # Rounding kernel alone on every link and member (no benefit from transforming before expanding)
+    x = unbounded_to_bounded(np.random.normal(0, 1, (len(id_list), ens)), 0.05, 0.5)
+    start = time.perf_counter()
+    np.vectorize(lambda v: float(np.format_float_positional(v,precision=5,unique=False,fractional=False,trim='k')))(x)
+    time_ref = time.perf_counter() - start
+    start = time.perf_counter()
+    round_significant(x, 5)
+    time_new = time.perf_counter() - start
+    print("rounding kernel, previous: %.3f s, vectorized: %.3f s, speedup: %.0fx" % (time_ref, time_new, time_ref / time_new))
+
+if __name__ == "__main__":
+    ens = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    watershed_depth = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    main(ens, watershed_depth)
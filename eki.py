@@ -1,7 +1,9 @@
 import json 
-import copy
+import hashlib
 import numpy as np
-from typing import List, Tuple, Dict, Union
+from scipy.special import ndtr
+from typing import List, Tuple, Dict, Union, NamedTuple
+from utils import LinkIndex
 
 def subsample_data(data: np.ndarray, test_dict: dict, id_list: List[int], file_order: np.ndarray) -> Tuple[np.ndarray]:
     """
@@ -23,16 +25,11 @@ def subsample_data(data: np.ndarray, test_dict: dict, id_list: List[int], file_o
     sav_vals = np.array(np.genfromtxt(sav_name, delimiter=','), ndmin=1)
     
     # Gets data at id values
-    new_lines = []
-    sav_ids = []
-    for i, id_val in enumerate(sav_vals):
-        if id_val in id_list:
-            sav_ids.append(id_val)
-            new_lines.append(data[:, i:i + 1])
+    idx_keep = np.flatnonzero(LinkIndex(id_list).contains(sav_vals))
             
     # returns data values and ids
-    ids_meas = np.array(sav_ids)
-    meas_vals = np.concatenate(new_lines, 1)
+    ids_meas = sav_vals[idx_keep]
+    meas_vals = data[:, idx_keep]
 
     return meas_vals, ids_meas
 
@@ -67,47 +64,129 @@ def pert(X, test_dict, sparse_parent):
             loc = loc + parent_num
     return X
 
-def EnKF(X_pre: np.ndarray, Y_pre: np.ndarray, y: np.ndarray, R_diag: np.ndarray) -> np.ndarray:
+def EnKF(X_pre: np.ndarray, Y_pre: np.ndarray, y: np.ndarray, R_diag: np.ndarray, solver: str = 'auto') -> np.ndarray:
     """
     Perform the Standard Perturbed Observation Ensemble Kalman Filter (EnKF) update step.
 
+    The Kalman gain is either solved in observation space, (y_num x y_num) system, or in ensemble space with the 
+    Woodbury identity, K = X (I + S^T S)^-1 S^T R^-1/2 with S = R^-1/2 Y, an (ens x ens) system costing 
+    O(y_num ens^2 + ens^3). In both cases R is only used through its diagonal.
+
     Args:
         X_pre (np.ndarray): Prior ensemble of latent parameters.
         Y_pre (np.ndarray): Prior ensemble of model outputs (observations).
         y (np.ndarray): Actual observations (measurement).
         R_diag (np.ndarray): Diagonal elements of the measurement noise covariance matrix (R).
+        solver (str, optional): 'obs' (observation space), 'ens' (ensemble space) or 'auto' (ensemble space when 
+                                there are more observations than ensemble members).
 
     Returns:
         np.ndarray: Posterior ensemble of latent parameters after the EnKF update.
     """
     ens = X_pre.shape[1]
     y_num = len(y)
-    y_size = y.shape
+    R_diag = np.asarray(R_diag, dtype=float).reshape(-1)
+    R_sqrt = np.sqrt(R_diag).reshape(-1, 1)
     
     #Computes state and measurement means
     xbar = np.mean(X_pre, axis=1, keepdims=True)
     ybar = np.mean(Y_pre, axis=1, keepdims=True)
     
-    #Gets measurement perturbation and perturbs
+    #Gets measurement perturbation and perturbs (element-wise, R is diagonal)
     pert_vec = np.random.normal(0, 1, (y_num, ens))
-    R = np.diag(R_diag)
-    y_pert = y + np.sqrt(R) @ pert_vec
+    y_pert = np.reshape(y, (-1, 1)) + R_sqrt * pert_vec
+    innovation = y_pert - Y_pre
     
-    #Computes Kalman Gain 
+    #Computes Kalman Gain and updates states (parameter vector)
     X = (X_pre - xbar) / np.sqrt(ens - 1)
     Y = (Y_pre - ybar) / np.sqrt(ens - 1)
-    K = np.linalg.solve((Y @ Y.T + R).T, (X @ Y.T).T).T
-    
+    if solver == 'auto':
+        solver = 'ens' if y_num > ens else 'obs'
+    if solver == 'ens':
+        S = Y / R_sqrt
+        C = S.T @ S
+        C[np.diag_indices(ens)] += 1.0
+        X_post = X @ np.linalg.solve(C, S.T @ (innovation / R_sqrt)) + X_pre
+    elif solver == 'obs':
+        C = Y @ Y.T
+        C[np.diag_indices(y_num)] += R_diag
+        K = np.linalg.solve(C.T, (X @ Y.T).T).T
+        X_post = K @ innovation + X_pre
+    else:
+        raise ValueError("Unknown gain solver: " + str(solver))
+    return X_post
+
+def ETKF(X_pre: np.ndarray, Y_pre: np.ndarray, y: np.ndarray, R_diag: np.ndarray) -> np.ndarray:
+    """
+    Perform the deterministic Ensemble Transform Kalman Filter (ETKF) square root update step.
+
+    The update is computed in ensemble space, the mean is moved with the Kalman gain and the anomalies are 
+    transformed with the symmetric square root of the posterior (ens x ens) covariance, so no observations 
+    are perturbed and no sampling noise is added.
+
+    Args:
+        X_pre (np.ndarray): Prior ensemble of latent parameters.
+        Y_pre (np.ndarray): Prior ensemble of model outputs (observations).
+        y (np.ndarray): Actual observations (measurement).
+        R_diag (np.ndarray): Diagonal elements of the measurement noise covariance matrix (R).
+
+    Returns:
+        np.ndarray: Posterior ensemble of latent parameters after the ETKF update.
+    """
+    ens = X_pre.shape[1]
+    R_sqrt = np.sqrt(np.asarray(R_diag, dtype=float)).reshape(-1, 1)
+
+    #Computes state and measurement means and anomalies
+    xbar = np.mean(X_pre, axis=1, keepdims=True)
+    ybar = np.mean(Y_pre, axis=1, keepdims=True)
+    X = X_pre - xbar
+
+    #Scaled measurement anomalies and innovation
+    S = (Y_pre - ybar) / (R_sqrt * np.sqrt(ens - 1))
+    d = (np.reshape(y, (-1, 1)) - ybar) / R_sqrt
+
+    #Eigen decomposition of the (ens x ens) system, posterior covariance in ensemble space is V (I + L)^-1 V^T
+    L, V = np.linalg.eigh(S.T @ S)
+    L = np.maximum(L, 0)
+    w_mean = V @ ((V.T @ (S.T @ d)) / (1.0 + L).reshape(-1, 1)) / np.sqrt(ens - 1)
+    W = (V / np.sqrt(1.0 + L)) @ V.T
+
     #Updates states (parameter vector)
-    X_post = K @ (y_pert - Y_pre) + X_pre
+    X_post = xbar + X @ (w_mean + W)
     return X_post
 
+def update_ensemble(X_pre: np.ndarray, Y_pre: np.ndarray, y: np.ndarray, R_diag: np.ndarray, test_dict: Dict[str, Union[str, float]]) -> np.ndarray:
+    """
+    Update the ensemble with the filter selected in the test dictionary.
+
+    Args:
+        X_pre (np.ndarray): Prior ensemble of latent parameters.
+        Y_pre (np.ndarray): Prior ensemble of model outputs (observations).
+        y (np.ndarray): Actual observations (measurement).
+        R_diag (np.ndarray): Diagonal elements of the measurement noise covariance matrix (R).
+        test_dict (Dict[str, Union[str, float]]): Test dictionary containing configuration parameters, uses the optional
+                                                  keys 'filter_type' ('enkf' or 'etkf') and 'gain_solver'.
+
+    Returns:
+        np.ndarray: Posterior ensemble of latent parameters.
+    """
+    filter_type = test_dict.get('filter_type', 'enkf')
+    if filter_type == 'enkf':
+        return EnKF(X_pre, Y_pre, y, R_diag, test_dict.get('gain_solver', 'auto'))
+    elif filter_type == 'etkf':
+        return ETKF(X_pre, Y_pre, y, R_diag)
+    raise ValueError("Unknown filter type: " + str(filter_type))
+
 def find_events(y: np.ndarray, min_dist: int, min_thresh: float, min_length: int) -> Tuple[List[List[int]], List[List[float]]]:
     """
     Find events in a time series based on given conditions.
 
+    Values are visited from largest to smallest, each value joins the first event (in order of creation)
+    having a point within 'min_dist' of it, otherwise it starts a new event.
+
     Args:
-        y (np.ndarray): Input time series.
+        y (np.ndarray): Input time series, either 1D or 2D (time x sensor). For a 2D input each sensor is
+                        searched separately and indices refer to the row-major flattened array.
         min_dist (int): Minimum distance allowed between two events.
         min_thresh (float): Minimum threshold value for identifying an event.
         min_length (int): Minimum length of an event (number of consecutive points).
@@ -117,60 +196,49 @@ def find_events(y: np.ndarray, min_dist: int, min_thresh: float, min_length: int
         1. List of lists containing the indices of each event found in the input time series.
         2. List of lists containing the corresponding values of each event found.
     """
-    # TODO: make this work with several different sensors, currently only works with a single sensor,
-    # can work asis with multiple, but will have weird effects at the interface between two vectorized
-    # time series
-    
-    # Initialize event list
-    event_list = []
-    event_val_list = []
-    check_list = copy.deepcopy(y) #measurement values
-    check_list_idx = np.arange(len(y)) #measurement locations
+    # Several sensors, find the events of each sensor, then map indices to the flattened array
+    if np.ndim(y) == 2:
+        sensor_num = y.shape[1]
+        event_list = []
+        event_val_list = []
+        for s in range(sensor_num):
+            sensor_events, sensor_event_vals = find_events(y[:, s], min_dist, min_thresh, min_length)
+            event_list += [[idx * sensor_num + s for idx in event] for event in sensor_events]
+            event_val_list += sensor_event_vals
+        return event_list, event_val_list
+
+    y = np.asarray(y).reshape(-1)
     min_thresh = np.maximum(1e-4, min_thresh) #ensures 0 values are always excluded
 
-    
-    while len(check_list) > 0: # While there are still elements in the list
-        # Finds the current largest value in list
-        max_val_idx = np.argmax(check_list) 
-        idx = check_list_idx[max_val_idx]
-        y_idx = check_list[max_val_idx]
-
-        # If this value is smaller than the minimum value, break
-        if y[idx] < min_thresh:
-            break
-
-        #If there is no events currently, make a new event, add value to event
-        if not event_list:
-            event_list.append([idx])
-            event_val_list.append([y_idx])
+    # Visits values from largest to smallest (ties by increasing index), stopping at the first value below threshold
+    order = np.argsort(-y, kind='stable')
+    below = np.nonzero(y[order] < min_thresh)[0]
+    if len(below) > 0:
+        order = order[:below[0]]
+
+    # Initialize event list, and the event each location belongs to (-1 if none)
+    event_list = []
+    event_val_list = []
+    owner = np.full(len(y), -1)
+
+    for idx in order:
+        # Events with a value indexwise closer than min_dist, the first created one takes the value
+        near = owner[max(idx - min_dist + 1, 0):idx + min_dist]
+        near = near[near >= 0]
+        if len(near) > 0:
+            event_idx = np.min(near)
+            event_list[event_idx].append(idx)
+            event_val_list[event_idx].append(y[idx])
         else:
-            #Check to see which value in the event list the value is indexwise closest to
-            for i, event in enumerate(event_list):
-                min_diff = min([abs(e - idx) for e in event])
-                
-                #If within the minimum index distance, add to that event, then stop
-                if min_diff < min_dist:
-                    event_list[i] = event + [idx]
-                    event_val_list[i] = event_val_list[i] + [y_idx]
-                    break
-                #If we made it to the end and we havent added it yet, the value gets its own event
-                elif i == len(event_list) - 1:
-                    event_list.append([idx])
-                    event_val_list.append([y_idx])
-                    break
-                    
-        #Remove the value from the remaining values
-        check_list = np.delete(check_list, max_val_idx)
-        check_list_idx = np.delete(check_list_idx, max_val_idx)
+            event_idx = len(event_list)
+            event_list.append([idx])
+            event_val_list.append([y[idx]])
+        owner[idx] = event_idx
 
     # Check all the events created, remove all the really short events
-    i = 0
-    while i < len(event_list):
-        if len(event_list[i]) < min_length:
-            event_list.pop(i)
-            event_val_list.pop(i)
-        else:
-            i += 1
+    keep = [i for i, event in enumerate(event_list) if len(event) >= min_length]
+    event_list = [event_list[i] for i in keep]
+    event_val_list = [event_val_list[i] for i in keep]
 
     return event_list, event_val_list
 
@@ -232,89 +300,108 @@ def find_metric_values(event_list, event_val_list):
         std_y_values.append([std_y_value])
     return max_values_idx, max_values, mean_values, slope_values, int_values, slope_idx, std_values, mean_y_values, std_y_values
 
-def mean_event_op(event_list: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
+class EventIndex(NamedTuple):
+    """
+    Compressed (CSR-style) representation of a list of events, entries of event i are indices[offsets[i]:offsets[i+1]].
+    """
+    offsets: np.ndarray
+    indices: np.ndarray
+    lengths: np.ndarray
+    segment: np.ndarray
+
+def compile_events(event_list: Union[List[List[int]], EventIndex]) -> EventIndex:
+    """
+    Compile a list of event indices into a compressed EventIndex, used by the event operators.
+
+    Args:
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event 
+                                                         (returned unchanged if already compiled).
+
+    Returns:
+        EventIndex: Offsets, concatenated indices, lengths, and event number of each entry.
+    """
+    if isinstance(event_list, EventIndex):
+        return event_list
+    lengths = np.array([np.size(event) for event in event_list], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    indices = np.concatenate([np.reshape(event, -1) for event in event_list]).astype(int) if len(event_list) > 0 else np.zeros(0, dtype=int)
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    return EventIndex(offsets, indices, lengths, segment)
+
+def segment_sum(events: EventIndex, values: np.ndarray) -> np.ndarray:
+    """
+    Sum the rows of 'values' (one row per entry of 'events.indices') over each event.
+
+    Args:
+        events (EventIndex): Compiled events.
+        values (np.ndarray): 2D array with one row per event entry.
+
+    Returns:
+        np.ndarray: A 2D array containing the sum over each event.
+    """
+    if len(events.lengths) == 0:
+        return np.zeros((0,) + values.shape[1:])
+    return np.add.reduceat(values, events.offsets[:-1], axis=0)
+
+def mean_event_op(event_list: Union[List[List[int]], EventIndex], Y_pre: np.ndarray) -> np.ndarray:
     """
     Calculate the mean of the events found in the input ensemble time series.
 
     Args:
-        event_list (List[List[int]]): List of lists containing the indices of each event.
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
         Y_pre (np.ndarray): 2D array representing the ensemble of time series.
 
     Returns:
         np.ndarray: A 2D array containing the mean of each event.
     """
-    E = len(event_list) # Number of events
-    N = Y_pre.shape[1] # Ensemble size
-    result = np.zeros((E, N))
-    for i, event_indices in enumerate(event_list):
-        result[i, :] = np.mean(Y_pre[event_indices, :], axis=0)
-    return result
+    events = compile_events(event_list)
+    return segment_sum(events, Y_pre[events.indices, :]) / events.lengths.reshape(-1, 1)
 
-def std_event_op(event_list: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
+def std_event_op(event_list: Union[List[List[int]], EventIndex], Y_pre: np.ndarray) -> np.ndarray:
     """
     Calculate the standard deviation of the events found in the input ensemble time series.
 
     Args:
-        event_list (List[List[int]]): List of lists containing the indices of each event.
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
         Y_pre (np.ndarray): 2D array representing the ensemble of time series.
 
     Returns:
         np.ndarray: A 2D array containing the standard deviation of each event.
     """
-    E = len(event_list) # Number of events
-    N = Y_pre.shape[1] # Ensemble size
-    result = np.zeros((E, N))
-    for i, event_indices in enumerate(event_list):
-        result[i, :] = np.std(Y_pre[event_indices, :], axis=0)
-    return result
+    events = compile_events(event_list)
+    mean = mean_event_op(events, Y_pre)
+    return np.sqrt(segment_sum(events, (Y_pre[events.indices, :] - mean[events.segment, :])**2) / events.lengths.reshape(-1, 1))
 
-def mean_y_event_op(event_list: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
+def mean_y_event_op(event_list: Union[List[List[int]], EventIndex], Y_pre: np.ndarray) -> np.ndarray:
     """
     Calculate the weighted mean of the location (in time) of the events found in the input ensemble time series.
 
     Args:
-        event_list (List[List[int]]): List of lists containing the indices of each event.
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
         Y_pre (np.ndarray): 2D array representing the ensemble of time series.
 
     Returns:
         np.ndarray: A 2D array containing the mean time value of each event.
     """
-    E = len(event_list) # Number of events
-    N = Y_pre.shape[1] # Ensemble size
-    result = np.zeros((E, N))
-    
     #Weighted average (over time) weighted by value
-    for i, event_indices in enumerate(event_list):
-        weights = Y_pre[event_indices, :]
-        weight_sum = np.sum(weights, axis=0)
-        event = np.array(event_indices).reshape(-1, 1)
-        weighted_sum = np.sum(event * weights, axis=0)
-        result[i, :] = weighted_sum / weight_sum
-    return result
+    events = compile_events(event_list)
+    weights = Y_pre[events.indices, :]
+    event = events.indices.reshape(-1, 1)
+    return segment_sum(events, event * weights) / segment_sum(events, weights)
 
-def std_y_event_op(event_list: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
+def std_y_event_op(event_list: Union[List[List[int]], EventIndex], Y_pre: np.ndarray) -> np.ndarray:
     """
     Calculate the weighted standard deviation of the location (in time) of the events found in the input ensemble time series.
 
     Args:
-        event_list (List[List[int]]): List of lists containing the indices of each event.
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
         Y_pre (np.ndarray): 2D array representing the ensemble of time series.
 
     Returns:
         np.ndarray: A 2D array containing the standard deviation of the time location of each event.
     """
-    E = len(event_list)
-    N = Y_pre.shape[1]
-    result = np.zeros((E, N))
-    
-    #Weighted average and std (over time) weighted by value
-    mean_y = mean_y_event_op(event_list, Y_pre)
-    for i, event_indices in enumerate(event_list):
-        weights = Y_pre[event_indices, :]
-        event = np.array(event_indices).reshape(-1, 1)
-        denominator = (((len(event) - 1.0) / len(event)) * np.sum(weights, axis=0))
-        result[i, :] = np.sqrt(np.sum(weights * (event - mean_y[i:i+1, :]) ** 2, axis=0) / denominator)
-    return result
+    events = compile_events(event_list)
+    return event_metrics(events, None, Y_pre)[-1]
 
 def max_event_op(max_values_idx: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
     """
@@ -327,35 +414,256 @@ def max_event_op(max_values_idx: List[List[int]], Y_pre: np.ndarray) -> np.ndarr
     Returns:
         np.ndarray: A 2D array containing the events with maximum values.
     """
-    idxs = np.array(max_values_idx).squeeze()
+    idxs = np.array(max_values_idx, dtype=int).reshape(-1)
     result = Y_pre[idxs, :]
     return result
 
-def slope_event_op(slope_idx: List[List[int]], Y_pre: np.ndarray) -> np.ndarray:
+def slope_event_op(slope_idx: Union[List[List[int]], EventIndex], Y_pre: np.ndarray) -> np.ndarray:
     """
     Calculate the slope of events for each column in the input time series.
 
+    The least squares slopes of all events and all columns are computed at once in closed form.
+
     Args:
-        slope_idx (List[List[int]]): List of lists containing the indices for calculating the slopes of events.
+        slope_idx (Union[List[List[int]], EventIndex]): List of lists containing the indices for calculating the slopes of events.
         Y_pre (np.ndarray): 2D array representing the original time series.
 
     Returns:
         np.ndarray: A 2D array containing the calculated slopes of events for each column in the time series.
     """
-    E = len(slope_idx)
-    N = Y_pre.shape[1]
-    result = np.zeros((E, N))
-    for i, event_indices in enumerate(slope_idx):
-        x = np.array(event_indices).flatten()
-        y = Y_pre[x, :]
-        for j in range(N):
-            result[i, j], _ = np.polyfit(x, y[:, j], 1)
-    return result
+    events = compile_events(slope_idx)
+    x = events.indices.reshape(-1, 1).astype(float)
+    x_centered = x - (segment_sum(events, x) / events.lengths.reshape(-1, 1))[events.segment, :]
+    return segment_sum(events, x_centered * Y_pre[events.indices, :]) / segment_sum(events, x_centered**2)
+
+def event_metrics(event_list: Union[List[List[int]], EventIndex], max_values_idx: List[List[int]], Y_pre: np.ndarray) -> Tuple[np.ndarray]:
+    """
+    Calculate all event metrics (max, mean, std, mean time, std time) of the ensemble in one pass over the event entries.
+
+    Args:
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
+        max_values_idx (List[List[int]]): List of lists containing the indices of maximum values in each event,
+                                          the max metric is skipped (None) if not given.
+        Y_pre (np.ndarray): 2D array representing the ensemble of time series.
+
+    Returns:
+        Tuple[np.ndarray]: The max, mean, std, mean time and std time of each event, each a 2D array (events x ensemble).
+    """
+    events = compile_events(event_list)
+    n = events.lengths.reshape(-1, 1)
+    event = events.indices.reshape(-1, 1)
+    weights = Y_pre[events.indices, :]
+
+    # Value metrics
+    weight_sum = segment_sum(events, weights)
+    mean = weight_sum / n
+    std = np.sqrt(segment_sum(events, (weights - mean[events.segment, :])**2) / n)
+
+    # Time metrics, weighted by value
+    mean_y = segment_sum(events, event * weights) / weight_sum
+    denominator = ((n - 1.0) / n) * weight_sum
+    std_y = np.sqrt(segment_sum(events, weights * (event - mean_y[events.segment, :])**2) / denominator)
+
+    max_val = max_event_op(max_values_idx, Y_pre) if max_values_idx is not None else None
+    return max_val, mean, std, mean_y, std_y
+
+class EventObsOperator:
+    """
+    "Metric" measurement operator, built once per experiment for a fixed observation 'y' and noise 'R'.
+
+    The observed events, their metrics 'y_event' and the metric noise 'R_event' only depend on 'y', 'R' and the 
+    event thresholds, so they are computed on first use and cached. The cache is rebuilt automatically whenever
+    any of these change (including in place changes of 'y' or 'R'), only the ensemble side is computed on each call.
+
+    The metric noise is either estimated from 'n_samp' perturbed observations drawn from a generator seeded with
+    'seed' (default), or computed analytically (see event_noise_cov). Its full covariance is kept in 'R_event_full'.
+    """
+
+    def __init__(self, y: np.ndarray, R: np.ndarray, min_dist: int = 24, thresh_pct: float = 25, min_length: int = 72, 
+                 noise_method: str = 'mc', n_samp: int = 1000, seed: int = 0):
+        """
+        Args:
+            y (np.ndarray): 1D array representing the original time series.
+            R (np.ndarray): diagonal of the measurement error covariance.
+            min_dist (int, optional): Minimum distance allowed between two events.
+            thresh_pct (float, optional): Percentile of the positive observations used as minimum event threshold.
+            min_length (int, optional): Minimum length of an event.
+            noise_method (str, optional): How the metric noise is computed, 'mc' (Monte Carlo) or 'analytic'.
+            n_samp (int, optional): Number of samples used to estimate the metric noise with 'mc'.
+            seed (int, optional): Seed of the generator used to estimate the metric noise with 'mc'.
+        """
+        self.y = y
+        self.R = R
+        self.min_dist = min_dist
+        self.thresh_pct = thresh_pct
+        self.min_length = min_length
+        self.noise_method = noise_method
+        self.n_samp = n_samp
+        self.seed = seed
+        self._key = None
+
+    def _cache_key(self) -> str:
+        # Cheap fingerprint of everything the observation side depends on
+        key = hashlib.sha1()
+        key.update(np.ascontiguousarray(self.y, dtype=float).tobytes())
+        key.update(np.ascontiguousarray(self.R, dtype=float).tobytes())
+        key.update(str((self.min_dist, self.thresh_pct, self.min_length, self.noise_method, self.n_samp, self.seed)).encode())
+        return key.hexdigest()
+
+    def _build(self) -> None:
+        y = self.y
+        R = self.R
+        N_y = len(y)
+
+        # Get the "metric" measurement 
+        if not np.any(y > 0):
+            raise ValueError("No positive observations to find events in")
+        min_thresh = np.percentile(y[y > 0], self.thresh_pct)
+        y_event_idx_list, y_event_list = find_events(y.flatten(), self.min_dist, min_thresh, self.min_length)
+        if len(y_event_idx_list) == 0:
+            raise ValueError("No observed event of at least " + str(self.min_length) + " times above %g" % min_thresh
+                             + ", lower 'event_min_length' or 'event_thresh_pct'")
+        y_max_idx, y_max, y_mean, y_slope, _, y_slope_idx, std_values, mean_y_values, std_y_values = find_metric_values(y_event_idx_list, y_event_list)
+        self.events = compile_events(y_event_idx_list)
+        self.max_idx = y_max_idx
+        self.y_event = np.concatenate((y_max, y_mean, std_values, mean_y_values, std_y_values))
+
+        # Note: we are making the approximation of gaussian metrics, this is required by EKI but there are 
+        # other choices that could be made, only the diagonal of the covariance is used by the update
+        if self.noise_method == 'mc':
+            # Perturb the measurement measurements for emperical approximation of "event" covariance
+            rng = np.random.default_rng(self.seed)
+            y_pert_unbounded = y.reshape(-1, 1) + np.sqrt(R).reshape(-1, 1) * rng.normal(0, 1, (N_y, self.n_samp))
+            y_pert = np.maximum(y_pert_unbounded, 0)
+            y_pert_event = np.concatenate(event_metrics(self.events, self.max_idx, y_pert))
+            self.R_event_full = np.atleast_2d(np.cov(y_pert_event))
+        elif self.noise_method == 'analytic':
+            self.R_event_full = event_noise_cov(self.events, self.max_idx, y, R)
+        else:
+            raise ValueError("Unknown event noise method: " + str(self.noise_method))
+        self.R_event = np.diag(self.R_event_full)
+
+    def __call__(self, Y_pre: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Apply the operator to an ensemble.
+
+        Args:
+            Y_pre (np.ndarray): 2D array representing the ensemble forecast time series.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: A tuple containing the calculated event properties for observation,
+                                                      ensemble forecast, and measurement error covariance.
+        """
+        key = self._cache_key()
+        if key != self._key:
+            self._build()
+            self._key = key
+
+        # Get the "metric" operator
+        Y_pre_event = np.concatenate(event_metrics(self.events, self.max_idx, Y_pre))
+        return self.y_event, Y_pre_event, self.R_event
+
+def event_noise_cov(event_list: Union[List[List[int]], EventIndex], max_values_idx: List[List[int]], y: np.ndarray, R: np.ndarray) -> np.ndarray:
+    """
+    Analytic covariance of the event metrics (max, mean, std, mean time, std time) of observations with independent noise.
+
+    The observations are y + sqrt(R) * e clipped at 0 (as in the Monte Carlo estimate), each value having the mean and 
+    variance of a Gaussian clipped at 0. The max and mean metrics are linear so their variances are exact, the 
+    std, mean time and std time metrics use a first order (delta method) expansion around the clipped mean, the 
+    variance of the std also includes the higher order terms of its square.
+
+    Args:
+        event_list (Union[List[List[int]], EventIndex]): List of lists containing the indices of each event.
+        max_values_idx (List[List[int]]): List of lists containing the indices of maximum values in each event.
+        y (np.ndarray): 1D array representing the original time series.
+        R (np.ndarray): diagonal of the measurement error covariance.
+
+    Returns:
+        np.ndarray: Full covariance of the event metrics, ordered as in event_metrics.
+    """
+    events = compile_events(event_list)
+    E = len(events.lengths)
+    seg = events.segment
+    idx = events.indices
+
+    # Raw moments of each observation in an event, Gaussian clipped at 0
+    mu = np.asarray(y, dtype=float).reshape(-1)[idx]
+    sigma = np.sqrt(np.asarray(R, dtype=float).reshape(-1)[idx])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(sigma > 0, mu / sigma, np.inf)
+        cdf = ndtr(z)
+        pdf = np.where(np.isfinite(z), np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi), 0.0)
+    sp = sigma * pdf
+    M1 = mu * cdf + sp
+    M2 = (mu**2 + sigma**2) * cdf + mu * sp
+    M3 = (mu**3 + 3 * mu * sigma**2) * cdf + (mu**2 + 2 * sigma**2) * sp
+    M4 = (mu**4 + 6 * mu**2 * sigma**2 + 3 * sigma**4) * cdf + (mu**3 + 5 * mu * sigma**2) * sp
+    v = M1
+    var = np.maximum(M2 - M1**2, 0)
+    mu3 = M3 - 3 * M1 * M2 + 2 * M1**3
+    mu4 = np.maximum(M4 - 4 * M1 * M3 + 6 * M1**2 * M2 - 3 * M1**4, 0)
+
+    # Event statistics at the clipped mean
+    n = events.lengths.astype(float)
+    t = idx.astype(float)
+    W = segment_sum(events, v.reshape(-1, 1)).reshape(-1)
+    m = W / n
+    std = np.sqrt(segment_sum(events, ((v - m[seg])**2).reshape(-1, 1)).reshape(-1) / n)
+    c = segment_sum(events, (t * v).reshape(-1, 1)).reshape(-1) / W
+    A = segment_sum(events, (v * (t - c[seg])**2).reshape(-1, 1)).reshape(-1)
+    s = np.sqrt(n * A / ((n - 1.0) * W))
+
+    # Jacobian of each metric with respect to the event entries (each entry belongs to a single event)
+    J = np.zeros((5 * E, len(idx)))
+    cols = np.arange(len(idx))
+    max_idx = np.array(max_values_idx, dtype=int).reshape(-1)
+    J[seg[idx == max_idx[seg]], cols[idx == max_idx[seg]]] = 1.0
+    J[E + seg, cols] = 1.0 / n[seg]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # std is linearized through its square, at the expected noisy variance (std^2 plus the mean noise variance)
+        std_noisy = np.sqrt(std**2 + segment_sum(events, var.reshape(-1, 1)).reshape(-1) * (n - 1.0) / n**2)
+        J[2 * E + seg, cols] = np.where(std_noisy[seg] > 0, (v - m[seg]) / (n[seg] * std_noisy[seg]), 0.0)
+        J[3 * E + seg, cols] = (t - c[seg]) / W[seg]
+        ds2 = n[seg] / ((n[seg] - 1.0) * W[seg]) * ((t - c[seg])**2 - A[seg] / W[seg])
+        J[4 * E + seg, cols] = np.where(s[seg] > 0, ds2 / (2 * s[seg]), 0.0)
+
+    cov = (J * var) @ J.T
+
+    # Higher order terms of the variance of the squared deviations, using the third and fourth central moments
+    # of the clipped noise (skewed and heavy tailed when the noise is large compared to the flow)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sq_var = segment_sum(events, (4 * (v - m[seg]) * mu3 + mu4 - var**2).reshape(-1, 1)).reshape(-1) / n**2
+        cov[2 * E + np.arange(E), 2 * E + np.arange(E)] += np.where(std_noisy > 0, sq_var / (4 * std_noisy**2), 0.0)
+    return cov
+
+def create_event_obs_op(y: np.ndarray, R: np.ndarray, test_dict: Dict[str, Union[str, float]]) -> EventObsOperator:
+    """
+    Create the "metric" measurement operator, using the event thresholds of the test dictionary.
+
+    Args:
+        y (np.ndarray): 1D array representing the original time series.
+        R (np.ndarray): diagonal of the measurement error covariance.
+        test_dict (Dict[str, Union[str, float]]): Test dictionary containing configuration parameters, uses the optional 
+                                                  keys 'event_min_dist', 'event_thresh_pct', 'event_min_length', 
+                                                  'event_noise', 'event_noise_samples' and 'event_noise_seed'.
+
+    Returns:
+        EventObsOperator: The measurement operator.
+    """
+    return EventObsOperator(y, R, 
+                            min_dist=test_dict.get('event_min_dist', 24), 
+                            thresh_pct=test_dict.get('event_thresh_pct', 25), 
+                            min_length=test_dict.get('event_min_length', 72),
+                            noise_method=test_dict.get('event_noise', 'mc'),
+                            n_samp=test_dict.get('event_noise_samples', 1000),
+                            seed=test_dict.get('event_noise_seed', 0))
 
 def event_meas_op(y: np.ndarray, Y_pre: np.ndarray, R: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Perform various operations on events based on input data and parameters.
 
+    Note: this rebuilds the observation side on every call, use an EventObsOperator to reuse it across steps.
+
     Args:
         y (np.ndarray): 1D array representing the original time series.
         Y_pre (np.ndarray): 2D array representing the ensemble forecast time series.
@@ -366,46 +674,13 @@ def event_meas_op(y: np.ndarray, Y_pre: np.ndarray, R: np.ndarray) -> Tuple[np.n
                                                   ensemble forecast, and measurement error covariance.
     """
     #TODO: enable using more than just thses metrics. I.E allow a feature to specify the specific metrics included
-    
-    # Get the "metric" measurement 
-    N_y = Y_pre.shape[0]
-    n_samp = 1000
-    min_dist = 24
-    min_thresh = np.percentile(y[y > 0], 25)
-    min_length = 72
-    y_event_idx_list, y_event_list = find_events(y.flatten(), min_dist, min_thresh, min_length)
-    y_max_idx, y_max, y_mean, y_slope, _, y_slope_idx, std_values, mean_y_values, std_y_values = find_metric_values(y_event_idx_list, y_event_list)
-    y_event = np.concatenate((y_max, y_mean, std_values, mean_y_values, std_y_values))
-
-    # Get the "metric" operator
-    Y_pre_max = max_event_op(y_max_idx, Y_pre)
-    Y_pre_mean = mean_event_op(y_event_idx_list, Y_pre)
-    Y_pre_std = std_event_op(y_event_idx_list, Y_pre)
-    Y_pre_y_mean = mean_y_event_op(y_event_idx_list, Y_pre)
-    Y_pre_y_std = std_y_event_op(y_event_idx_list, Y_pre)
-    Y_pre_event = np.concatenate((Y_pre_max, Y_pre_mean, Y_pre_std, Y_pre_y_mean, Y_pre_y_std))
-
-    # Perturb the measurement measurements for emperical approximation of "event" covariance
-    # Note: we are making the approximation of both uncorrelated metrics and gaussian metrics, 
-    # this is required by EKI but there are other choices that could be made, like keeping R_event full rank
-    # or making a different choice of gaussian approximation.
-    y_pert_unbounded = y.reshape(-1, 1) + np.sqrt(R).reshape(-1, 1) * np.random.normal(0, 1, (N_y, n_samp))
-    y_pert = np.maximum(y_pert_unbounded, 0)
-    y_pert_max = max_event_op(y_max_idx, y_pert)
-    y_pert_mean = mean_event_op(y_event_idx_list, y_pert)
-    y_pert_std = std_event_op(y_event_idx_list, y_pert)
-    y_pert_y_mean = mean_y_event_op(y_event_idx_list, y_pert)
-    y_pert_y_std = std_y_event_op(y_event_idx_list, y_pert)
-    y_pert_event = np.concatenate((y_pert_max, y_pert_mean, y_pert_std, y_pert_y_mean, y_pert_y_std))
-    C_yy = np.cov(y_pert_event)
-    R_event = np.diag(C_yy)
-
-    return y_event, Y_pre_event, R_event
+    return EventObsOperator(y, R)(Y_pre)
 
     
-def EnKF_step(y: np.ndarray, X: np.ndarray, Y: np.ndarray, R: np.ndarray, test_dict: Dict[str, Union[str, float]], i: int) -> np.ndarray:
+def EnKF_step(y: np.ndarray, X: np.ndarray, Y: np.ndarray, R: np.ndarray, test_dict: Dict[str, Union[str, float]], i: int, 
+              obs_op: EventObsOperator = None) -> np.ndarray:
     """
-    Perform an EnKF step based on the type of measurement specified in the test dictionary.
+    Perform an EnKF step based on the type of measurement and filter ('filter_type') specified in the test dictionary.
 
     Args:
         y (np.ndarray): 1D array representing the observation/measurement data.
@@ -414,11 +689,13 @@ def EnKF_step(y: np.ndarray, X: np.ndarray, Y: np.ndarray, R: np.ndarray, test_d
         R (np.ndarray): 1D array representing the measurement error covariance.
         test_dict (Dict[str, Union[str, float]]): Test dictionary containing configuration parameters.
         i (int): Index of the EnKF step.
+        obs_op (EventObsOperator, optional): Cached "metric" measurement operator, reused across steps. 
+                                             Created for this step only if not given.
 
     Returns:
         np.ndarray: The updated ensemble of state vectors after the EnKF step.
     """
-    
+
     # If using threshold operator, just use values larger than thresh_val
     if test_dict["meas_type"] == 'thresh':
         thresh_val = test_dict['thresh_val']
@@ -427,13 +704,16 @@ def EnKF_step(y: np.ndarray, X: np.ndarray, Y: np.ndarray, R: np.ndarray, test_d
         y_use = y[thresh_idx, :]
         R_use = R[thresh_idx]
         Y_use = Y[thresh_idx, :]
-        X_post = EnKF(X, Y_use, y_use, R_use)
+        X_post = update_ensemble(X, Y_use, y_use, R_use, test_dict)
         
     # If using metric operator, switch between metric and thresh every other iteration
     elif test_dict["meas_type"] == 'metric':
         if np.mod(i, 2) == 0:
-            y_use, Y_use, R_use = event_meas_op(y, Y, R)
-            X_post = EnKF(X, Y_use, y_use, R_use)
+            if obs_op is None:
+                obs_op = create_event_obs_op(y, R, test_dict)
+            obs_op.y, obs_op.R = y, R
+            y_use, Y_use, R_use = obs_op(Y)
+            X_post = update_ensemble(X, Y_use, y_use, R_use, test_dict)
             # print('i=',i,':',np.linalg.norm(X_post-X)/np.linalg.norm(X))
         else:
             thresh_val = test_dict['thresh_val']
@@ -442,10 +722,10 @@ def EnKF_step(y: np.ndarray, X: np.ndarray, Y: np.ndarray, R: np.ndarray, test_d
             y_use = y[thresh_idx, :]
             R_use = R[thresh_idx]
             Y_use = Y[thresh_idx, :]
-            X_post = EnKF(X, Y_use, y_use, R_use)
+            X_post = update_ensemble(X, Y_use, y_use, R_use, test_dict)
             # print('i=',i,':',np.linalg.norm(X_post-X)/np.linalg.norm(X))
     
     # Otherwise, just use standard EKI
     else:
-        X_post = EnKF(X, Y, y, R)
+        X_post = update_ensemble(X, Y, y, R, test_dict)
     return X_post
\ No newline at end of file
@@ -3,22 +3,63 @@ import sys
 import shutil
 import numpy as np
 import os
+import time
 
 from tqdm import tqdm
 from utils import process_json, get_ids, get_subwatershed
-from io_ifc import create_meas_sav, create_test_rec, create_prm, create_gbl, create_batch_job_file, save_statistics_csv, save_particles
-from eki import subsample_data, pert, EnKF_step
+from io_ifc import create_meas_sav, create_test_rec, create_prm, create_prm_template, write_prm_member, create_gbl, create_batch_job_file, save_statistics_csv, save_particles, save_archive, save_checkpoint, load_checkpoint
+from eki import subsample_data, pert, EnKF_step, create_event_obs_op
 from latent import create_latent, transform_latent
 from run import run_test
+from executor import get_executor
+from sim_cache import get_sim_cache
+from pipeline import StageTimes, BackgroundWriter
+from ensemble_stats import RunningStatistics
+from archive import ExperimentArchive
+from topology import write_subnetwork
+from forcing import create_forcing
+from staging import create_stage, read_staging_log
+from windows import assimilation_windows, check_window_observations
 from ifc_usgs_fileorder import file_order, usgs_2_id
 
 
-def main(json_name, ens):
+def posterior_members(test_dict, ens, step, step_num):
+    """
+    Get the number of ensemble members whose posterior is simulated at a step, from the optional key 'posterior_runs':
+    'all' (default), 'none', 'final' (all members at the last step only) or 'subset' (the first 'posterior_subset'
+    members, 10 by default, at every step). The posterior run is only used for diagnostics, the next step 
+    perturbs the posterior parameters and runs the prior again.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters.
+        ens (int): Number of ensemble members.
+        step (int): Index of the step.
+        step_num (int): Number of steps.
+
+    Returns:
+        int: Number of members to simulate, from member 0.
+    """
+    posterior_runs = test_dict.get('posterior_runs', 'all')
+    if posterior_runs == 'all':
+        return ens
+    elif posterior_runs == 'none':
+        return 0
+    elif posterior_runs == 'final':
+        return ens if step == step_num - 1 else 0
+    elif posterior_runs == 'subset':
+        return min(ens, test_dict.get('posterior_subset', 10))
+    raise ValueError("Unknown posterior_runs: " + str(posterior_runs))
+
+def main(json_name, ens, resume=False):
     # Read json file and get directories and number of steps
     test_dict = process_json(json_name)
     tmp_dir = test_dict['tmp_dir']
     out_dir = test_dict['out_dir']
     step_num = test_dict['steps']
+    run_timeout = test_dict.get('run_timeout', None)
+    results_memmap = test_dict.get('results_memmap', False)
+    output_format = test_dict.get('output_format', 'csv')
+    keep_particles = test_dict.get('keep_particles', True)
 
     # Get data file location, idx of locations, and standard deviation parameters
     data_file = test_dict['meas_csv']
@@ -33,6 +74,27 @@ def main(json_name, ens):
     os.makedirs(out_dir + 'csv/', exist_ok=True)
     os.makedirs(out_dir + 'npy/', exist_ok=True)
     
+    # Optionally simulate only the links upstream of the gauge, extracted from the full network files
+    if test_dict.get('subnetwork', False):
+        outlet = test_dict.get('subnetwork_outlet', None) or usgs_2_id[usgs]
+        test_dict.update(write_subnetwork(test_dict, outlet, tmp_dir + 'subnetwork'))
+
+    # Assimilation windows, a single one over the whole period unless 'window_hours' is set
+    windows = assimilation_windows(test_dict)
+    windowed = test_dict.get('window_hours', None) is not None
+    states_dir = out_dir + 'states/'
+    if windowed:
+        if not resume and os.path.exists(states_dir):
+            shutil.rmtree(states_dir)
+        os.makedirs(states_dir, exist_ok=True)
+
+    # Optionally read the rainfall of the simulated links once into a local .str file (one per window), instead of every member reading the statewide files
+    if test_dict.get('local_forcing', False):
+        if windowed:
+            test_dict['window_forcing'] = [create_forcing(dict(test_dict, time_start=window.start, time_end=window.end)) for window in windows]
+        else:
+            test_dict['forcing_str'] = create_forcing(test_dict)
+
     # Get list of IDs and create all necesary files
     id_list = get_ids(test_dict)
     sparse_parent = get_subwatershed(test_dict, id_list)
@@ -42,9 +104,25 @@ def main(json_name, ens):
     # Create all necessary files for running tests
     create_meas_sav(test_dict, id_list)
     create_test_rec(test_dict, id_list)
-    create_prm(test_dict, id_list, prm_ens, ens)
+    prm_template = create_prm_template(test_dict, id_list, prm_ens)
+    create_prm(test_dict, id_list, prm_ens, ens, prm_template)
+    executor = get_executor(test_dict)
+    sim_cache = get_sim_cache(test_dict)
+
+    # Optionally copy the inputs shared by every member once per node (e.g. to /dev/shm), the .gbl files refer to the copies.
+    # Members run here are staged now, the job script stages them on each node of the cluster
+    stage = create_stage(test_dict)
+    stage_time = 0.0
+    if stage is not None:
+        test_dict['staged_inputs'] = stage.staged
+        if sim_cache is not None:
+            sim_cache.add_staged(stage.staged)
+        if executor.node_local:
+            stage_start = time.perf_counter()
+            stage.stage()
+            stage_time = time.perf_counter() - stage_start
     create_gbl(test_dict, ens)
-    create_batch_job_file(tmp_dir)
+    create_batch_job_file(tmp_dir, stage)
     
     # Get data from csv file and seperate it into EKI / Plotting / IDs and save to file
     data = np.genfromtxt(data_file, delimiter=',', skip_header=True)
@@ -55,33 +133,134 @@ def main(json_name, ens):
     data_plot, sav_ids = subsample_data(data_tmp, test_dict, id_list, file_order)
     #TDOD: Change this so usgs can be a list of strings, to enable multiple sensors turned on simultaneously
     idx_meas = np.where(sav_ids == usgs_2_id[usgs])[0] 
-    save_statistics_csv(test_dict, sparse_parent, data_plot, name='csv/' + "meas")
+
+    # Outputs of each run go either to the experiment archive (chunks appended to out_dir/archive/) or to npy and csv files
+    output_store = test_dict.get('output_store', 'archive')
+    archive = None
+    if output_store == 'archive':
+        if not resume and os.path.exists(out_dir + 'archive/'):
+            shutil.rmtree(out_dir + 'archive/')
+        archive = ExperimentArchive(out_dir + 'archive/', sav_ids, test_dict.get('archive_dtype', 'float64'), 
+                                    test_dict.get('archive_compress', False))
+        archive.add_observations(data_plot)
+    else:
+        save_statistics_csv(test_dict, sparse_parent, data_plot, name='csv/' + "meas")
+
+    # Every window must have observed flow to find events in
+    check_window_observations(windows, data_use)
 
     # EKI parameters (y = data, X = latent parameter ensemble, R = measurement uncertainty)
     y = np.reshape(data_use,(-1,1)) 
     R = (rel_meas_std * y.reshape(-1))**2 + meas_std**2
     X_post = latent_var
+    obs_op = create_event_obs_op(y, R, test_dict) if not windowed else None
 
-    # Run test
-    for i in tqdm(range(step_num)):
-        # Perturb previous parameters, run model, get simulation results - Prior
-        X_prior = pert(X_post, test_dict, sparse_parent)   
-        prm_ens_prior, _ = transform_latent(test_dict, sparse_parent, X_prior)
-        create_prm(test_dict, id_list, prm_ens_prior, ens) 
-        Y_prior, Y_plot_prior, Y_mean, Y_std, _, _  = run_test(ens, X_prior, tmp_dir, idx_meas)    
-        save_particles(test_dict, sparse_parent, X_prior, Y_plot_prior, name='npy/' + str(i) + '_prior')
-        save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std, X_prior, name='csv/' + str(i) + "_prior")
+    # Continue after the last completed half step (prior or posterior run) of a previous run of this test
+    start_step = 0
+    resume_prior = False
+    if resume:
+        checkpoint = load_checkpoint(test_dict)
+        if checkpoint["X"].shape != latent_var.shape:
+            raise ValueError("The checkpoint does not match the ensemble size or parameters of the test")
+        if checkpoint["phase"] == "prior":
+            start_step = checkpoint["step"]
+            resume_prior = True
+            X_prior, Y_prior = checkpoint["X"], checkpoint["Y"]
+        else:
+            start_step = checkpoint["step"] + 1
+            X_post = checkpoint["X"]
+
+    # Outputs are written in the background while the next ensemble runs, the time each stage waits is reported
+    times = StageTimes()
+    writer = BackgroundWriter(times, test_dict.get('background_writes', True))
+
+    # Statistics at the plotting locations are computed as member outputs are read
+    stats = RunningStatistics(test_dict.get('stat_quantiles', []))
+
+    def window_obs(window):
+        # Observations of a window, with their uncertainty and measurement operator
+        y_window = np.reshape(data_use[window.offset:window.offset + window.length], (-1, 1))
+        R_window = (rel_meas_std * y_window.reshape(-1))**2 + meas_std**2
+        return y_window, R_window, create_event_obs_op(y_window, R_window, test_dict)
+
+    def window_gbl(w, advance):
+        # Writes the .gbl files of a run of window w, the members starting from their states at the start of the window
+        # (saved by the previous window), an advance run stopping at the start of the next window and saving the states there
+        window = windows[w]
+        window_dict = dict(test_dict, time_start=window.start, time_end=window.next_start if advance else window.end)
+        if w > 0:
+            window_dict['member_rec'] = states_dir + str(w) + '_'
+        if advance:
+            window_dict['member_snapshot'] = states_dir + str(w + 1) + '_'
+        if 'window_forcing' in test_dict:
+            window_dict['forcing_str'] = test_dict['window_forcing'][w]
+        create_gbl(window_dict, ens)
+
+    def simulate(X, run_ens, phase, step, use_cache=True):
+        # Writes the parameter files of the first run_ens members and runs them, each member starting
+        # as soon as its file is written on backends which allow it
+        prm_ens_run, _ = transform_latent(test_dict, sparse_parent, X[:, :run_ens])
+        write_member = None
+        if executor.streaming:
+            write_member = lambda j: write_prm_member(tmp_dir, prm_template, prm_ens_run, j)
+        else:
+            create_prm(test_dict, id_list, prm_ens_run, run_ens, prm_template)
+        results = run_test(run_ens, X[:, :run_ens], tmp_dir, idx_meas, executor, run_timeout, memmap=results_memmap, 
+                           output_format=output_format, sim_cache=sim_cache if use_cache else None, write_member=write_member, 
+                           times=times, keep_particles=keep_particles, stats=stats)
+        if sim_cache is not None and use_cache:
+            tqdm.write("Step " + str(step) + " " + phase + ", simulation cache: " + str(sim_cache.hits) + " hits, " + str(sim_cache.misses) + " misses")
+        return results, stats.summary()
+
+    def save_outputs(X, Y_plot, Y_stats, run_ens, step, phase):
+        # Saves the particles (if kept) and statistics of a run in the background, X holds every member even if fewer were run
+        if archive is not None:
+            offset = windows[step // step_num].offset
+            writer.submit(save_archive, archive, test_dict, sparse_parent, X[:, :run_ens], Y_plot, Y_stats, step, phase, offset)
+        else:
+            Y_other = {key: value for key, value in Y_stats.items() if key not in ('mean', 'std')}
+            writer.submit(save_particles, test_dict, sparse_parent, X[:, :run_ens], Y_plot, name='npy/' + str(step) + '_' + phase)
+            writer.submit(save_statistics_csv, test_dict, sparse_parent, Y_stats['mean'], Y_stats['std'], X, 
+                          name='csv/' + str(step) + '_' + phase, Y_stats=Y_other)
+
+    # Run test, 'steps' iterations in each window (step k is iteration i of window w)
+    for k in tqdm(range(start_step, len(windows) * step_num)):
+        w, i = divmod(k, step_num)
+        if windowed and (i == 0 or k == start_step):
+            y, R, obs_op = window_obs(windows[w])
+
+        # Perturb previous parameters, run model, get simulation results - Prior (already done if resuming after it)
+        # pert works in place, and X_post may still be being written
+        if not (resume_prior and k == start_step):
+            X_prior = pert(X_post.copy(), test_dict, sparse_parent)   
+            if windowed:
+                window_gbl(w, False)
+            (Y_prior, Y_plot_prior, _, _, _, _), Y_stats = simulate(X_prior, ens, "prior", k)
+            save_outputs(X_prior, Y_plot_prior, Y_stats, ens, k, "prior")
+            writer.submit(save_checkpoint, test_dict, k, "prior", X_prior, Y_prior, np.random.get_state())
         
-        # Run EKI step, rerun model, record simulation results after assimilation - Posterior 
-        X_post = EnKF_step(y, X_prior, Y_prior, R, test_dict, i)
-        prm_ens_post, _ = transform_latent(test_dict, sparse_parent, X_post)
-        create_prm(test_dict, id_list, prm_ens_post, ens)    
-        Y_post, Y_plot_post, Y_mean, Y_std, _, _ = run_test(ens, X_post, tmp_dir, idx_meas) 
-        save_particles(test_dict, sparse_parent, X_post, Y_plot_post, name='npy/' + str(i) + "_post")
-        save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std, X_post, name='csv/' + str(i) + "_post")
-       
+        # Run EKI step, rerun model on all, some or none of the members, record simulation results after assimilation - Posterior.
+        # The last posterior run of a window (but the last window) runs every member, not cached as it saves their states
+        X_post = EnKF_step(y, X_prior, Y_prior, R, test_dict, i, obs_op)
+        advance = windowed and i == step_num - 1 and windows[w].next_start is not None
+        post_ens = ens if advance else posterior_members(test_dict, ens, i, step_num)
+        if post_ens > 0:
+            if windowed:
+                window_gbl(w, advance)
+            (Y_post, Y_plot_post, _, _, _, _), Y_stats = simulate(X_post, post_ens, "post", k, use_cache=not advance)
+            save_outputs(X_post, Y_plot_post, Y_stats, post_ens, k, "post")
+        writer.submit(save_checkpoint, test_dict, k, "post", X_post, None, np.random.get_state())
+    writer.shutdown()
+    if stage is not None:
+        times.add('staging', busy=stage_time + read_staging_log(tmp_dir))
+    times.add('python', busy=time.perf_counter() - times.start - times.idle['python'])
+    print(times.report())
+    executor.shutdown()
+
     
 if __name__ == "__main__": 
+   # Usage: python eki_test.py test.json ens [--resume]
    json_name = sys.argv[1]
    ens = int(sys.argv[2])
-   main(json_name, ens)
+   resume = "--resume" in sys.argv[3:]
+   main(json_name, ens, resume)
@@ -0,0 +1,147 @@
+import numpy as np
+from typing import List, Tuple, Dict, Union
+
+class RunningStatistics:
+    """
+    Statistics over the ensemble members updated one member at a time, so the results of the whole
+    ensemble never have to be held in memory: mean and standard deviation (Welford's algorithm),
+    minimum, maximum and optionally quantiles (P-square algorithm, Jain and Chlamtac 1985, exact
+    while there are 5 members or fewer, rough estimates for ensembles smaller than a few tens of members).
+
+    Every statistic has the shape of the results of one member. Members can be added in any order,
+    the mean and standard deviation only differ from np.mean and np.std by rounding.
+
+    Args:
+        quantiles (List[float], optional): Probabilities of the quantiles to estimate, e.g. [0.05, 0.5, 0.95].
+    """
+
+    def __init__(self, quantiles: List[float] = ()):
+        self.quantiles = np.array(quantiles, dtype=float).reshape(-1)
+        if np.any((self.quantiles <= 0) | (self.quantiles >= 1)):
+            raise ValueError("Quantile probabilities must be between 0 and 1")
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start a new ensemble. Statistics are recomputed in new arrays, those returned before are left unchanged.
+
+        Returns:
+            None
+        """
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+        self.min = None
+        self.max = None
+        self._first = None
+        self._heights = None
+        self._pos = None
+        self._desired = None
+        self._increment = None
+
+    def update(self, member_results: np.ndarray) -> None:
+        """
+        Add the results of one ensemble member.
+
+        Args:
+            member_results (np.ndarray): Results of the member, the same shape for every member.
+
+        Returns:
+            None
+        """
+        x = np.asarray(member_results, dtype=float)
+        self.count += 1
+        if self.count == 1:
+            self.mean = x.copy()
+            self._m2 = np.zeros(x.shape)
+            self.min = x.copy()
+            self.max = x.copy()
+        else:
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (x - self.mean)
+            np.minimum(self.min, x, out=self.min)
+            np.maximum(self.max, x, out=self.max)
+        if len(self.quantiles) > 0:
+            self._update_quantiles(x)
+
+    @property
+    def std(self) -> np.ndarray:
+        """
+        np.ndarray: Standard deviation over the members (population, as np.std).
+        """
+        return np.sqrt(self._m2 / self.count)
+
+    def _update_quantiles(self, x: np.ndarray) -> None:
+        # The first 5 members are kept, they set the 5 markers of the P-square algorithm
+        if self.count <= 5:
+            if self._first is None:
+                self._first = np.empty((5,) + x.shape)
+            self._first[self.count - 1] = x
+            if self.count == 5:
+                nq = len(self.quantiles)
+                marker_shape = (nq, 5) + (1,) * x.ndim
+                p = self.quantiles[:, None]
+                desired = np.concatenate((np.ones((nq, 1)), 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5 * np.ones((nq, 1))), axis=1)
+                increment = np.concatenate((np.zeros((nq, 1)), p / 2, p, (1 + p) / 2, np.ones((nq, 1))), axis=1)
+                self._heights = np.repeat(np.sort(self._first, axis=0)[None], nq, axis=0)
+                self._pos = np.broadcast_to(np.arange(1.0, 6.0).reshape((1, 5) + (1,) * x.ndim), self._heights.shape).copy()
+                self._desired = np.broadcast_to(desired.reshape(marker_shape), self._heights.shape).copy()
+                self._increment = increment.reshape(marker_shape)
+            return
+
+        h, n = self._heights, self._pos
+
+        # Cell of each value between the markers, the extreme markers follow the minimum and maximum
+        k = np.sum(x[None, None] >= h[:, 1:4], axis=1)
+        np.minimum(h[:, 0], x, out=h[:, 0])
+        np.maximum(h[:, 4], x, out=h[:, 4])
+        n += np.arange(5).reshape((1, 5) + (1,) * x.ndim) > k[:, None]
+        self._desired += self._increment
+
+        # Moves the middle markers by one position towards their desired position, with a piecewise parabolic
+        # prediction of their height, or a linear one if the parabolic one breaks the order of the markers
+        for i in range(1, 4):
+            d = self._desired[:, i] - n[:, i]
+            up = (d >= 1) & (n[:, i + 1] - n[:, i] > 1)
+            down = (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+            move = up | down
+            if not np.any(move):
+                continue
+            s = np.where(up, 1.0, -1.0)
+            parabolic = h[:, i] + s / (n[:, i + 1] - n[:, i - 1]) * (
+                (n[:, i] - n[:, i - 1] + s) * (h[:, i + 1] - h[:, i]) / (n[:, i + 1] - n[:, i])
+                + (n[:, i + 1] - n[:, i] - s) * (h[:, i] - h[:, i - 1]) / (n[:, i] - n[:, i - 1]))
+            linear = h[:, i] + s * (np.where(up, h[:, i + 1], h[:, i - 1]) - h[:, i]) / (np.where(up, n[:, i + 1], n[:, i - 1]) - n[:, i])
+            ordered = (parabolic > h[:, i - 1]) & (parabolic < h[:, i + 1])
+            h[:, i] = np.where(move, np.where(ordered, parabolic, linear), h[:, i])
+            n[:, i] += np.where(move, s, 0.0)
+
+    def quantile(self, q: float) -> np.ndarray:
+        """
+        Get the estimate of one of the quantiles.
+
+        Args:
+            q (float): Probability of the quantile, one of 'quantiles'.
+
+        Returns:
+            np.ndarray: Estimated quantile over the members.
+        """
+        idx = np.flatnonzero(np.isclose(self.quantiles, q))
+        if len(idx) == 0:
+            raise KeyError("Quantile " + str(q) + " is not estimated")
+        if self.count <= 5:
+            return np.quantile(self._first[:self.count], q, axis=0)
+        return self._heights[idx[0], 2].copy()
+
+    def summary(self) -> Dict[str, np.ndarray]:
+        """
+        Get every statistic, quantiles being named by their percentage (e.g. 'q5' for 0.05).
+
+        Returns:
+            Dict[str, np.ndarray]: 'mean', 'std', 'min', 'max' and one 'q<percent>' per quantile.
+        """
+        summary = {"mean": self.mean, "std": self.std, "min": self.min, "max": self.max}
+        for q in self.quantiles:
+            summary["q%g" % (100 * q)] = self.quantile(q)
+        return summary
@@ -0,0 +1,310 @@
+import os
+import shlex
+import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Union
+from utils import time_to_epoch
+
+class Executor:
+    """
+    Base class for the backends used to run the ensemble of asynch simulations.
+
+    Each ensemble member j is described by the file '<tmp_dir><j>.gbl' written by io_ifc.create_gbl,
+    a backend only needs to run asynch (or an equivalent) on the requested members, and write the
+    exit status of each member to '<tmp_dir><j>.status' once it has finished (see write_status), with
+    the error output of a failed member in '<tmp_dir><j>.log' (see log_name).
+
+    Backends with 'streaming' set accept members one at a time as their files are written,
+    the others should be given the whole ensemble at once. Backends with 'node_local' set run
+    the members on this machine, so inputs staged here are visible to them (see staging.py).
+    """
+
+    streaming = False
+    node_local = False
+
+    def submit(self, tmp_dir: str, members: List[int]) -> None:
+        """
+        Start the simulations of the given ensemble members.
+
+        Args:
+            tmp_dir (str): Temporary directory containing the member .gbl files.
+            members (List[int]): Indices of the ensemble members to run.
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def shutdown(self) -> None:
+        """
+        Release any resources held by the backend.
+
+        Returns:
+            None
+        """
+        pass
+
+    def cache_tag(self) -> str:
+        """
+        Describe how the simulations are run, so results of different models are never mixed in a cache.
+
+        Returns:
+            str: Description of the backend.
+        """
+        return type(self).__name__
+
+class SGEExecutor(Executor):
+    """
+    Runs the ensemble as an SGE array job using the 'submit_job.job' script from io_ifc.create_batch_job_file.
+    """
+
+    def submit(self, tmp_dir: str, members: List[int]) -> None:
+        # SGE task ids start at 1, submit one array job per contiguous range of members
+        for first, last in member_ranges(members):
+            job = "qsub -t " + str(first + 1) + ":" + str(last + 1) + ' ' + tmp_dir + 'submit_job.job'
+            os.system(job)
+
+class LocalExecutor(Executor):
+    """
+    Runs the ensemble on the local machine, launching one asynch subprocess per member
+    with at most 'max_workers' of them running at once.
+    """
+
+    streaming = True
+    node_local = True
+
+    def __init__(self, max_workers: int = None, asynch_cmd: str = "asynch"):
+        self.max_workers = max_workers
+        self.asynch_cmd = asynch_cmd
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def _task(self):
+        return run_asynch, (self.asynch_cmd,)
+
+    def submit(self, tmp_dir: str, members: List[int]) -> None:
+        func, args = self._task()
+        for j in members:
+            self.pool.submit(run_member, tmp_dir, j, func, *args)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown()
+
+    def cache_tag(self) -> str:
+        return type(self).__name__ + " " + str(self.asynch_cmd)
+
+class FakeExecutor(LocalExecutor):
+    """
+    Runs a deterministic stand-in for asynch (see fake_asynch), used to test the pipeline
+    on machines without asynch installed.
+    """
+
+    def __init__(self, max_workers: int = None):
+        super().__init__(max_workers, asynch_cmd=None)
+
+    def _task(self):
+        return fake_asynch, ()
+
+def get_executor(test_dict: dict) -> Executor:
+    """
+    Create the execution backend selected in the test dictionary.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional keys
+                          'executor' ('sge', 'local' or 'fake'), 'max_workers' and 'asynch_cmd'.
+
+    Returns:
+        Executor: The execution backend.
+    """
+    executor = test_dict.get("executor", "sge")
+    max_workers = test_dict.get("max_workers", None)
+    if executor == "sge":
+        return SGEExecutor()
+    elif executor == "local":
+        return LocalExecutor(max_workers, test_dict.get("asynch_cmd", "asynch"))
+    elif executor == "fake":
+        return FakeExecutor(max_workers)
+    raise ValueError("Unknown executor: " + str(executor))
+
+def member_ranges(members: List[int]) -> List[Tuple[int, int]]:
+    """
+    Group member indices into contiguous (first, last) ranges.
+
+    Args:
+        members (List[int]): Indices of the ensemble members.
+
+    Returns:
+        List[Tuple[int, int]]: Inclusive ranges covering the members.
+    """
+    ranges = []
+    for j in sorted(members):
+        if ranges and j == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], j)
+        else:
+            ranges.append((j, j))
+    return ranges
+
+def status_name(tmp_dir: str, member: int) -> str:
+    """
+    Get the name of the file holding the exit status of an ensemble member.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+
+    Returns:
+        str: Name of the status file.
+    """
+    return tmp_dir + str(member) + ".status"
+
+def log_name(tmp_dir: str, member: int) -> str:
+    """
+    Get the name of the file holding the error output of an ensemble member.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+
+    Returns:
+        str: Name of the log file.
+    """
+    return tmp_dir + str(member) + ".log"
+
+def read_log(tmp_dir: str, member: int, max_lines: int = 5) -> str:
+    """
+    Get the end of the error output of an ensemble member, for failure reports.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+        max_lines (int, optional): Number of last non empty lines to keep.
+
+    Returns:
+        str: Last lines of the log joined by ' | ', empty if there is no log.
+    """
+    if not os.path.exists(log_name(tmp_dir, member)):
+        return ""
+    with open(log_name(tmp_dir, member), 'r', errors='replace') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return " | ".join(lines[-max_lines:])
+
+def write_status(tmp_dir: str, member: int, code: int) -> None:
+    """
+    Atomically write the exit status of an ensemble member, marking it as finished.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+        code (int): Exit status of the simulation (0 on success).
+
+    Returns:
+        None
+    """
+    name = status_name(tmp_dir, member)
+    with open(name + ".tmp", 'w') as f:
+        f.write("%d\n" % code)
+    os.replace(name + ".tmp", name)
+
+def run_member(tmp_dir: str, member: int, func, *args) -> int:
+    """
+    Run the simulation of one ensemble member and record its exit status.
+
+    Args:
+        tmp_dir (str): Temporary directory containing the member .gbl file.
+        member (int): Index of the ensemble member.
+        func (callable): Function running the simulation for a .gbl file, returning its exit status.
+        *args: Additional arguments passed to 'func'.
+
+    Returns:
+        int: Exit status of the simulation.
+    """
+    # Any exception (e.g. asynch not found) is recorded as a failure in the member's log, so the member is never left pending
+    try:
+        code = func(tmp_dir + str(member) + ".gbl", *args)
+    except Exception as e:
+        with open(log_name(tmp_dir, member), 'a') as f:
+            f.write(type(e).__name__ + ": " + str(e) + "\n")
+        code = -1
+    write_status(tmp_dir, member, code)
+    return code
+
+def run_asynch(gbl_name: str, asynch_cmd: str) -> int:
+    """
+    Run asynch on a single .gbl file, its error output going to the log of the member ('<member>.log' next to the .gbl).
+
+    Args:
+        gbl_name (str): Name of the .gbl file.
+        asynch_cmd (str): Command used to launch asynch, e.g. 'asynch' or 'mpirun -np 2 asynch'.
+
+    Returns:
+        int: Return code of the asynch process.
+    """
+    cmd = shlex.split(asynch_cmd) + [gbl_name]
+    with open(os.path.splitext(gbl_name)[0] + ".log", 'w') as f:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=f).returncode
+
+def fake_asynch(gbl_name: str) -> int:
+    """
+    Deterministic stand-in for asynch, writes the same CSV or HDF5 output asynch would for the given .gbl.
+
+    The hydrograph at each saved link is a train of storm responses whose size and recession
+    depend on the mean of the member's parameters, so that the EKI has something to fit.
+
+    Args:
+        gbl_name (str): Name of the .gbl file, as written by io_ifc.create_gbl.
+
+    Returns:
+        int: Return code (always 0).
+    """
+    with open(gbl_name, 'r') as f:
+        gbl_lines = [line.strip() for line in f.readlines()]
+
+    # Times, print interval, and files used in the .gbl
+    start_time = time_to_epoch(gbl_lines[1])
+    end_time = time_to_epoch(gbl_lines[2])
+    prm_name = [line.split()[1] for line in gbl_lines if line.startswith("0 ") and line.endswith(".prm")][0]
+    sav_name = [line.split()[1] for line in gbl_lines if line.startswith("1 ") and line.endswith(".sav")][0]
+    out_line = [line.split() for line in gbl_lines if line.startswith(("2 ", "5 ")) and line.endswith((".csv", ".h5"))][0]
+    interval = float(out_line[1]) * 60
+    out_name = out_line[2]
+    rec_name = [line.split()[1] for line in gbl_lines if line.startswith("2 ") and line.endswith(".rec")][0]
+    snapshot_names = [line.split()[1] for line in gbl_lines if line.startswith("1 ") and line.endswith(".rec")]
+
+    # Mean of all parameters of the member
+    with open(prm_name, 'r') as f:
+        prm_lines = [line for line in f.readlines() if line.strip()]
+    prm_mean = np.mean([[float(i) for i in line.split()] for line in prm_lines[2::2]])
+    sav_ids = np.array(np.genfromtxt(sav_name, delimiter=','), ndmin=1)
+
+    # Storms every 300 hours, amplitude and recession time scale with the parameters
+    t = np.arange(0, end_time - start_time + interval / 2, interval) / 3600.0
+    t_storm = np.arange(24.0, t[-1] + 1, 300.0)
+    lag = t.reshape(-1, 1) - t_storm.reshape(1, -1)
+    tau = 24.0 * (1.0 + 10.0 * prm_mean)
+    storms = np.sum(np.where(lag >= 0, np.exp(-np.maximum(lag, 0) / tau), 0.0), axis=1)
+    scale = (1.0 + np.arange(len(sav_ids))) * 100.0 * (1.0 + prm_mean)
+    q = 1.0 + storms.reshape(-1, 1) * scale.reshape(1, -1)
+
+    # The states are not simulated, the snapshot is the initial states
+    for snapshot_name in snapshot_names:
+        with open(rec_name, 'r') as f_in, open(snapshot_name, 'w') as f_out:
+            f_out.write(f_in.read())
+
+    if out_line[0] == "5":
+        # Table of (link ID, time, value) rows, ordered by link then time (as written by asynch)
+        import h5py
+        table = np.zeros(q.size, dtype=[("LinkID", np.int32), ("Time", np.float64), ("State0", np.float32)])
+        table["LinkID"] = np.repeat(sav_ids.astype(np.int32), len(t))
+        table["Time"] = np.tile(t * 60.0, len(sav_ids))
+        table["State0"] = q.T.reshape(-1)
+        with h5py.File(out_name, 'w') as f:
+            f.create_dataset("outputs", data=table)
+        return 0
+
+    # Two header lines, then one row per time with a trailing comma (as written by asynch)
+    with open(out_name, 'w') as f:
+        f.write("%d,\n" % len(sav_ids))
+        f.write(",".join(str(int(i)) for i in sav_ids) + ",\n")
+        for row in q:
+            f.write("".join("%.6e," % v for v in row) + "\n")
+    return 0
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+import os
+import sys
+import gzip
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Union
+from network import load_rvr, network_cache_dir
+from utils import process_json, time_to_epoch, LinkIndex
+
+## Local rainfall forcing
+# The rainfall of the IFC archive is one binary file per hour for the whole state, read by asynch
+# (forcing type 5) for every link it simulates. Each member of each run would read the whole archive
+# for the period, so the rainfall of the simulated links is extracted once into a .str file (forcing type 1).
+
+# Resolution of the rainfall files in minutes, as in the '10 60 ...' line of the .gbl
+RAIN_RESOLUTION = 60
+
+# Name of the rainfall file of an hour in the rainfall directory, files ending in '.gz' are gzipped
+RAIN_FILE_FORMAT = "{time}.bin"
+
+def rain_file_name(rain_dir: str, time: int, file_format: str = RAIN_FILE_FORMAT) -> str:
+    """
+    Get the name of the rainfall file of an hour.
+
+    Args:
+        rain_dir (str): Directory of the rainfall files.
+        time (int): Unix time of the hour.
+        file_format (str, optional): Name of the file, '{time}' being replaced by the Unix time.
+
+    Returns:
+        str: Name of the binary file.
+    """
+    return os.path.join(rain_dir, file_format.format(time=time))
+
+def rain_hours(test_dict: dict) -> np.ndarray:
+    """
+    Get the hours of the simulated period, as read by asynch from the rainfall directory.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters.
+
+    Returns:
+        np.ndarray: Unix time of each hour.
+    """
+    epoch_time_start = int(time_to_epoch(test_dict['time_start']))
+    epoch_time_end = int(time_to_epoch(test_dict['time_end']))
+    return np.arange(epoch_time_start, epoch_time_end + 1, RAIN_RESOLUTION * 60)
+
+def rain_files(test_dict: dict) -> List[str]:
+    """
+    Get the rainfall files of the simulated period, raising FileNotFoundError if the rainfall directory or some
+    of its files are missing, rather than simulating the missing hours without rain.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional key 'rain_file_format'
+                          (name of the file of an hour, see RAIN_FILE_FORMAT).
+
+    Returns:
+        List[str]: Name of the file of each hour.
+    """
+    rain_dir = test_dict['rain_dir']
+    file_format = test_dict.get('rain_file_format', RAIN_FILE_FORMAT)
+    file_names = [rain_file_name(rain_dir, int(hour), file_format) for hour in rain_hours(test_dict)]
+    if not os.path.isdir(rain_dir):
+        raise FileNotFoundError("Rainfall directory " + rain_dir + " not found")
+    missing = [name for name in file_names if not os.path.isfile(name)]
+    if missing:
+        raise FileNotFoundError(str(len(missing)) + " of the " + str(len(file_names)) + " rainfall files of the period are missing "
+                                "(see 'rain_file_format'): " + ", ".join(os.path.basename(name) for name in missing[:5])
+                                + (", ..." if len(missing) > 5 else ""))
+    return file_names
+
+def read_rain_file(file_name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read a binary rainfall file, big endian (link ID, rate) pairs of 4 byte integers and floats,
+    links without rain being left out. Files ending in '.gz' are gzipped.
+
+    Args:
+        file_name (str): Name of the binary file.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Link IDs and rainfall rates (mm/hr).
+    """
+    dtype = [('id', '>u4'), ('value', '>f4')]
+    if file_name.endswith(".gz"):
+        with gzip.open(file_name, 'rb') as f:
+            records = np.frombuffer(f.read(), dtype=dtype)
+    else:
+        records = np.fromfile(file_name, dtype=dtype)
+    return records['id'].astype(np.int64), records['value'].astype(float)
+
+def forcing_name(test_dict: dict, link_ids: np.ndarray) -> str:
+    """
+    Get the name of the .str file of the rainfall of a set of links, keyed by the rainfall directory, the
+    simulated period, the names, sizes and modification times of its rainfall files, and the links, so
+    experiments on the same network and period share it while a reprocessed rainfall archive is extracted again.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional keys 'forcing_dir'
+                          (directory of the .str files, defaults to the network cache directory), 'cache_dir'
+                          and 'rain_file_format'.
+        link_ids (np.ndarray): Link IDs of the simulated network.
+
+    Returns:
+        str: Name of the .str file.
+    """
+    forcing_dir = test_dict.get('forcing_dir', None) or network_cache_dir(test_dict) or test_dict['out_dir'] + "cache/"
+    h = hashlib.sha1()
+    h.update((os.path.abspath(test_dict['rain_dir']) + "\n" + test_dict['time_start'] + "\n" + test_dict['time_end'] + "\n").encode())
+    for file_name in rain_files(test_dict):
+        stat = os.stat(file_name)
+        h.update(("%s %d %d\n" % (os.path.basename(file_name), stat.st_size, stat.st_mtime_ns)).encode())
+    h.update(np.sort(np.asarray(link_ids, dtype=np.int64)).tobytes())
+    return os.path.join(forcing_dir, "rain_" + h.hexdigest()[:16] + ".str")
+
+def write_str(str_name: str, link_ids: np.ndarray, link_pos: np.ndarray, times: np.ndarray, values: np.ndarray) -> None:
+    """
+    Write a .str file (number of links, then for each link its ID and number of changes, and a
+    'time value' line per change, the rate being constant until the next change).
+
+    Args:
+        str_name (str): Name of the .str file.
+        link_ids (np.ndarray): Link IDs.
+        link_pos (np.ndarray): Position in link_ids of the link of each change.
+        times (np.ndarray): Time of each change, in minutes from the start of the simulation.
+        values (np.ndarray): Rate after each change.
+
+    Returns:
+        None
+    """
+    order = np.lexsort((times, link_pos))
+    counts = np.bincount(link_pos, minlength=len(link_ids))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    change_lines = ["%d %.6g\n" % (t, v) for t, v in zip(times[order].tolist(), values[order].tolist())]
+
+    # Written under a temporary name then renamed, so concurrent experiments never read a partial file
+    with open(str_name + ".tmp", 'w') as f:
+        f.write("%d\n\n" % len(link_ids))
+        for k, id_val in enumerate(link_ids.tolist()):
+            f.write("%d %d\n" % (id_val, counts[k]))
+            f.write("".join(change_lines[offsets[k]:offsets[k + 1]]))
+            f.write("\n")
+    os.replace(str_name + ".tmp", str_name)
+
+def create_forcing(test_dict: dict, read_workers: int = 4) -> str:
+    """
+    Extract the rainfall of the links of the .rvr over the simulated period into a .str file, unless
+    it was already extracted. The rainfall files are read once, in parallel, keeping only the changes
+    of rate of each link.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, see forcing_name.
+        read_workers (int, optional): Number of threads reading rainfall files.
+
+    Returns:
+        str: Name of the .str file.
+    """
+    link_ids = np.array(load_rvr(test_dict['rvr'], network_cache_dir(test_dict)).ids)
+    str_name = forcing_name(test_dict, link_ids)
+    if os.path.exists(str_name):
+        return str_name
+    os.makedirs(os.path.dirname(str_name) or '.', exist_ok=True)
+
+    # Keeps the rate of each link after every hour where it changed (every link starts without rain)
+    link_index = LinkIndex(link_ids)
+    current = np.zeros(len(link_ids))
+    change_pos, change_times, change_values = [], [], []
+    file_names = rain_files(test_dict)
+    window = 4 * read_workers
+    with ThreadPoolExecutor(max_workers=read_workers) as pool:
+        # Reads ahead a few files at a time, so memory does not grow with the number of hours
+        for start in range(0, len(file_names), window):
+            for k, (ids, values) in enumerate(pool.map(read_rain_file, file_names[start:start + window]), start):
+                rate = np.zeros(len(link_ids))
+                pos = link_index.position(ids)
+                rate[pos[pos >= 0]] = values[pos >= 0]
+                changed = np.flatnonzero(rate != current) if k > 0 else np.arange(len(link_ids))
+                change_pos.append(changed)
+                change_times.append(np.full(len(changed), k * RAIN_RESOLUTION))
+                change_values.append(rate[changed])
+                current = rate
+
+    write_str(str_name, link_ids, np.concatenate(change_pos), np.concatenate(change_times), np.concatenate(change_values))
+    return str_name
+
+def main(json_name: str) -> None:
+    str_name = create_forcing(process_json(json_name))
+    print("Wrote " + str_name)
+
+if __name__ == "__main__":
+    # Usage: python forcing.py test.json
+    main(sys.argv[1])
@@ -1,7 +1,12 @@
+import os
 import numpy as np
-from latent import transform_latent_sparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from latent import transform_latent_sparse, convert_logical, ParamEnsemble
 from typing import List, Tuple, Dict, Union
-from utils import time_to_epoch
+from utils import time_to_epoch, LinkIndex
+from network import load_rec, network_cache_dir
+from archive import ExperimentArchive
+from staging import InputStage
 
 def create_gbl(test_dict: dict, ens: int) -> None:
     """
@@ -26,11 +31,28 @@ def create_gbl(test_dict: dict, ens: int) -> None:
     out_dir = test_dict["out_dir"]
     tmp_dir = test_dict["tmp_dir"]
     
-    # Filenames utilized
-    rvr_name = test_dict["rvr"]
-    mon_name = test_dict["mon"]
-    rec_name = tmp_dir + 'init.rec' 
-    sav_name = tmp_dir + 'meas.sav' 
+    # Filenames utilized, replaced by their node-local copies if staged (see staging.py)
+    staged = test_dict.get("staged_inputs", {})
+    rvr_name = staged.get(test_dict["rvr"], test_dict["rvr"])
+    mon_name = staged.get(test_dict["mon"], test_dict["mon"])
+    rec_name = staged.get(tmp_dir + 'init.rec', tmp_dir + 'init.rec') 
+    sav_name = staged.get(tmp_dir + 'meas.sav', tmp_dir + 'meas.sav') 
+
+    # Rainfall, either the hourly binary files of the whole state or the .str file of the simulated links (see forcing.py)
+    forcing_str = test_dict.get("forcing_str", None)
+    if forcing_str is None:
+        rain_lines = ["5 " + staged.get(rain_dir, rain_dir), "10 60 " + str(epoch_time_start) + " " + str(epoch_time_end)]
+    else:
+        rain_lines = ["1 " + staged.get(forcing_str, forcing_str)]
+
+    # Initial states and end of simulation snapshot (.rec) of each member, if the members start from their own
+    # states ('<member_rec><member>.rec', see windows.py), otherwise they all start from init.rec
+    member_rec = test_dict.get("member_rec", None)
+    member_snapshot = test_dict.get("member_snapshot", None)
+
+    # Hydrograph output, either CSV text or binary HDF5 (2 = .csv file, 5 = .h5 file)
+    output_format = test_dict.get("output_format", "csv")
+    output_type = {"csv": "2", "h5": "5"}[output_format]
     
     # List containing contents of .gbl file
     # For more details, view https://github.com/Iowa-Flood-Center/asynch/tree/develop/examples
@@ -49,15 +71,14 @@ def create_gbl(test_dict: dict, ens: int) -> None:
                 "0 ",
                 "2 " + rec_name,
                 "4", 
-                "5 " + rain_dir, 
-                "10 60 " + str(epoch_time_start) + " " + str(epoch_time_end),
+                *rain_lines,
                 "7 " + mon_name,  
                 str(epoch_time_start) + " " + str(epoch_time_end),
                 "0",
                 "0",
                 "0",
                 "0", 
-                "2 60 ",
+                output_type + " 60 ",
                 "0 ", 
                 "1 " + sav_name, 
                 "0", 
@@ -71,32 +92,148 @@ def create_gbl(test_dict: dict, ens: int) -> None:
                 "1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2", 
                 "1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2 1E-2", 
                 "#"]
-    # Make a copy of gbl_list to modify for ensemble members
+    # Make a copy of gbl_list to modify for ensemble members, the lines after the rainfall move with its number of lines
     gbl_list_copy = gbl_list.copy()  
+    out_idx = 19 + len(rain_lines)
+    snapshot_idx = 23 + len(rain_lines)
+    scratch_idx = 24 + len(rain_lines)
     
     # Write each .gbl within tmp directory
     for i in range(ens):
         gbl_name = tmp_dir + str(i) + ".gbl"
         prm_name = tmp_dir + str(i) + ".prm"
         uini_name = tmp_dir + str(i) + ".rec" 
-        csv_name = tmp_dir + str(i) + ".csv" 
+        out_name = tmp_dir + str(i) + "." + output_format
         gbl_list_copy[10] = gbl_list[10] + prm_name
-        gbl_list_copy[21] = gbl_list[21] + csv_name
-        gbl_list_copy[26] = gbl_list[26] + "_" + str(i)
+        gbl_list_copy[out_idx] = gbl_list[out_idx] + out_name
+        gbl_list_copy[scratch_idx] = gbl_list[scratch_idx] + "_" + str(i)
+        if member_rec is not None:
+            gbl_list_copy[11] = "2 " + member_rec + str(i) + ".rec"
+        if member_snapshot is not None:
+            gbl_list_copy[snapshot_idx] = "1 " + member_snapshot + str(i) + ".rec"
         f = open(gbl_name,'w')
         for item in gbl_list_copy:
             f.write("%s\n" % item)
         f.close()
 
-def create_prm(test_dict: dict, id_list: list, prm_array: np.ndarray, ens: int) -> None:
+class PrmTemplate:
+    """
+    Pre-rendered text of the .prm files of an experiment.
+
+    The ID lines and the parameters that are the same for every member (the ones not distributed
+    in 'prm_dist') are rendered once, so writing a member only formats its active parameters.
+
+    Args:
+        id_list (list): List of IDs, in the order of the parameter rows.
+        prm_values (np.ndarray): Parameter values of each link (id_num, prm_num), only the inactive columns are used.
+        active (list): Logical list, True for the parameters that vary between members.
+    """
+
+    def __init__(self, id_list: list, prm_values: np.ndarray, active: list):
+        self.id_num = len(id_list)
+        self.active = np.flatnonzero(active)
+        self.header = str(self.id_num) + "\n"
+
+        # Render each parameter line with a placeholder in the active columns, then split it around them,
+        # giving the text between the active values of each link (with the separating spaces)
+        prm_text = [[str(item) for item in row] for row in np.asarray(prm_values, dtype=float).tolist()]
+        for row in prm_text:
+            for k in self.active:
+                row[k] = "\0"
+        pieces = [" ".join(row).split("\0") for row in prm_text]
+
+        # The ID line is part of the first piece and the newline of the last
+        self.pieces = [list(piece) for piece in zip(*pieces)]
+        self.pieces[0] = [str(id_val) + "\n" + piece for id_val, piece in zip(id_list, self.pieces[0])]
+        self.pieces[-1] = [piece + "\n" for piece in self.pieces[-1]]
+
+    def active_values(self, prm_array: np.ndarray, member: int) -> np.ndarray:
+        """
+        Get the active parameters of an ensemble member.
+
+        Args:
+            prm_array (Union[ParamEnsemble, np.ndarray]): Parameter ensemble (prm_num, id_num, ens).
+            member (int): Index of the ensemble member.
+
+        Returns:
+            np.ndarray: Active parameter values of the member (active_num, id_num).
+        """
+        if isinstance(prm_array, ParamEnsemble):
+            return prm_array.active_member(member)
+        return prm_array[self.active, :, member]
+
+    def render(self, active_values: np.ndarray) -> str:
+        """
+        Render the .prm file of an ensemble member.
+
+        Args:
+            active_values (np.ndarray): Active parameter values of the member (active_num, id_num).
+
+        Returns:
+            str: Contents of the .prm file.
+        """
+        lines = self.pieces[0]
+        for values, piece in zip(np.asarray(active_values, dtype=float).tolist(), self.pieces[1:]):
+            lines = [line + str(val) + text for line, val, text in zip(lines, values, piece)]
+        return self.header + "".join(lines)
+
+def create_prm_template(test_dict: dict, id_list: list, prm_array: Union[ParamEnsemble, np.ndarray]) -> PrmTemplate:
+    """
+    Create the .prm template of an experiment from a parameter ensemble.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters.
+        id_list (list): List of IDs.
+        prm_array (Union[ParamEnsemble, np.ndarray]): Parameter ensemble (prm_num, id_num, ens), the inactive
+                                                      parameters of the first member are used for the whole experiment.
+
+    Returns:
+        PrmTemplate: The .prm template.
+    """
+    if isinstance(prm_array, ParamEnsemble):
+        return PrmTemplate(id_list, prm_array.prm_array, convert_logical(test_dict["prm_dist"]))
+    return PrmTemplate(id_list, prm_array[:, :, 0].T, convert_logical(test_dict["prm_dist"]))
+
+# Template used by the processes writing .prm files, set once per process by _init_prm_worker
+_prm_template = None
+
+def _init_prm_worker(template: PrmTemplate) -> None:
+    global _prm_template
+    _prm_template = template
+
+def _write_prm_worker(prm_name: str, active_values: np.ndarray) -> None:
+    with open(prm_name, 'w') as f:
+        f.write(_prm_template.render(active_values))
+
+def write_prm_member(tmp_dir: str, template: PrmTemplate, prm_array: Union[ParamEnsemble, np.ndarray], member: int) -> None:
+    """
+    Write the PRM file of one ensemble member.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        template (PrmTemplate): Template from create_prm_template.
+        prm_array (Union[ParamEnsemble, np.ndarray]): Parameter ensemble (prm_num, id_num, ens).
+        member (int): Index of the ensemble member.
+
+    Returns:
+        None
+    """
+    with open(tmp_dir + str(member) + ".prm", 'w') as f:
+        f.write(template.render(template.active_values(prm_array, member)))
+
+def create_prm(test_dict: dict, id_list: list, prm_array: Union[ParamEnsemble, np.ndarray], ens: int, template: PrmTemplate = None) -> None:
     """
     Create PRM files based on the given test dictionary, ID list, and PRM array.
 
+    Members are rendered one at a time from the template, in 'prm_write_workers' processes
+    (optional key, defaults to 1) when more than one.
+
     Args:
         test_dict (dict): Test dictionary containing required parameters.
         id_list (list): List of IDs.
-        prm_array (np.ndarray): Array of PRM values.
+        prm_array (Union[ParamEnsemble, np.ndarray]): Parameter ensemble (prm_num, id_num, ens).
         ens (int): Number of PRM files to create.
+        template (PrmTemplate, optional): Template from create_prm_template, created from prm_array if not given.
 
     Returns:
         None
@@ -109,22 +246,27 @@ def create_prm(test_dict: dict, id_list: list, prm_array: np.ndarray, ens: int)
     # ID 2
     # ...
     
-    # Initialize empty list of size total number of rows
-    id_num = len(id_list)
-    prm_list = [[] for _ in range(2 * id_num + 1)]
-
-    
     tmp_dir = test_dict["tmp_dir"]
-    prm_num = prm_array.shape[1]
-    prm_list[0] = str(id_num)
-    for i in range(ens):
-        prm_name = tmp_dir + str(i) + ".prm"
-        with open(prm_name, 'w') as f:
-            for j in range(id_num):
-                prm_list[1 + 2 * j] = str(id_list[j])
-                prm_list[2 + 2 * j] = " ".join([str(item) for item in prm_array[:, j, i]])
-            for item in prm_list:
-                f.write("%s\n" % item)
+    workers = test_dict.get("prm_write_workers", 1)
+    if template is None:
+        template = create_prm_template(test_dict, id_list, prm_array)
+
+    if workers <= 1:
+        for i in range(ens):
+            write_prm_member(tmp_dir, template, prm_array, i)
+        return
+
+    # Keep at most two members per process in flight, so memory does not grow with the ensemble
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_prm_worker, initargs=(template,)) as pool:
+        pending = set()
+        for i in range(ens):
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(pool.submit(_write_prm_worker, tmp_dir + str(i) + ".prm", template.active_values(prm_array, i)))
+        for future in pending:
+            future.result()
 
 def create_meas_sav(test_dict: dict, id_list: list) -> None:
     """
@@ -144,7 +286,8 @@ def create_meas_sav(test_dict: dict, id_list: list) -> None:
     # Read existing SAV file and filter lines based on ID list
     with open(sav_name, 'r') as f:
         sav_lines = [line.strip() for line in f.readlines() if line.strip()]
-        new_lines = [line for line in sav_lines if int(line) in id_list]
+        keep = LinkIndex(id_list).contains(np.array(sav_lines, dtype=np.int64))
+        new_lines = [line for line, use in zip(sav_lines, keep) if use]
 
     # Write the filtered lines to a new SAV file
     sav_name = tmp_dir + "meas.sav"
@@ -157,31 +300,22 @@ def create_test_rec(test_dict: dict, id_list: list) -> None:
     Create a filtered REC file based on the given test dictionary and ID list.
 
     Args:
-        test_dict (dict): Test dictionary containing required parameters.
+        test_dict (dict): Test dictionary containing required parameters, uses the optional key 'cache_dir'.
         id_list (list): List of IDs (integers) for filtering the REC file.
 
     Returns:
         None
     """
     # Get necessary parameters
-    rec_name = test_dict['rec']
     tmp_dir = test_dict['tmp_dir']
+    rec = load_rec(test_dict['rec'], network_cache_dir(test_dict))
 
-    # Read existing REC file and filter lines based on ID list
-    with open(rec_name, 'r') as f:
-        rec_lines = [line.strip() for line in f.readlines() if line.strip()]
-
-    id_num = len(id_list)
-    rec_lines[1] = str(id_num)
-
-    new_lines = rec_lines[:3]
-    id_lines = rec_lines[3::2]
-    state_lines = rec_lines[4::2]
-
-    for i, line in enumerate(id_lines):
-        if int(line) in id_list:
-            new_lines.append(line)
-            new_lines.append(state_lines[i])
+    # Keep the links in the ID list, in the order of the REC file
+    keep = LinkIndex(id_list).contains(rec.ids)
+    new_lines = [rec.header[0], str(len(id_list)), rec.header[2]]
+    for id_val, state in zip(rec.ids[keep].tolist(), rec.states[keep].tolist()):
+        new_lines.append(str(id_val))
+        new_lines.append(state)
 
     # Write the filtered lines to a new REC file
     rec_name = tmp_dir + "init.rec"
@@ -189,7 +323,7 @@ def create_test_rec(test_dict: dict, id_list: list) -> None:
         for item in new_lines:
             f.write("%s\n" % item)
 
-def save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std=None, X_mat=None, name="results"):
+def save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std=None, X_mat=None, name="results", Y_stats=None):
     """
     Save statistical results to CSV files.
 
@@ -200,6 +334,7 @@ def save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std=None, X_mat=None
         Y_std (np.ndarray, optional): Standard deviation results to be saved to a CSV file.
         X_mat (np.ndarray, optional): Parameter data to compute mean and standard deviation.
         name (str, optional): Prefix for the output CSV file names.
+        Y_stats (dict, optional): Other statistics of the results (e.g. 'min', 'q95'), each saved to '<name>_<key>.csv'.
 
     Returns:
         None
@@ -225,6 +360,11 @@ def save_statistics_csv(test_dict, sparse_parent, Y_mean, Y_std=None, X_mat=None
         out_name_std = out_dir + str(name) + "_std.csv"
         np.savetxt(out_name_std, Y_std_out_content, delimiter=",", fmt="%.5e")
 
+    # Save the other statistics of the results to CSV if provided
+    for stat_name, Y_stat in (Y_stats or {}).items():
+        Y_stat_out_content = np.concatenate((title_y, Y_stat), axis=0)
+        np.savetxt(out_dir + str(name) + "_" + stat_name + ".csv", Y_stat_out_content, delimiter=",", fmt="%.5e")
+
     # Save parameter mean and standard deviation to CSV if X_mat is provided
     if X_mat is not None:
         X_sparse = transform_latent_sparse(test_dict, sparse_parent, X_mat)
@@ -245,7 +385,7 @@ def save_particles(test_dict, sparse_parent, X_particle, Y_particle, name="resul
         test_dict (dict): Test dictionary containing required parameters.
         sparse_parent (dict): Sparse parent information.
         X_particle (np.ndarray): Particle data to be saved to a NPY file.
-        Y_particle (np.ndarray): Particle results to be saved to a NPY file.
+        Y_particle (np.ndarray): Particle results to be saved to a NPY file, only the parameters are saved if None.
         name (str, optional): Prefix for the output NPY file names.
 
     Returns:
@@ -268,22 +408,101 @@ def save_particles(test_dict, sparse_parent, X_particle, Y_particle, name="resul
     X_particle_name = out_dir + str(name) + '_params_particles.npy'
     Y_particle_name = out_dir + str(name) + '_particles.npy'
     
-    with open(Y_particle_name, 'wb') as f:
-        np.save(f, Y_particle)
+    if Y_particle is not None:
+        with open(Y_particle_name, 'wb') as f:
+            np.save(f, Y_particle)
         
     with open(X_particle_name, 'wb') as f:
         np.save(f, X_sparse)
 
-def create_batch_job_file(tmp_dir: str) -> None:
+def save_archive(archive: ExperimentArchive, test_dict: dict, sparse_parent, X_particle: np.ndarray, Y_particle: np.ndarray,
+                 Y_stats: Dict[str, np.ndarray], step: int, phase: str, offset: int = 0) -> None:
+    """
+    Save the particles and statistics of a run to the experiment archive, in place of save_particles and save_statistics_csv.
+
+    Args:
+        archive (ExperimentArchive): Archive of the experiment.
+        test_dict (dict): Test dictionary containing required parameters.
+        sparse_parent (dict): Sparse parent information.
+        X_particle (np.ndarray): Latent parameters of the members.
+        Y_particle (np.ndarray): Simulations of the members at the saved locations (members, time, saved locations),
+                                 None if they were not kept.
+        Y_stats (Dict[str, np.ndarray]): Statistics of the simulations over the members, at least 'mean' and 'std'
+                                         (see RunningStatistics.summary).
+        step (int): Index of the step.
+        phase (str): 'prior' or 'post'.
+        offset (int, optional): Index of the first time of the run in the observations.
+
+    Returns:
+        None
+    """
+    X_sparse = transform_latent_sparse(test_dict, sparse_parent, X_particle)
+    archive.append(step, phase, Y_particle, X_sparse, stats=Y_stats, offset=offset)
+
+def save_checkpoint(test_dict: dict, step: int, phase: str, X: np.ndarray, Y: np.ndarray = None, rng_state: tuple = None) -> None:
+    """
+    Atomically save the state of the assimilation after a completed half step, with the state of
+    the global random generator, to 'checkpoint.npz' in the output directory.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters.
+        step (int): Index of the completed step.
+        phase (str): Completed half step, 'prior' (X and Y are the prior ensemble and its simulation results)
+                     or 'post' (X is the posterior ensemble).
+        X (np.ndarray): Latent parameter ensemble.
+        Y (np.ndarray, optional): Simulation results at the measured locations, one column per member.
+        rng_state (tuple, optional): State of the global random generator (np.random.get_state()) after the 
+                                     half step, defaults to the current state.
+
+    Returns:
+        None
+    """
+    out_dir = test_dict["out_dir"]
+    if rng_state is None:
+        rng_state = np.random.get_state()
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = rng_state
+    checkpoint = {"step": step, "phase": phase, "X": X, 
+                  "rng_keys": rng_keys, "rng_pos": rng_pos, "rng_has_gauss": rng_has_gauss, "rng_gauss": rng_gauss}
+    if Y is not None:
+        checkpoint["Y"] = Y
+
+    # Written next to the checkpoint then renamed, so a crash never leaves a partial checkpoint
+    tmp_name = out_dir + "checkpoint.tmp.npz"
+    np.savez(tmp_name, **checkpoint)
+    os.replace(tmp_name, out_dir + "checkpoint.npz")
+
+def load_checkpoint(test_dict: dict) -> dict:
+    """
+    Load the checkpoint saved by save_checkpoint and restore the state of the global random generator.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters.
+
+    Returns:
+        dict: The 'step' (int), 'phase' (str), 'X' and, after a prior run, 'Y' of the checkpoint.
+    """
+    with np.load(test_dict["out_dir"] + "checkpoint.npz") as f:
+        checkpoint = {key: f[key] for key in f.files}
+    np.random.set_state(("MT19937", checkpoint.pop("rng_keys"), int(checkpoint.pop("rng_pos")), 
+                         int(checkpoint.pop("rng_has_gauss")), float(checkpoint.pop("rng_gauss"))))
+    checkpoint["step"] = int(checkpoint["step"])
+    checkpoint["phase"] = str(checkpoint["phase"])
+    return checkpoint
+
+def create_batch_job_file(tmp_dir: str, stage: InputStage = None) -> None:
     """
-    Create a batch job file for running EKI simulations.
+    Create a batch job file for running EKI simulations, each task records its exit status in '<member>.status'
+    and the error output of asynch in '<member>.log'.
 
     Args:
         tmp_dir (str): Temporary directory where the batch job file will be created.
+        stage (InputStage, optional): Inputs each task stages on its node before running asynch, if not already there.
 
     Returns:
         None
     """
+    if stage is not None:
+        stage.write_list(tmp_dir + 'stage_files.txt')
     with open(tmp_dir + 'submit_job.job', 'w') as f:
         f.write('#!/bin/bash\n')
         f.write('#$ -N EKI_job\n')
@@ -293,5 +512,19 @@ def create_batch_job_file(tmp_dir: str) -> None:
         f.write('#$ -o /dev/null\n')
         f.write('#$ -e /dev/null\n')
         f.write('\n')
+        if stage is not None:
+            for line in stage.script_lines(tmp_dir):
+                f.write(line + '\n')
+            f.write('\n')
         f.write('filename=$(($SGE_TASK_ID - 1))\n')
-        f.write('mpirun -np 2 asynch ' + tmp_dir + '$filename.gbl\n')
\ No newline at end of file
+        if stage is not None:
+            # A member whose inputs could not be staged fails without running asynch (see staging.log)
+            f.write('if [ -n "$stage_failed" ]; then\n')
+            f.write('  echo "Inputs could not be staged on $(hostname), see ' + tmp_dir + 'staging.log" > ' + tmp_dir + '$filename.log\n')
+            f.write('  echo 1 > ' + tmp_dir + '$filename.status.tmp\n')
+            f.write('  mv ' + tmp_dir + '$filename.status.tmp ' + tmp_dir + '$filename.status\n')
+            f.write('  exit 1\n')
+            f.write('fi\n')
+        f.write('mpirun -np 2 asynch ' + tmp_dir + '$filename.gbl 2> ' + tmp_dir + '$filename.log\n')
+        f.write('echo $? > ' + tmp_dir + '$filename.status.tmp\n')
+        f.write('mv ' + tmp_dir + '$filename.status.tmp ' + tmp_dir + '$filename.status\n')
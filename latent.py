@@ -1,5 +1,7 @@
 import json
 import numpy as np
+from scipy.sparse import coo_matrix
+from network import load_prm, network_cache_dir
 from typing import List, Tuple, Dict, Union
 
 def convert_logical(str_list: list) -> list:
@@ -74,7 +76,117 @@ def unbounded_to_bounded(x: np.ndarray, lb: float, ub: float) -> np.ndarray:
     return lb + (x_on_0_1) * (ub - lb)
 
 
-def transform_latent(test_dict: dict, sparse_parent: np.ndarray, latent_var: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+def round_significant(x: np.ndarray, digits: int = 5) -> np.ndarray:
+    """
+    Round values to a number of significant digits, giving the same values as formatting each one with 
+    np.format_float_positional(x, precision=digits, unique=False, fractional=False) and parsing it back.
+
+    Args:
+        x (np.ndarray): Input array.
+        digits (int, optional): Number of significant digits.
+
+    Returns:
+        np.ndarray: Array of rounded values.
+    """
+    x = np.asarray(x, dtype=float)
+    result = x.copy()
+    ax = np.abs(x)
+    idx = np.nonzero(np.isfinite(x) & (x != 0))
+
+    # Decimal exponent of each value, log10 can be off by one next to powers of ten
+    ax_nz = ax[idx]
+    exp = np.floor(np.log10(ax_nz)).astype(int)
+    with np.errstate(over='ignore'):
+        exp[ax_nz < 10.0**exp] -= 1
+        exp[ax_nz >= 10.0**(exp + 1)] += 1
+    shift = digits - 1 - exp
+
+    # Scales by an exact power of ten so rounding to an integer keeps 'digits' digits, then scales back with a 
+    # single correctly rounded operation (identical to parsing the formatted decimal)
+    up = shift >= 0
+    scale = 10.0**np.minimum(np.abs(shift), 308)
+    with np.errstate(over='ignore', invalid='ignore'):
+        scaled = np.where(up, ax_nz * scale, ax_nz / scale)
+        rounded = np.rint(scaled)
+        result[idx] = np.copysign(np.where(up, rounded / scale, rounded * scale), x[idx])
+
+        # Values too close to a rounding tie (scaling may have moved them across it), or where the powers of ten or 
+        # the result are not exact, are formatted one at a time
+        check = (np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6) | (np.abs(shift) > 22) | (~up & (rounded * scale >= 2.0**53))
+    for i in zip(*[axis[check] for axis in idx]):
+        result[i] = float(np.format_float_positional(x[i], precision=digits, unique=False, fractional=False, trim='k'))
+    return result
+
+def parent_index(sparse_parent: coo_matrix) -> np.ndarray:
+    """
+    Get the index of the parent (subwatershed) of each link from the sparse parent matrix.
+
+    Args:
+        sparse_parent (coo_matrix): Sparse parent matrix, with a single 1 in the column of each link.
+
+    Returns:
+        np.ndarray: Parent index of each link.
+    """
+    sparse_parent = coo_matrix(sparse_parent)
+    link_parent = np.zeros(sparse_parent.shape[1], dtype=int)
+    link_parent[sparse_parent.col] = sparse_parent.row
+    return link_parent
+
+class ParamEnsemble:
+    """
+    Parameter ensemble of shape (prm_num, id_num, ens) stored without expanding it to every link and member.
+
+    The template parameters are stored once, and the distributed parameters only once per subwatershed and
+    member, every link taking the values of its parent. Members are expanded on demand (see member and
+    active_member), np.asarray gives the full array.
+
+    Args:
+        prm_array (np.ndarray): Template parameters of each link (id_num, prm_num).
+        active_values (np.ndarray): Values of the distributed parameters of each subwatershed (active_num, out_num, ens).
+        link_parent (np.ndarray): Parent index of each link, from parent_index.
+        active (list): Logical list, True for the distributed parameters.
+    """
+
+    def __init__(self, prm_array: np.ndarray, active_values: np.ndarray, link_parent: np.ndarray, active: list):
+        self.prm_array = prm_array
+        self.active_values = active_values
+        self.link_parent = link_parent
+        self.active = np.flatnonzero(active)
+        self.shape = (prm_array.shape[1], prm_array.shape[0], active_values.shape[2])
+
+    def active_member(self, member: int) -> np.ndarray:
+        """
+        Get the distributed parameters of an ensemble member at every link.
+
+        Args:
+            member (int): Index of the ensemble member.
+
+        Returns:
+            np.ndarray: Distributed parameter values (active_num, id_num).
+        """
+        return self.active_values[:, self.link_parent, member]
+
+    def member(self, member: int) -> np.ndarray:
+        """
+        Get all parameters of an ensemble member at every link.
+
+        Args:
+            member (int): Index of the ensemble member.
+
+        Returns:
+            np.ndarray: Parameter values (prm_num, id_num).
+        """
+        prm_member = self.prm_array.T.copy()
+        prm_member[self.active, :] = self.active_member(member)
+        return prm_member
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        prm_ens = np.repeat(self.prm_array.T[:, :, np.newaxis], self.shape[2], axis=2)
+        for k, i in enumerate(self.active):
+            prm_ens[i, :, :] = self.active_values[k][self.link_parent, :]
+        return prm_ens if dtype is None else prm_ens.astype(dtype)
+
+def transform_latent(test_dict: dict, sparse_parent: np.ndarray, latent_var: np.ndarray) -> Tuple[ParamEnsemble, np.ndarray]:
     """
     Transform latent variables to parameter ensembles based on the given test dictionary and sparse parent data.
 
@@ -84,58 +196,40 @@ def transform_latent(test_dict: dict, sparse_parent: np.ndarray, latent_var: np.
         latent_var (np.ndarray): Array of latent variables to transform.
 
     Returns:
-        Tuple[np.ndarray, np.ndarray]: A tuple containing transformed parameter ensembles (prm_ens) and 
-                                       the list of sorted IDs (id_list).
+        Tuple[ParamEnsemble, np.ndarray]: A tuple containing transformed parameter ensembles (prm_ens) and 
+                                          the list of sorted IDs (id_list).
     """
-    #TODO: get to work with more (or less) prm numbers for different model numbers
-    TOTAL_608_PRM_NUM = 18
-    
-    
-    # Read template PRM file and extract data
-    prm_name = test_dict['prm']
-    with open(prm_name, 'r') as f:
-        prm_lines = [line for line in f.readlines() if line.strip()]
-    id_list_prm = [int(i.strip('\n')) for i in prm_lines[1::2]]
-    prm_list = np.array([[float(i) for i in line.strip('\n').split()] for line in prm_lines[2::2]])
-    
-    # Sort by ascending ID number and get total IDs
-    id_list_arg = np.argsort(id_list_prm)
-    prm_array = prm_list[id_list_arg,:]
-    id_list = np.sort(id_list_prm)
-    id_num = len(id_list)  
+    # Template PRM file, sorted by ascending ID number (parsed once, see network.load_prm)
+    prm_array = load_prm(test_dict['prm'], network_cache_dir(test_dict))
+    id_list = prm_array.ids
+    prm_array = prm_array.values
     ens = latent_var.shape[1]
    
-    # Create a ensemble of parameter matricies
-    prm_ens = np.zeros((TOTAL_608_PRM_NUM,id_num,ens))
     out_num = sparse_parent.shape[0]
+    link_parent = parent_index(sparse_parent)
 
     # Get parameters for transformation
     include_parameters = convert_logical(test_dict["prm_dist"])
     lower_bounds = test_dict['prm_lb']
     upper_bounds = test_dict['prm_ub']
 
+    # Distributed parameters are kept per subwatershed, the others stay as in the template
+    active_values = np.zeros((sum(include_parameters), out_num, ens))
     loc = 0
+    k = 0
     for i, dist in enumerate(include_parameters):
         if dist is True: # Check if using paramters
             # Define bounds
             lb = float(lower_bounds[i])
             ub = float(upper_bounds[i])
             
-            # Convert from sparse to full space
-            lv = (sparse_parent.T)@latent_var[loc:(loc+out_num),:]
-            
             #Apply transformation, and round to 5 digits (necessary for asynch, otherwise will fail)
-            transform_func = lambda x: float(np.format_float_positional(unbounded_to_bounded(x,lb,ub),precision=5,unique=False,fractional=False,trim='k'))  
-            vec_transform_func = np.vectorize(transform_func)
-            var_val = vec_transform_func(lv) 
-            prm_ens[i,:,:] = var_val
+            active_values[k] = round_significant(unbounded_to_bounded(latent_var[loc:(loc+out_num),:],lb,ub), 5)
             
             #Advance forward
             loc = loc + out_num
-        else:   # otherwise, leave alone
-            for j in range(ens):
-                prm_ens[i,:,j] = prm_array[:,i]
-    return prm_ens, id_list
+            k = k + 1
+    return ParamEnsemble(prm_array, active_values, link_parent, include_parameters), id_list
 
 def transform_latent_sparse(test_dict: dict, sparse_parent: np.ndarray, latent_var: np.ndarray) -> np.ndarray:
     """
@@ -0,0 +1,230 @@
+import os
+import hashlib
+import numpy as np
+from typing import List, Tuple, Dict, Union, NamedTuple
+
+## Loaders of the asynch network inputs (.prm, .rec, .rvr)
+# Each file is parsed once per process (kept in memory) and once per change of the file (kept as an .npz
+# in the cache directory, keyed by the path, size and modification time of the file).
+
+class PrmData(NamedTuple):
+    """
+    Parsed .prm file, sorted by ascending ID.
+
+    Attributes:
+        ids (np.ndarray): Link IDs (id_num).
+        values (np.ndarray): Parameters of each link (id_num, prm_num).
+    """
+    ids: np.ndarray
+    values: np.ndarray
+
+class RecData(NamedTuple):
+    """
+    Parsed .rec file, in file order.
+
+    Attributes:
+        header (np.ndarray): Model number, number of links and time lines, as in the file.
+        ids (np.ndarray): Link IDs (id_num).
+        states (np.ndarray): Initial state line of each link, as in the file.
+    """
+    header: np.ndarray
+    ids: np.ndarray
+    states: np.ndarray
+
+class RvrData(NamedTuple):
+    """
+    Parsed .rvr file, in file order, with the children of link ids[k] in children[offsets[k]:offsets[k+1]].
+
+    Attributes:
+        ids (np.ndarray): Link IDs (id_num).
+        offsets (np.ndarray): Start of the children of each link (id_num + 1).
+        children (np.ndarray): Link IDs of the children of every link.
+    """
+    ids: np.ndarray
+    offsets: np.ndarray
+    children: np.ndarray
+
+# Parsed files of this process, (kind, absolute path) -> (size, modification time, data)
+_parsed = {}
+
+def read_lines(file_name: str) -> List[str]:
+    """
+    Read the non-empty lines of a file.
+
+    Args:
+        file_name (str): Name of the file.
+
+    Returns:
+        List[str]: Stripped non-empty lines.
+    """
+    with open(file_name, 'r') as f:
+        return [line.strip() for line in f.readlines() if line.strip()]
+
+def parse_prm(prm_name: str) -> PrmData:
+    """
+    Parse a .prm file (number of links, then an ID line and a parameter line per link).
+
+    Args:
+        prm_name (str): Name of the .prm file.
+
+    Returns:
+        PrmData: IDs and parameters, sorted by ascending ID.
+    """
+    prm_lines = read_lines(prm_name)
+    ids = np.array(prm_lines[1::2], dtype=np.int64)
+    values = np.array(" ".join(prm_lines[2::2]).split(), dtype=float).reshape(len(ids), -1)
+    idx_sort = np.argsort(ids)
+    return PrmData(ids[idx_sort], values[idx_sort, :])
+
+def parse_rec(rec_name: str) -> RecData:
+    """
+    Parse a .rec file (model, number of links and time, then an ID line and a state line per link).
+
+    Args:
+        rec_name (str): Name of the .rec file.
+
+    Returns:
+        RecData: Header, IDs and state lines, in file order.
+    """
+    rec_lines = read_lines(rec_name)
+    return RecData(np.array(rec_lines[:3]), np.array(rec_lines[3::2], dtype=np.int64), np.array(rec_lines[4::2]))
+
+def parse_rvr(rvr_name: str) -> RvrData:
+    """
+    Parse a .rvr file (number of links, then an ID line and a 'number of children, children' line per link).
+
+    Args:
+        rvr_name (str): Name of the .rvr file.
+
+    Returns:
+        RvrData: IDs and children of each link, in file order.
+    """
+    rvr_lines = read_lines(rvr_name)
+    ids = np.array(rvr_lines[1::2], dtype=np.int64)
+    tokens = np.array(" ".join(rvr_lines[2::2]).split(), dtype=np.int64)
+
+    # Each child line is its number of children followed by the children, drop the numbers
+    counts = np.array([line.split(None, 1)[0] for line in rvr_lines[2::2]], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts + 1)[:-1]))
+    is_child = np.ones(len(tokens), dtype=bool)
+    is_child[starts] = False
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return RvrData(ids, offsets, tokens[is_child])
+
+_parsers = {"prm": (parse_prm, PrmData), "rec": (parse_rec, RecData), "rvr": (parse_rvr, RvrData)}
+
+def cache_name(cache_dir: str, kind: str, file_name: str) -> str:
+    """
+    Get the name of the binary cache of a network input file.
+
+    Args:
+        cache_dir (str): Cache directory.
+        kind (str): Type of file ('prm', 'rec' or 'rvr').
+        file_name (str): Name of the input file.
+
+    Returns:
+        str: Name of the .npz cache file.
+    """
+    path = os.path.abspath(file_name)
+    key = hashlib.sha1(path.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(path) + "." + key + "." + kind + ".npz")
+
+def network_cache_dir(test_dict: dict) -> str:
+    """
+    Get the directory of the binary cache of the network files of a test.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional key 'cache_dir'.
+
+    Returns:
+        str: 'cache_dir', or 'out_dir/cache/' if it is missing, None if the disk cache is disabled.
+    """
+    if 'cache_dir' in test_dict:
+        return test_dict['cache_dir']
+    return test_dict['out_dir'] + "cache/"
+
+def load_network_file(file_name: str, kind: str, cache_dir: str = None) -> Union[PrmData, RecData, RvrData]:
+    """
+    Load a parsed network input file, from memory, from the binary cache, or by parsing it.
+
+    Args:
+        file_name (str): Name of the input file.
+        kind (str): Type of file ('prm', 'rec' or 'rvr').
+        cache_dir (str, optional): Directory of the binary cache, None to only keep the file in memory.
+
+    Returns:
+        Union[PrmData, RecData, RvrData]: Parsed file, its arrays are shared and read only.
+    """
+    parse, data_type = _parsers[kind]
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+
+    # Already parsed by this process
+    memo = _parsed.get((kind, path))
+    if memo is not None and memo[0] == stamp:
+        return memo[1]
+
+    # Binary cache, valid if written for the same size and modification time
+    data = None
+    npz_name = cache_name(cache_dir, kind, file_name) if cache_dir is not None else None
+    if npz_name is not None and os.path.exists(npz_name):
+        try:
+            with np.load(npz_name) as f:
+                if tuple(f["stamp"]) == stamp:
+                    data = data_type(*[f[field] for field in data_type._fields])
+        except (OSError, KeyError, ValueError):
+            data = None
+
+    # Parse the file and write the cache (atomically, so concurrent runs never read a partial file)
+    if data is None:
+        data = parse(file_name)
+        if npz_name is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_name = npz_name + "." + str(os.getpid()) + ".tmp.npz"
+            np.savez(tmp_name, stamp=np.array(stamp, dtype=np.int64), **data._asdict())
+            os.replace(tmp_name, npz_name)
+
+    for arr in data:
+        arr.setflags(write=False)
+    _parsed[(kind, path)] = (stamp, data)
+    return data
+
+def load_prm(prm_name: str, cache_dir: str = None) -> PrmData:
+    """
+    Load a .prm file, see load_network_file.
+
+    Args:
+        prm_name (str): Name of the .prm file.
+        cache_dir (str, optional): Directory of the binary cache, None to disable it.
+
+    Returns:
+        PrmData: IDs and parameters, sorted by ascending ID.
+    """
+    return load_network_file(prm_name, "prm", cache_dir)
+
+def load_rec(rec_name: str, cache_dir: str = None) -> RecData:
+    """
+    Load a .rec file, see load_network_file.
+
+    Args:
+        rec_name (str): Name of the .rec file.
+        cache_dir (str, optional): Directory of the binary cache, None to disable it.
+
+    Returns:
+        RecData: Header, IDs and state lines, in file order.
+    """
+    return load_network_file(rec_name, "rec", cache_dir)
+
+def load_rvr(rvr_name: str, cache_dir: str = None) -> RvrData:
+    """
+    Load a .rvr file, see load_network_file.
+
+    Args:
+        rvr_name (str): Name of the .rvr file.
+        cache_dir (str, optional): Directory of the binary cache, None to disable it.
+
+    Returns:
+        RvrData: IDs and children of each link, in file order.
+    """
+    return load_network_file(rvr_name, "rvr", cache_dir)
@@ -0,0 +1,161 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Union
+
+class StageTimes:
+    """
+    Busy and idle time of the stages of the assimilation loop, to find its critical path.
+
+    The stages are 'python' (the main process, idle while it waits for the ensemble), 'model'
+    (the simulations, idle whenever none is submitted, e.g. while Python writes files or updates
+    the ensemble) and 'writer' (the background writer of the outputs, see BackgroundWriter).
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.busy = defaultdict(float)
+        self.idle = defaultdict(float)
+        self._model_start = self.start
+        self._model_stop = self.start
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Count the time spent in a block as busy time of a stage.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy[name] += time.perf_counter() - start
+
+    def add(self, name: str, busy: float = 0.0, idle: float = 0.0) -> None:
+        """
+        Add busy and idle time to a stage.
+
+        Args:
+            name (str): Name of the stage.
+            busy (float, optional): Busy time in seconds.
+            idle (float, optional): Idle time in seconds.
+
+        Returns:
+            None
+        """
+        self.busy[name] += busy
+        self.idle[name] += idle
+
+    def model_started(self) -> None:
+        """
+        Record the submission of the first member of an ensemble run, the model was idle since the last run.
+
+        Returns:
+            None
+        """
+        now = time.perf_counter()
+        self.idle['model'] += now - self._model_stop
+        self._model_start = now
+
+    def model_stopped(self) -> None:
+        """
+        Record the end of the last member of an ensemble run.
+
+        Returns:
+            None
+        """
+        now = time.perf_counter()
+        self.busy['model'] += now - self._model_start
+        self._model_stop = now
+
+    def report(self) -> str:
+        """
+        Summarize the busy and idle time of every stage.
+
+        Returns:
+            str: One line per stage.
+        """
+        total = time.perf_counter() - self.start
+        lines = ["Stage times over %.1f s:" % total]
+        for name in sorted(set(self.busy) | set(self.idle)):
+            lines.append("  %-7s busy %8.1f s, idle %8.1f s" % (name, self.busy[name], self.idle[name]))
+        return "\n".join(lines)
+
+class BackgroundWriter:
+    """
+    Runs output writing functions in a background thread, in the order they were submitted, so the main
+    process can go on with the next simulation while the outputs of the previous one are written.
+
+    Args:
+        times (StageTimes, optional): Records the busy and idle time of the writer under 'writer'.
+        enabled (bool, optional): If False, functions run immediately in the calling thread.
+    """
+
+    def __init__(self, times: StageTimes = None, enabled: bool = True):
+        self.times = times
+        self.enabled = enabled
+        self.pool = ThreadPoolExecutor(max_workers=1) if enabled else None
+        self.futures = []
+        self.start = time.perf_counter()
+        self.busy = 0.0
+
+    def _run(self, func, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.busy += time.perf_counter() - start
+
+    def submit(self, func, *args, **kwargs) -> None:
+        """
+        Write in the background, the arguments must not be modified afterwards.
+
+        Errors of earlier writes are raised here, so a failing writer stops the test early.
+
+        Args:
+            func (callable): Function writing the output.
+            *args: Arguments passed to 'func'.
+            **kwargs: Keyword arguments passed to 'func'.
+
+        Returns:
+            None
+        """
+        self._check()
+        if not self.enabled:
+            self._run(func, args, kwargs)
+            return
+        self.futures.append(self.pool.submit(self._run, func, args, kwargs))
+
+    def _check(self) -> None:
+        # Raises the first error of the finished writes and forgets them
+        done = [future for future in self.futures if future.done()]
+        self.futures = [future for future in self.futures if future not in done]
+        for future in done:
+            future.result()
+
+    def flush(self) -> None:
+        """
+        Wait for every submitted write, raising the first error.
+
+        Returns:
+            None
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self) -> None:
+        """
+        Wait for every submitted write, then record the writer times.
+
+        Returns:
+            None
+        """
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.times is not None:
+            self.times.add('writer', busy=self.busy, idle=time.perf_counter() - self.start - self.busy)
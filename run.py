@@ -1,61 +1,328 @@
 import os
 import numpy as np
 import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict, Union
+from executor import Executor, SGEExecutor, status_name, log_name, read_log
+from utils import LinkIndex
+from sim_cache import SimulationCache
+from pipeline import StageTimes
+from ensemble_stats import RunningStatistics
 
-def run_test(ens: int, X: np.ndarray, tmp_dir: str, idx_meas: np.ndarray) -> Tuple[np.ndarray]:
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+def wait_for_members(tmp_dir: str, members: List[int], on_done, timeout: float = None, poll_interval: float = 1.0) -> None:
+    """
+    Wait for the ensemble members to finish, calling 'on_done' for each member as soon as it has finished successfully.
+
+    Completion is detected through the '<member>.status' files written by the execution backend.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        members (List[int]): Indices of the ensemble members to wait for.
+        on_done (callable): Function called with the index of each successfully finished member.
+        timeout (float, optional): Maximum time to wait in seconds, waits indefinitely if None.
+        poll_interval (float, optional): Time in seconds between checks of the status files.
+
+    Returns:
+        None
+    """
+    start_time = time.time()
+    pending = set(members)
+    failed = {}
+
+    while pending:
+        # Checks the status files of the members still running
+        finished = [j for j in pending if os.path.exists(status_name(tmp_dir, j))]
+        for j in finished:
+            pending.remove(j)
+            with open(status_name(tmp_dir, j), 'r') as f:
+                code = int(f.read().strip() or -1)
+            os.remove(status_name(tmp_dir, j))
+            if code != 0:
+                # Reports the end of the member's error output (exception, asynch stderr) with its status
+                log = read_log(tmp_dir, j)
+                failed[j] = "exit status " + str(code) + (": " + log if log else "")
+                continue
+            try:
+                on_done(j)
+            except Exception as e:
+                failed[j] = "unreadable output (" + str(e) + ")"
+
+        if pending:
+            if timeout is not None and time.time() - start_time > timeout:
+                break
+            time.sleep(poll_interval)
+
+    # Reports every member which did not finish correctly
+    if failed or pending:
+        report = "Ensemble run failed after " + str(round(time.time() - start_time, 1)) + " s."
+        if failed:
+            report += " Failed members: " + ", ".join(str(j) + " (" + failed[j] + ")" for j in sorted(failed)) + "."
+        if pending:
+            report += " Timed out waiting for members: " + str(sorted(pending)) + "."
+        raise RuntimeError(report)
+
+def read_member_csv(tmp_dir: str, member: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Read the results of an ensemble member from its asynch CSV output.
+
+    Only the value columns are parsed, the trailing empty column written by asynch is skipped.
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+        out (np.ndarray, optional): Preallocated array of shape (time, saved locations) to read the results into.
+
+    Returns:
+        np.ndarray: Results with shape (time, saved locations).
+    """
+    csv_name = tmp_dir + str(member) + ".csv"
+
+    # Number of values from the first row, each value is followed by a comma
+    with open(csv_name, 'r') as f:
+        f.readline()
+        f.readline()
+        sav_num = f.readline().count(',')
+    if sav_num == 0:
+        raise ValueError("empty results file")
+
+    results = np.loadtxt(csv_name, delimiter=',', skiprows=2, usecols=range(sav_num), ndmin=2)
+    if out is None:
+        return results
+    out[...] = results
+    return out
+
+def read_member_h5(tmp_dir: str, member: int, out: np.ndarray = None, sav_ids: np.ndarray = None) -> np.ndarray:
+    """
+    Read the results of an ensemble member from its asynch HDF5 output, without any text parsing.
+
+    The file holds a single table 'outputs' with one row per (link, time), the fields being the link ID, 
+    the time, then the printed component (State0).
+
+    Args:
+        tmp_dir (str): Temporary directory path.
+        member (int): Index of the ensemble member.
+        out (np.ndarray, optional): Preallocated array of shape (time, saved locations) to read the results into.
+        sav_ids (np.ndarray, optional): Link IDs in the column order of the results, defaults to the IDs in 'meas.sav'.
+
+    Returns:
+        np.ndarray: Results with shape (time, saved locations).
+    """
+    if h5py is None:
+        raise ImportError("h5py is required to read asynch .h5 output")
+    if sav_ids is None:
+        sav_ids = np.array(np.genfromtxt(tmp_dir + "meas.sav", delimiter=','), ndmin=1)
+
+    with h5py.File(tmp_dir + str(member) + ".h5", 'r') as f:
+        table = f["outputs"][()]
+    if table.size == 0:
+        raise ValueError("empty results file")
+    link_field, time_field, value_field = table.dtype.names[:3]
+
+    # Orders rows by position of the link in sav_ids, then by time, every link having the same number of times
+    sav_num = len(sav_ids)
+    link_pos = LinkIndex(sav_ids).position(table[link_field])
+    if np.any(link_pos < 0):
+        raise ValueError("links not in the saved links: " + str(np.unique(table[link_field][link_pos < 0])[:10].tolist()))
+    counts = np.bincount(link_pos, minlength=sav_num)
+    if np.any(counts != counts.max()):
+        raise ValueError("saved links missing or with fewer times: " + str(np.asarray(sav_ids, dtype=np.int64)[counts != counts.max()][:10].tolist()))
+    order = np.lexsort((table[time_field], link_pos))
+    results = table[value_field][order].reshape(sav_num, -1).T
+    if out is None:
+        return results.astype(float)
+    out[...] = results
+    return out
+
+def allocate_results(shape: Tuple[int], tmp_dir: str, memmap: bool = False) -> np.ndarray:
+    """
+    Allocate the array holding the results of the whole ensemble.
+
+    Args:
+        shape (Tuple[int]): Shape of the array (ensemble members, time, saved locations).
+        tmp_dir (str): Temporary directory path, used for the backing file when memory mapping.
+        memmap (bool, optional): Back the array by a file in tmp_dir instead of memory.
+
+    Returns:
+        np.ndarray: Uninitialized array of the given shape.
+    """
+    if not memmap:
+        return np.empty(shape)
+
+    # The backing file is unlinked right away, the mapping stays valid until the array is released
+    fd, name = tempfile.mkstemp(suffix=".npy", dir=tmp_dir)
+    os.close(fd)
+    results = np.lib.format.open_memmap(name, mode='w+', dtype=float, shape=shape)
+    os.remove(name)
+    return results
+
+def index_as_slice(idx: np.ndarray) -> Union[slice, np.ndarray]:
+    """
+    Convert an array of consecutive indices to a slice, so indexing with it gives a view instead of a copy.
+
+    Args:
+        idx (np.ndarray): Array of indices.
+
+    Returns:
+        Union[slice, np.ndarray]: Equivalent slice, or the array itself if the indices are not consecutive.
+    """
+    idx = np.asarray(idx).reshape(-1)
+    if len(idx) > 0 and np.all(np.diff(idx) == 1):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+def run_test(ens: int, X: np.ndarray, tmp_dir: str, idx_meas: np.ndarray, executor: Executor = None,
+             timeout: float = None, poll_interval: float = 1.0, memmap: bool = False,
+             read_workers: int = 4, output_format: str = "csv", sim_cache: SimulationCache = None,
+             write_member=None, times: StageTimes = None, keep_particles: bool = True,
+             stats: RunningStatistics = None) -> Tuple[np.ndarray]:
     """
     Run the test with given ensemble size, latent parameter ensemble, temporary directory, and measurement indices.
 
+    The statistics at the plotting locations are updated as the output of each member is read. The results
+    of all members are only kept, in a single (ensemble members, time, saved locations) array, if 'keep_particles',
+    otherwise only the results at the measured locations are kept.
+
     Args:
         ens (int): Number of ensemble members.
         X (np.ndarray): Latent parameter ensemble.
         tmp_dir (str): Temporary directory path.
         idx_meas (np.ndarray): Array containing measurement indices.
+        executor (Executor, optional): Backend used to run the ensemble, defaults to an SGE array job.
+        timeout (float, optional): Maximum time in seconds to wait for the ensemble, waits indefinitely if None.
+        poll_interval (float, optional): Time in seconds between checks for finished members.
+        memmap (bool, optional): Back the ensemble results by a memory mapped file in tmp_dir.
+        read_workers (int, optional): Number of threads reading member results in parallel.
+        output_format (str, optional): Format of the asynch output, 'csv' or 'h5' (see io_ifc.create_gbl).
+        sim_cache (SimulationCache, optional): Cache of previous outputs, only members not in it are run.
+        write_member (callable, optional): Function writing the input files of a member, called with its index. 
+                                           On streaming backends each member is submitted as soon as it is written.
+        times (StageTimes, optional): Records the time the model was running and the time spent waiting for it.
+        keep_particles (bool, optional): Keep and return the results of every member at the plotting locations,
+                                         'Y_plot' is None otherwise (the statistics may then differ in their last
+                                         bits between runs, members being added in the order they finish).
+        stats (RunningStatistics, optional): Statistics over the members to update (reset first), for the minimum,
+                                             maximum or quantiles of the run. Mean and standard deviation only if None.
 
     Returns:
         Tuple[np.ndarray]: A tuple containing simulation results and statistics.
     """
     
-    # Runs test utilizing 'submit_job.job' script, submiting array job
-    job = "qsub -t 1:" + str(ens) + ' ' + tmp_dir + 'submit_job.job'
-    procs = os.system(job)
-
-    # Tries to read results files, retries every 100 seconds
-    while True:
-        try:
-            read_values = [np.genfromtxt(tmp_dir + str(j) + ".csv", delimiter=',', skip_header=2) for j in range(ens)]
-            count_all = np.array([a.size for a in read_values])
-
-            #makes sure results are all the same size and not all 0
-            if (np.max(count_all) - np.min(count_all)) == 0:
-                if np.any(np.max(count_all) == 0):
-                    pass
-                else:
-                    break
-        except:
-            print("not finished, waiting 100 seconds")
-            time.sleep(100)
-            #TODO: probably should ensure this doesnt go forever if unmonitored
-
-    # Removes last column (bug associated with written csv file, extra empty column)
-    read_values_fixed = [results[:, :-1] for results in read_values]
+    # Runs test on the selected backend (by default the 'submit_job.job' script, submiting array job)
+    if executor is None:
+        executor = SGEExecutor()
+    members = list(range(ens))
+    for j in members:
+        for name in (status_name(tmp_dir, j), log_name(tmp_dir, j)):
+            if os.path.exists(name):
+                os.remove(name)
+    if sim_cache is not None:
+        sim_cache.begin()
+
+    # Starts the members which are not cached
+    members_run = []
+    def start(batch):
+        if sim_cache is not None:
+            batch = sim_cache.fetch_members(tmp_dir, batch, output_format, executor.cache_tag())
+        if batch:
+            if times is not None and not members_run:
+                times.model_started()
+            executor.submit(tmp_dir, batch)
+            members_run.extend(batch)
+
+    # Writes the input files of each member, starting it right away if the backend accepts single members
+    if write_member is not None and executor.streaming:
+        for j in members:
+            write_member(j)
+            start([j])
+    else:
+        if write_member is not None:
+            for j in members:
+                write_member(j)
+        start(members)
+
+    # Selects the reader matching the asynch output format
+    if output_format == "h5":
+        sav_ids = np.array(np.genfromtxt(tmp_dir + "meas.sav", delimiter=','), ndmin=1)
+        read_member = lambda tmp_dir, j, out=None: read_member_h5(tmp_dir, j, out, sav_ids)
+    else:
+        read_member = read_member_csv
+
+    # Reads the results of each member as soon as it has finished and adds them to the statistics,
+    # the first member read sets the array sizes
+    if stats is None:
+        stats = RunningStatistics()
+    stats.reset()
+    idx_meas = index_as_slice(idx_meas)
+    lock = threading.Lock()
+    results = None
+    meas_results = None
+    reads = {}
+    waiting = {}
+    next_member = 0
+    def add(j, member_results):
+        # When the results are kept, members are added to the statistics in member order whatever order they
+        # finish in, so the statistics are reproducible (members finished early wait as views of 'results').
+        # Otherwise they are added as they are read, and the statistics may differ in their last bits between runs
+        nonlocal next_member
+        with lock:
+            meas_results[j] = member_results[:, idx_meas]
+            if results is None:
+                stats.update(member_results)
+                return
+            waiting[j] = results[j]
+            while next_member in waiting:
+                stats.update(waiting.pop(next_member))
+                next_member += 1
+    def read(j, out=None):
+        add(j, read_member(tmp_dir, j, out))
+    with ThreadPoolExecutor(max_workers=read_workers) as pool:
+        def on_done(j):
+            nonlocal results, meas_results
+            if meas_results is None:
+                first_results = read_member(tmp_dir, j)
+                meas_results = np.empty((ens,) + first_results[:, idx_meas].shape)
+                if keep_particles:
+                    results = allocate_results((ens,) + first_results.shape, tmp_dir, memmap)
+                    results[j] = first_results
+                add(j, first_results)
+            else:
+                reads[j] = pool.submit(read, j, None if results is None else results[j])
+        wait_start = time.perf_counter()
+        wait_for_members(tmp_dir, members, on_done, timeout, poll_interval)
+        if times is not None:
+            times.add('python', idle=time.perf_counter() - wait_start)
+            if members_run:
+                times.model_stopped()
+
+    # Makes sure results are all the same size
+    failed = [j for j in sorted(reads) if reads[j].exception() is not None]
+    if failed:
+        raise RuntimeError("Ensemble run failed. Unreadable or mismatched output for members: " + 
+                           ", ".join(str(j) + " (" + str(reads[j].exception()) + ")" for j in failed) + ".")
     
-    # Gets results at measured locations
-    read_values_measured = [results[:, idx_meas] for results in read_values_fixed]
-    Y = np.concatenate([np.reshape(results, (-1, 1)) for results in read_values_measured], 1)
+    # Gets results at measured locations, one column per ensemble member
+    Y = meas_results.reshape(ens, -1).T
     
-    # Calculates mean, standard deviation, and full list of results at plotting locations
-    Y_plot_mean = np.mean(np.array(read_values_fixed), 0)
-    Y_plot_std = np.std(np.array(read_values_fixed), axis=0)
-    Y_plot = np.array(read_values_fixed)
+    # Mean, standard deviation, and full list of results (if kept) at plotting locations
+    Y_plot = results
+    Y_plot_mean = stats.mean
+    Y_plot_std = stats.std
     
     # Calculates the mean and standard deviation of latent variables
     X_plot_mean = np.mean(X, axis=1, keepdims=True)
     X_plot_std = np.std(X, axis=1, keepdims=True)
 
-    # Remove temporary CSV files
+    # Keep the new outputs for later runs of the same inputs, then remove temporary output files
+    if sim_cache is not None:
+        sim_cache.store_members(tmp_dir, members_run, output_format)
     for j in range(ens):
-        os.remove(tmp_dir + str(j) + ".csv")
+        os.remove(tmp_dir + str(j) + "." + output_format)
 
-    return Y, Y_plot, Y_plot_mean, Y_plot_std, X_plot_mean, X_plot_std
\ No newline at end of file
+    return Y, Y_plot, Y_plot_mean, Y_plot_std, X_plot_mean, X_plot_std
@@ -0,0 +1,206 @@
+import os
+import shutil
+import hashlib
+from typing import List, Tuple, Dict, Union
+from executor import write_status
+
+class SimulationCache:
+    """
+    On disk cache of asynch outputs, keyed by the content of the inputs of each ensemble member.
+
+    The key of a member is a hash of its .prm file, of its .gbl file (with the member's own file names
+    replaced by placeholders), of every file referenced by the .gbl (river network, initial states, saved
+    links, monthly values...) and of the listing of every directory it references (forcing), plus a tag
+    identifying the executor. Staged copies of inputs (see staging.py) are keyed by their sources, so
+    staged and unstaged runs share outputs. Outputs are stored as '<cache_dir>/<key[:2]>/<key>.<format>', the least
+    recently used ones being removed once the cache is larger than 'max_bytes'.
+
+    Args:
+        cache_dir (str): Directory of the cache.
+        max_bytes (int, optional): Maximum size of the cache in bytes, unlimited if None.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.sources = {}
+        self._digests = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add_staged(self, staged: Dict[str, str]) -> None:
+        """
+        Key the staged copies of inputs by their sources, which are always visible from here.
+
+        Args:
+            staged (Dict[str, str]): Name of the staged copy of each source (see InputStage.staged).
+
+        Returns:
+            None
+        """
+        self.sources.update((staged_name, source) for source, staged_name in staged.items())
+
+    def _path_digest(self, path: str) -> str:
+        # Names, sizes and modification times of the files of a directory, listed again each time since
+        # rewriting a file in place leaves the directory's own size and modification time unchanged
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                entry_stat = entry.stat()
+                h.update(("%s %d %d\n" % (entry.name, entry_stat.st_size, entry_stat.st_mtime_ns)).encode())
+            return h.hexdigest()
+
+        # Content of a file, remembered while its size and modification time are unchanged
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._digests:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self._digests[memo_key] = h.hexdigest()
+        return self._digests[memo_key]
+
+    def member_key(self, tmp_dir: str, member: int, tag: str = "") -> str:
+        """
+        Get the cache key of an ensemble member from its .gbl and .prm files.
+
+        Args:
+            tmp_dir (str): Temporary directory containing the member files.
+            member (int): Index of the ensemble member.
+            tag (str, optional): Identifies how the member is run (see Executor.cache_tag).
+
+        Returns:
+            str: Hexadecimal key.
+        """
+        h = hashlib.sha256(tag.encode() + b'\n')
+        with open(tmp_dir + str(member) + ".prm", 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+
+        # The member's own files (.prm, .rec, output) and scratch directory do not change the results
+        with open(tmp_dir + str(member) + ".gbl", 'r') as f:
+            gbl_lines = [line.strip() for line in f.readlines()]
+        for line in gbl_lines:
+            tokens = [self.sources.get(token, token) for token in line.split()]
+            if tokens != line.split():
+                line = " ".join(tokens)
+            line = line.replace(tmp_dir + str(member) + ".", "<member>.")
+            if line == tmp_dir + "_" + str(member):
+                line = "<scratch>"
+            h.update(line.encode() + b'\n')
+            for token in line.split():
+                if os.path.exists(token):
+                    h.update(self._path_digest(token).encode() + b'\n')
+        return h.hexdigest()
+
+    def entry_name(self, key: str, output_format: str) -> str:
+        """
+        Get the name of the cached output for a key.
+
+        Args:
+            key (str): Cache key.
+            output_format (str): Format of the asynch output, 'csv' or 'h5'.
+
+        Returns:
+            str: Name of the cached file.
+        """
+        return os.path.join(self.cache_dir, key[:2], key + "." + output_format)
+
+    def begin(self) -> None:
+        """
+        Start a new ensemble run, resetting the keys of the members to store and the hit and miss counts.
+
+        Returns:
+            None
+        """
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fetch_members(self, tmp_dir: str, members: List[int], output_format: str, tag: str = "") -> List[int]:
+        """
+        Copy the cached outputs of the members to tmp_dir and mark them as finished, adding to the
+        hit and miss counts since begin.
+
+        Args:
+            tmp_dir (str): Temporary directory containing the member files.
+            members (List[int]): Indices of the ensemble members.
+            output_format (str): Format of the asynch output, 'csv' or 'h5'.
+            tag (str, optional): Identifies how the members are run (see Executor.cache_tag).
+
+        Returns:
+            List[int]: Members not in the cache, which still have to be run.
+        """
+        missing = []
+        for j in members:
+            key = self.member_key(tmp_dir, j, tag)
+            entry = self.entry_name(key, output_format)
+            try:
+                shutil.copyfile(entry, tmp_dir + str(j) + "." + output_format)
+                os.utime(entry)
+                write_status(tmp_dir, j, 0)
+            except OSError:
+                self.keys[j] = key
+                missing.append(j)
+        self.hits += len(members) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def store_members(self, tmp_dir: str, members: List[int], output_format: str) -> None:
+        """
+        Store the outputs of members run since fetch_members, then evict the least recently used outputs.
+
+        Args:
+            tmp_dir (str): Temporary directory containing the member outputs.
+            members (List[int]): Indices of the ensemble members to store.
+            output_format (str): Format of the asynch output, 'csv' or 'h5'.
+
+        Returns:
+            None
+        """
+        for j in members:
+            entry = self.entry_name(self.keys[j], output_format)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            shutil.copyfile(tmp_dir + str(j) + "." + output_format, entry + ".tmp")
+            os.replace(entry + ".tmp", entry)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used outputs until the cache fits in 'max_bytes'.
+
+        Returns:
+            None
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(root, name)))
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(name)
+            total -= size
+
+def get_sim_cache(test_dict: dict) -> Union[SimulationCache, None]:
+    """
+    Create the simulation cache selected in the test dictionary.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional keys
+                          'sim_cache_dir' (no cache if missing or None) and 'sim_cache_max_gb'.
+
+    Returns:
+        Union[SimulationCache, None]: The simulation cache, or None if disabled.
+    """
+    cache_dir = test_dict.get("sim_cache_dir", None)
+    if cache_dir is None:
+        return None
+    max_gb = test_dict.get("sim_cache_max_gb", None)
+    return SimulationCache(cache_dir, None if max_gb is None else int(max_gb * 1e9))
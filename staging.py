@@ -0,0 +1,257 @@
+import os
+import shutil
+import hashlib
+from typing import List, Tuple, Dict, Union
+from forcing import rain_files
+
+class InputStage:
+    """
+    Inputs shared by every ensemble member (river network, initial states, saved links, forcing), copied once
+    per node to a local directory such as '/dev/shm/eki/', so each asynch process reads them from local storage.
+
+    A staged file is named after a digest of its content (a staged directory after the names, sizes and modification
+    times of its files), so a changed input is staged again while copies of unchanged inputs, such as the files
+    rewritten in tmp_dir at every start, are shared by later runs and experiments. Staged files are marked as used
+    every time they are staged, and the least recently used ones are removed once the stage is larger than 'max_bytes'.
+
+    Args:
+        stage_dir (str): Local directory of the staged inputs, the same path on every node.
+        max_bytes (int, optional): Maximum size of the staged inputs in bytes, unlimited if None. The inputs
+                                   of the current experiment are never removed.
+    """
+
+    def __init__(self, stage_dir: str, max_bytes: int = None):
+        self.stage_dir = stage_dir
+        self.max_bytes = max_bytes
+        self.staged = {}
+        self.files = []
+
+    @staticmethod
+    def _file_digest(path: str) -> str:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()[:12]
+
+    @staticmethod
+    def _dir_digest(source_dir: str, sources: List[str]) -> str:
+        h = hashlib.sha1(os.path.abspath(source_dir).encode() + b'\n')
+        for path in sources:
+            stat = os.stat(path)
+            h.update(("%s %d %d\n" % (os.path.basename(path), stat.st_size, stat.st_mtime_ns)).encode())
+        return h.hexdigest()[:12]
+
+    def add_file(self, source: str) -> str:
+        """
+        Stage a file.
+
+        Args:
+            source (str): Name of the file.
+
+        Returns:
+            str: Name of the staged copy.
+        """
+        staged_name = os.path.join(self.stage_dir, self._file_digest(source) + "_" + os.path.basename(source))
+        self.staged[source] = staged_name
+        self.files.append((source, staged_name))
+        return staged_name
+
+    def add_dir(self, source_dir: str, names: List[str]) -> str:
+        """
+        Stage some of the files of a directory, raising FileNotFoundError if the directory cannot be read
+        from this node or some of the files are missing, so members never run with part of their inputs.
+
+        Args:
+            source_dir (str): Directory of the files.
+            names (List[str]): Names of the files in source_dir.
+
+        Returns:
+            str: Name of the staged directory, ending with a separator.
+        """
+        if not os.path.isdir(source_dir) or not os.access(source_dir, os.R_OK | os.X_OK):
+            raise FileNotFoundError("Cannot stage " + source_dir + ", the directory cannot be read from this node")
+        sources = [os.path.join(source_dir, name) for name in names]
+        missing = [name for name, source in zip(names, sources) if not os.path.isfile(source)]
+        if missing:
+            raise FileNotFoundError("Cannot stage " + source_dir + ", " + str(len(missing)) + " of its " + str(len(names))
+                                    + " files are missing: " + ", ".join(missing[:5]) + (", ..." if len(missing) > 5 else ""))
+        staged_dir = os.path.join(self.stage_dir, self._dir_digest(source_dir, sources) + "_" + os.path.basename(os.path.normpath(source_dir)), "")
+        self.staged[source_dir] = staged_dir
+        self.files.extend((source, staged_dir + os.path.basename(source)) for source in sources)
+        return staged_dir
+
+    def stage(self) -> None:
+        """
+        Copy the inputs not already staged on this node, after removing the least recently used inputs of
+        other experiments (see evict). Copies are never hard links, their modification time marking their last use.
+
+        Returns:
+            None
+        """
+        self.evict()
+        for source, staged_name in self.files:
+            if os.path.exists(staged_name):
+                os.utime(staged_name)
+                continue
+            os.makedirs(os.path.dirname(staged_name), exist_ok=True)
+
+            # Written under a temporary name then renamed, so concurrent experiments never read a partial file
+            tmp_name = staged_name + "." + str(os.getpid()) + ".tmp"
+            try:
+                shutil.copyfile(source, tmp_name)
+            except OSError:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
+            os.replace(tmp_name, staged_name)
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used staged files, other than the inputs of this stage, until the stage
+        fits in 'max_bytes'. The markers of the job scripts are removed with them, so later tasks stage again.
+
+        Returns:
+            None
+        """
+        if self.max_bytes is None or not os.path.isdir(self.stage_dir):
+            return
+        keep = set(staged_name for _, staged_name in self.files)
+        entries = []
+        for root, _, files in os.walk(self.stage_dir):
+            for name in files:
+                if not name.startswith("."):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(root, name)))
+        total = sum(entry[1] for entry in entries)
+        removed = False
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name in keep:
+                continue
+            os.remove(name)
+            total -= size
+            removed = True
+        if removed:
+            for name in os.listdir(self.stage_dir):
+                if name.startswith(".staged_"):
+                    os.remove(os.path.join(self.stage_dir, name))
+
+    def write_list(self, list_name: str) -> None:
+        """
+        Write the (source, staged name) pairs, one tab separated pair per line, for the job script.
+
+        Args:
+            list_name (str): Name of the list file.
+
+        Returns:
+            None
+        """
+        with open(list_name, 'w') as f:
+            for source, staged_name in self.files:
+                f.write(os.path.abspath(source) + "\t" + staged_name + "\n")
+
+    def script_lines(self, tmp_dir: str) -> List[str]:
+        """
+        Get the lines of a job script staging the inputs on the node it runs on, as stage does. The first task
+        on a node stages them while the others wait for it, and logs the time it took to '<tmp_dir>staging.log'.
+        Inputs that could not be copied (e.g. a full stage) are logged there too and set 'stage_failed', the
+        node being staged again by the next task.
+
+        Args:
+            tmp_dir (str): Temporary directory, containing the list of inputs 'stage_files.txt' (see write_list).
+
+        Returns:
+            List[str]: Lines of the job script.
+        """
+        list_name = os.path.abspath(tmp_dir + "stage_files.txt")
+        log_name = tmp_dir + "staging.log"
+        stage_dir = os.path.normpath(self.stage_dir)
+        marker = os.path.join(stage_dir, ".staged_" + hashlib.sha1("".join(s + d for s, d in self.files).encode()).hexdigest()[:12])
+        lines = [
+            'mkdir -p ' + stage_dir,
+            '(',
+            'flock 9',
+            'if [ ! -e ' + marker + ' ]; then',
+            '  start=$(date +%s.%N)',
+        ]
+        if self.max_bytes is not None:
+            # Removes the least recently used files of other experiments, as evict does
+            lines += [
+                '  total=$(find ' + stage_dir + ' -type f ! -name ".*" -printf "%s\\n" | awk "{s += \\$1} END {print s + 0}")',
+                '  if [ "$total" -gt ' + str(self.max_bytes) + ' ]; then',
+                '    find ' + stage_dir + ' -type f ! -name ".*" -printf "%T@ %s %p\\n" | sort -n | while read -r t size name; do',
+                '      [ "$total" -le ' + str(self.max_bytes) + ' ] && break',
+                '      cut -f2 ' + list_name + ' | grep -qxF "$name" && continue',
+                '      rm -f "$name" && total=$((total - size))',
+                '    done',
+                '    rm -f ' + os.path.join(stage_dir, ".staged_*"),
+                '  fi',
+            ]
+        lines += [
+            '  failed=0',
+            '  while IFS=$\'\\t\' read -r src dst; do',
+            '    if [ -e "$dst" ]; then',
+            '      touch "$dst"',
+            '    elif ! { mkdir -p "$(dirname "$dst")" && cp "$src" "$dst.$$.tmp" && mv "$dst.$$.tmp" "$dst"; }; then',
+            '      rm -f "$dst.$$.tmp"',
+            '      failed=1',
+            '      echo "$(hostname) failed to stage $src" >> ' + log_name,
+            '    fi',
+            '  done < ' + list_name,
+            '  [ "$failed" -eq 0 ] || exit 1',
+            '  touch ' + marker,
+            '  echo "$(hostname) $(awk "BEGIN {print $(date +%s.%N) - $start}")" >> ' + log_name,
+            'fi',
+            ') 9>' + os.path.join(stage_dir, ".lock") + ' || stage_failed=1',
+        ]
+        return lines
+
+def create_stage(test_dict: dict) -> Union[InputStage, None]:
+    """
+    Select the inputs shared by every member to stage, from the test dictionary. The files written
+    in tmp_dir ('init.rec' and 'meas.sav') must already exist.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional keys 'stage_dir'
+                          (no staging if missing or None), 'stage_max_gb' (unlimited if missing or None),
+                          'forcing_str' or 'window_forcing' (.str files staged instead of the rainfall files
+                          of the simulated period) and 'rain_file_format'.
+
+    Returns:
+        Union[InputStage, None]: The inputs to stage, or None if disabled.
+    """
+    stage_dir = test_dict.get("stage_dir", None)
+    if stage_dir is None:
+        return None
+    tmp_dir = test_dict["tmp_dir"]
+    max_gb = test_dict.get("stage_max_gb", None)
+    stage = InputStage(stage_dir, None if max_gb is None else int(max_gb * 1e9))
+    for name in [test_dict["rvr"], test_dict["mon"], tmp_dir + "init.rec", tmp_dir + "meas.sav"]:
+        stage.add_file(name)
+    if test_dict.get("window_forcing", None) is not None:
+        for name in test_dict["window_forcing"]:
+            stage.add_file(name)
+    elif test_dict.get("forcing_str", None) is not None:
+        stage.add_file(test_dict["forcing_str"])
+    else:
+        stage.add_dir(test_dict["rain_dir"], [os.path.basename(name) for name in rain_files(test_dict)])
+    return stage
+
+def read_staging_log(tmp_dir: str) -> float:
+    """
+    Get the time spent staging inputs by the job scripts, see InputStage.script_lines.
+
+    Args:
+        tmp_dir (str): Temporary directory.
+
+    Returns:
+        float: Total staging time in seconds over every node.
+    """
+    log_name = tmp_dir + "staging.log"
+    if not os.path.exists(log_name):
+        return 0.0
+    with open(log_name, 'r') as f:
+        # Lines of failed copies ('<host> failed to stage <source>') are skipped
+        return sum(float(line.split()[1]) for line in f if len(line.split()) == 2)
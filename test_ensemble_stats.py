@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from ensemble_stats import RunningStatistics
+
+def reference_p2(values, p):
+    # Scalar P-square estimate of one quantile, as written in Jain and Chlamtac (1985)
+    q = sorted(values[:5])
+    n = [1.0, 2.0, 3.0, 4.0, 5.0]
+    desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+    increment = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+    for x in values[5:]:
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = max(i for i in range(4) if q[i] <= x)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            desired[i] += increment[i]
+        for i in range(1, 4):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                s = 1.0 if d >= 1 else -1.0
+                parabolic = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    j = i + int(s)
+                    q[i] = q[i] + s * (q[j] - q[i]) / (n[j] - n[i])
+                n[i] += s
+    return q[2]
+
+def ensemble(seed, ens, shape=(6, 4)):
+    rng = np.random.default_rng(seed)
+    return rng.gamma(2.0, 3.0, (ens,) + shape)
+
+@pytest.mark.parametrize("ens", [1, 2, 7, 40])
+def test_moments(ens):
+    members = ensemble(0, ens)
+    stats = RunningStatistics()
+    for x in members:
+        stats.update(x)
+    assert stats.count == ens
+    np.testing.assert_allclose(stats.mean, np.mean(members, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.std, np.std(members, axis=0), rtol=1e-10, atol=1e-12)
+    np.testing.assert_array_equal(stats.min, np.min(members, axis=0))
+    np.testing.assert_array_equal(stats.max, np.max(members, axis=0))
+
+@pytest.mark.parametrize("ens", [1, 3, 5])
+def test_quantiles_exact(ens):
+    # With 5 members or fewer the quantiles are those of the members
+    members = ensemble(1, ens)
+    stats = RunningStatistics([0.05, 0.5, 0.95])
+    for x in members:
+        stats.update(x)
+    for q in (0.05, 0.5, 0.95):
+        np.testing.assert_allclose(stats.quantile(q), np.quantile(members, q, axis=0), rtol=1e-12)
+
+@pytest.mark.parametrize("ens", [6, 30, 200])
+def test_quantiles_p2(ens):
+    # Every element is the scalar P-square estimate of its members, ties included
+    members = ensemble(2, ens, (5, 3))
+    members[:, 0, 0] = np.round(members[:, 0, 0] / 5.0)
+    quantiles = [0.05, 0.5, 0.95]
+    stats = RunningStatistics(quantiles)
+    for x in members:
+        stats.update(x)
+    for q in quantiles:
+        expected = np.array([[reference_p2(list(members[:, i, j]), q) for j in range(3)] for i in range(5)])
+        np.testing.assert_allclose(stats.quantile(q), expected, rtol=1e-12)
+    assert set(stats.summary()) == {"mean", "std", "min", "max", "q5", "q50", "q95"}
+
+def test_reset():
+    stats = RunningStatistics([0.5])
+    for x in ensemble(3, 8):
+        stats.update(x)
+    mean = stats.mean
+    members = ensemble(4, 3)
+    stats.reset()
+    for x in members:
+        stats.update(x)
+    assert stats.mean is not mean
+    np.testing.assert_allclose(stats.mean, np.mean(members, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.quantile(0.5), np.median(members, axis=0), rtol=1e-12)
+    with pytest.raises(KeyError):
+        stats.quantile(0.25)
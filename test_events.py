@@ -0,0 +1,143 @@
+import os
+import copy
+import numpy as np
+import pytest
+from eki import (EventObsOperator, create_event_obs_op, find_events, compile_events, event_metrics, mean_event_op, std_event_op,
+                 mean_y_event_op, std_y_event_op, max_event_op, slope_event_op)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture(scope="module")
+def observations():
+    # Observed flow of one gauge of the example data, with the noise of test.json
+    data = np.genfromtxt(os.path.join(REPO_DIR, "example_files", "data.csv"), delimiter=',', skip_header=True)
+    y = data[:, 1]
+    R = (2.0 * y)**2 + 500.0**2
+    return y, R
+
+def test_default_noise_is_mc(observations):
+    y, R = observations
+    assert create_event_obs_op(y, R, {}).noise_method == 'mc'
+
+def test_analytic_noise_matches_mc(observations):
+    # The analytic metric noise is within a few percent of a large Monte Carlo estimate
+    y, R = observations
+    Y_pre = np.tile(y.reshape(-1, 1), (1, 2))
+    analytic = EventObsOperator(y, R, noise_method='analytic')
+    mc = EventObsOperator(y, R, noise_method='mc', n_samp=20000)
+    analytic(Y_pre)
+    mc(Y_pre)
+    np.testing.assert_allclose(np.diag(analytic.R_event_full), np.diag(mc.R_event_full), rtol=0.08)
+    assert np.linalg.norm(analytic.R_event_full - mc.R_event_full) < 0.05 * np.linalg.norm(mc.R_event_full)
+
+def reference_find_events(y, min_dist, min_thresh, min_length):
+    # find_events before it was rewritten (repeated argmax, scanning every event), the reference for its output
+    event_list = []
+    event_val_list = []
+    check_list = copy.deepcopy(y)
+    check_list_idx = np.arange(len(y))
+    min_thresh = np.maximum(1e-4, min_thresh)
+    while len(check_list) > 0:
+        max_val_idx = np.argmax(check_list)
+        idx = check_list_idx[max_val_idx]
+        y_idx = check_list[max_val_idx]
+        if y[idx] < min_thresh:
+            break
+        if not event_list:
+            event_list.append([idx])
+            event_val_list.append([y_idx])
+        else:
+            for i, event in enumerate(event_list):
+                min_diff = min([abs(e - idx) for e in event])
+                if min_diff < min_dist:
+                    event_list[i] = event + [idx]
+                    event_val_list[i] = event_val_list[i] + [y_idx]
+                    break
+                elif i == len(event_list) - 1:
+                    event_list.append([idx])
+                    event_val_list.append([y_idx])
+                    break
+        check_list = np.delete(check_list, max_val_idx)
+        check_list_idx = np.delete(check_list_idx, max_val_idx)
+    i = 0
+    while i < len(event_list):
+        if len(event_list[i]) < min_length:
+            event_list.pop(i)
+            event_val_list.pop(i)
+        else:
+            i += 1
+    return event_list, event_val_list
+
+def assert_same_events(events, expected):
+    assert len(expected[0]) > 0
+    assert [[int(i) for i in event] for event in events[0]] == [[int(i) for i in event] for event in expected[0]]
+    assert [[float(v) for v in values] for values in events[1]] == [[float(v) for v in values] for values in expected[1]]
+
+def test_find_events_gauges(observations):
+    y, _ = observations
+    min_thresh = np.percentile(y[y > 0], 25)
+    assert_same_events(find_events(y, 24, min_thresh, 72), reference_find_events(y, 24, min_thresh, 72))
+
+@pytest.mark.parametrize("seed", range(3))
+def test_find_events_ties(seed):
+    # Integer valued series, with many equal values visited by increasing index
+    y = np.round(np.random.default_rng(seed).gamma(0.5, 4.0, 600))
+    assert_same_events(find_events(y, 5, 1.0, 3), reference_find_events(y, 5, 1.0, 3))
+
+def test_find_events_sensors():
+    # Each sensor is searched separately, with indices into the row-major flattened array
+    y = np.round(np.random.default_rng(0).gamma(0.5, 4.0, (300, 3)))
+    event_list, event_val_list = find_events(y, 5, 1.0, 3)
+    expected_events, expected_vals = [], []
+    for s in range(3):
+        sensor_events, sensor_vals = reference_find_events(y[:, s], 5, 1.0, 3)
+        expected_events += [[idx * 3 + s for idx in event] for event in sensor_events]
+        expected_vals += sensor_vals
+    assert_same_events((event_list, event_val_list), (expected_events, expected_vals))
+
+def reference_event_ops(event_list, max_values_idx, slope_idx, Y_pre):
+    # Event operators before they were rewritten (one loop over events, np.polyfit per member), the reference for their output
+    E, N = len(event_list), Y_pre.shape[1]
+    mean, std, mean_y, std_y = (np.zeros((E, N)) for _ in range(4))
+    slope = np.zeros((len(slope_idx), N))
+    for i, event_indices in enumerate(event_list):
+        weights = Y_pre[event_indices, :]
+        event = np.array(event_indices).reshape(-1, 1)
+        mean[i, :] = np.mean(weights, axis=0)
+        std[i, :] = np.std(weights, axis=0)
+        mean_y[i, :] = np.sum(event * weights, axis=0) / np.sum(weights, axis=0)
+        denominator = ((len(event) - 1.0) / len(event)) * np.sum(weights, axis=0)
+        std_y[i, :] = np.sqrt(np.sum(weights * (event - mean_y[i:i+1, :])**2, axis=0) / denominator)
+    for i, event_indices in enumerate(slope_idx):
+        x = np.array(event_indices).flatten()
+        for j in range(N):
+            slope[i, j], _ = np.polyfit(x, Y_pre[x, j], 1)
+    max_val = Y_pre[np.array(max_values_idx).squeeze(), :]
+    return max_val, mean, std, mean_y, std_y, slope
+
+def test_event_ops():
+    rng = np.random.default_rng(0)
+    y = np.round(rng.gamma(0.5, 4.0, 500))
+    event_list, event_val_list = find_events(y, 5, 1.0, 3)
+    max_values_idx = [[event[int(np.argmax(values))]] for event, values in zip(event_list, event_val_list)]
+    slope_idx = [[e for e in event if e >= peak[0]] for event, peak in zip(event_list, max_values_idx)]
+    slope_idx = [event for event in slope_idx if len(event) > 1]
+    Y_pre = y.reshape(-1, 1) * rng.uniform(0.5, 1.5, (len(y), 20)) + 0.1
+    expected = reference_event_ops(event_list, max_values_idx, slope_idx, Y_pre)
+
+    events = compile_events(event_list)
+    for ops in ((max_event_op(max_values_idx, Y_pre), mean_event_op(event_list, Y_pre), std_event_op(events, Y_pre),
+                 mean_y_event_op(event_list, Y_pre), std_y_event_op(events, Y_pre)),
+                event_metrics(events, max_values_idx, Y_pre)):
+        for values, expected_values in zip(ops, expected):
+            np.testing.assert_allclose(values, expected_values, rtol=1e-12)
+    np.testing.assert_allclose(slope_event_op(slope_idx, Y_pre), expected[5], rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("y, message", [
+    (np.zeros(200), "No positive observations"),
+    (np.concatenate([np.zeros(100), np.ones(10), np.zeros(90)]), "No observed event of at least 72 times"),
+])
+def test_no_events(y, message):
+    # Observations without events are a clear error, not an empty percentile or update
+    with pytest.raises(ValueError, match=message):
+        EventObsOperator(y, np.ones(len(y)))(np.ones((len(y), 3)))
@@ -0,0 +1,27 @@
+import pytest
+from executor import LocalExecutor
+from run import wait_for_members
+
+@pytest.fixture
+def tmp_dir(tmp_path):
+    return str(tmp_path) + "/"
+
+def run_members(tmp_dir: str, asynch_cmd: str) -> str:
+    # Runs two members with the given command, returning the failure report
+    for j in range(2):
+        open(tmp_dir + str(j) + ".gbl", 'w').close()
+    executor = LocalExecutor(2, asynch_cmd)
+    executor.submit(tmp_dir, [0, 1])
+    with pytest.raises(RuntimeError) as e:
+        wait_for_members(tmp_dir, [0, 1], lambda j: None, timeout=30, poll_interval=0.05)
+    executor.shutdown()
+    return str(e.value)
+
+def test_failure_reports_stderr(tmp_dir):
+    report = run_members(tmp_dir, "sh -c 'echo solver diverged >&2; exit 3'")
+    assert "0 (exit status 3: solver diverged)" in report
+    assert "1 (exit status 3: solver diverged)" in report
+
+def test_failure_reports_exception(tmp_dir):
+    report = run_members(tmp_dir, "/nonexistent/asynch")
+    assert "exit status -1: FileNotFoundError" in report
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from eki import EnKF, ETKF, update_ensemble
+
+def reference_EnKF(X_pre, Y_pre, y, R_diag):
+    # EnKF before the gain solvers were added (dense R, observation space solve), the reference for its output
+    ens = X_pre.shape[1]
+    y_num = len(y)
+    xbar = np.mean(X_pre, axis=1, keepdims=True)
+    ybar = np.mean(Y_pre, axis=1, keepdims=True)
+    pert_vec = np.random.normal(0, 1, (y_num, ens))
+    R = np.diag(R_diag)
+    y_pert = y + np.sqrt(R) @ pert_vec
+    X = (X_pre - xbar) / np.sqrt(ens - 1)
+    Y = (Y_pre - ybar) / np.sqrt(ens - 1)
+    K = np.linalg.solve((Y @ Y.T + R).T, (X @ Y.T).T).T
+    return K @ (y_pert - Y_pre) + X_pre
+
+def random_problem(seed, x_num, y_num, ens):
+    # Ensemble of parameters and of nonlinear model outputs, with observations and their noise
+    rng = np.random.default_rng(seed)
+    X_pre = rng.normal(0, 1, (x_num, ens))
+    H = rng.normal(0, 1, (y_num, x_num))
+    Y_pre = H @ X_pre + 0.1 * (H @ X_pre)**2
+    y = rng.normal(0, 1, (y_num, 1))
+    R_diag = rng.uniform(0.5, 2.0, y_num)
+    return X_pre, Y_pre, y, R_diag
+
+@pytest.mark.parametrize("y_num, ens", [(60, 10), (8, 20)])
+@pytest.mark.parametrize("solver", ['obs', 'ens', 'auto'])
+def test_enkf_solvers(y_num, ens, solver):
+    # Every solver gives the previous update for the same random draws
+    X_pre, Y_pre, y, R_diag = random_problem(0, 5, y_num, ens)
+    np.random.seed(1)
+    expected = reference_EnKF(X_pre, Y_pre, y, R_diag)
+    np.random.seed(1)
+    np.testing.assert_allclose(EnKF(X_pre, Y_pre, y, R_diag, solver), expected, rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize("y_num, ens", [(60, 10), (8, 20)])
+def test_etkf_matches_kalman(y_num, ens):
+    # With a linear model, the ETKF posterior mean and covariance are the exact Kalman update of the ensemble mean
+    # and covariance, without drawing random numbers
+    X_pre, _, y, R_diag = random_problem(0, 5, y_num, ens)
+    H = np.random.default_rng(2).normal(0, 1, (y_num, 5))
+    Y_pre = H @ X_pre
+    P = np.cov(X_pre)
+    K = P @ H.T @ np.linalg.inv(H @ P @ H.T + np.diag(R_diag))
+    mean = np.mean(X_pre, axis=1, keepdims=True) + K @ (y - H @ np.mean(X_pre, axis=1, keepdims=True))
+    cov = P - K @ H @ P
+
+    state = np.random.get_state()
+    X_post = ETKF(X_pre, Y_pre, y, R_diag)
+    assert np.random.get_state()[2] == state[2] and np.array_equal(np.random.get_state()[1], state[1])
+    np.testing.assert_allclose(np.mean(X_post, axis=1, keepdims=True), mean, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(np.cov(X_post), cov, rtol=1e-10, atol=1e-12)
+    np.testing.assert_array_equal(update_ensemble(X_pre, Y_pre, y, R_diag, {'filter_type': 'etkf'}), X_post)
@@ -0,0 +1,51 @@
+import os
+import gzip
+import numpy as np
+import pytest
+from network import load_rvr
+from forcing import rain_hours, create_forcing
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture
+def test_dict(tmp_path):
+    # Three hours of rainfall over the links of a small sub-watershed
+    return {"rvr": os.path.join(REPO_DIR, "example_files", "sub-watershed", "05463500.rvr"),
+            "rain_dir": str(tmp_path / "rain") + "/", "time_start": "2016-07-01 00:00", "time_end": "2016-07-01 02:00",
+            "cache_dir": None, "forcing_dir": str(tmp_path / "forcing") + "/"}
+
+def write_rain(test_dict, file_format):
+    # Rain on a few links each hour, the same rates whatever the format
+    os.makedirs(test_dict["rain_dir"], exist_ok=True)
+    link_ids = load_rvr(test_dict["rvr"], None).ids
+    rng = np.random.default_rng(0)
+    for hour in rain_hours(test_dict):
+        records = np.zeros(5, dtype=[('id', '>u4'), ('value', '>f4')])
+        records['id'] = rng.choice(link_ids, 5, replace=False)
+        records['value'] = rng.uniform(0, 10, 5)
+        name = os.path.join(test_dict["rain_dir"], file_format.format(time=int(hour)))
+        with (gzip.open(name, 'wb') if name.endswith(".gz") else open(name, 'wb')) as f:
+            f.write(records.tobytes())
+
+def read_str(str_name):
+    with open(str_name, 'r') as f:
+        return f.read()
+
+def test_gzipped_rain(test_dict):
+    write_rain(test_dict, "{time}.bin")
+    expected = read_str(create_forcing(test_dict))
+    assert len(expected.split("\n\n")) > 3
+    write_rain(dict(test_dict, rain_dir=test_dict["rain_dir"] + "gz/"), "{time}.gz")
+    assert read_str(create_forcing(dict(test_dict, rain_dir=test_dict["rain_dir"] + "gz/", rain_file_format="{time}.gz"))) == expected
+
+def test_missing_rain(test_dict):
+    # Missing files or a missing directory are errors, and nothing is cached
+    with pytest.raises(FileNotFoundError, match="Rainfall directory"):
+        create_forcing(test_dict)
+    write_rain(test_dict, "{time}.bin")
+    os.remove(os.path.join(test_dict["rain_dir"], str(int(rain_hours(test_dict)[1])) + ".bin"))
+    with pytest.raises(FileNotFoundError, match="1 of the 3 rainfall files .*: " + str(int(rain_hours(test_dict)[1])) + ".bin"):
+        create_forcing(test_dict)
+    with pytest.raises(FileNotFoundError, match="3 of the 3"):
+        create_forcing(dict(test_dict, rain_file_format="{time}.gz"))
+    assert not os.path.exists(test_dict["forcing_dir"]) or os.listdir(test_dict["forcing_dir"]) == []
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+from latent import create_latent, convert_logical, unbounded_to_bounded, round_significant, transform_latent
+from utils import process_json, get_ids, get_subwatershed
+from io_ifc import create_prm, create_prm_template, write_prm_member
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def reference_round(x):
+    # Rounding before it was vectorized, through the string written for asynch
+    return np.vectorize(lambda v: float(np.format_float_positional(v, precision=5, unique=False, fractional=False, trim='k')))(x)
+
+@pytest.fixture
+def test_dict(tmp_path, monkeypatch):
+    # test.json on a small sub-watershed
+    monkeypatch.chdir(REPO_DIR)
+    test_dict = process_json("test.json")
+    test_dict.update(meas_usgs="05463500", rvr="example_files/sub-watershed/05463500.rvr",
+                     prm="example_files/sub-watershed/05463500.prm", cache_dir=str(tmp_path / "cache") + "/")
+    return test_dict
+
+def test_round_significant():
+    rng = np.random.default_rng(0)
+    values = [rng.uniform(-1, 1, 20000) * 10.0**rng.integers(-30, 30, 20000),
+              unbounded_to_bounded(rng.normal(0, 1, 20000), 0.05, 0.5),
+              # Rounding ties, powers of ten and their neighbours, and special values
+              np.array([1.23455, 1.23465, 0.5, 2.5e-7, 99999.5, 1e5, 1e-5, 10.0, 0.1]),
+              np.nextafter(10.0**np.arange(-20, 21), np.inf), np.nextafter(10.0**np.arange(-20, 21), -np.inf),
+              np.array([0.0, -0.0, 5e-324, -2.2e-308, np.inf, -np.inf, np.nan])]
+    for x in values:
+        rounded = round_significant(x, 5)
+        expected = reference_round(x)
+        np.testing.assert_array_equal(rounded, expected)
+        np.testing.assert_array_equal(np.signbit(rounded), np.signbit(expected))
+
+def test_transform_latent(test_dict):
+    # Same parameters as the sparse matmul expansion of every member followed by string rounding
+    id_list = get_ids(test_dict)
+    sparse_parent = get_subwatershed(test_dict, id_list)
+    np.random.seed(0)
+    latent_var = create_latent(test_dict, sparse_parent, 6)
+    prm_ens, ids = transform_latent(test_dict, sparse_parent, latent_var)
+
+    with open(test_dict['prm'], 'r') as f:
+        prm_lines = [line for line in f.readlines() if line.strip()]
+    id_list_prm = [int(i) for i in prm_lines[1::2]]
+    prm_list = np.array([[float(i) for i in line.split()] for line in prm_lines[2::2]])
+    prm_array = prm_list[np.argsort(id_list_prm), :]
+    expected = np.repeat(prm_array.T[:, :, np.newaxis], 6, axis=2)
+    out_num = sparse_parent.shape[0]
+    loc = 0
+    for i, dist in enumerate(convert_logical(test_dict["prm_dist"])):
+        if dist:
+            lv = sparse_parent.T @ latent_var[loc:loc + out_num, :]
+            expected[i] = reference_round(unbounded_to_bounded(lv, float(test_dict['prm_lb'][i]), float(test_dict['prm_ub'][i])))
+            loc += out_num
+
+    np.testing.assert_array_equal(ids, np.sort(id_list_prm))
+    np.testing.assert_array_equal(np.asarray(prm_ens), expected)
+    np.testing.assert_array_equal(prm_ens.member(3), expected[:, :, 3])
+
+def reference_prm(id_list, prm_array, member):
+    # .prm file before it was rendered from a template, one str() per value
+    lines = [str(len(id_list))]
+    for j in range(len(id_list)):
+        lines.append(str(id_list[j]))
+        lines.append(" ".join([str(item) for item in prm_array[:, j, member]]))
+    return "".join("%s\n" % line for line in lines)
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_create_prm(test_dict, tmp_path, workers):
+    # Files written from the template, by create_prm or one member at a time, are byte identical to the previous writer
+    id_list = get_ids(test_dict)
+    sparse_parent = get_subwatershed(test_dict, id_list)
+    np.random.seed(0)
+    prm_ens, id_list = transform_latent(test_dict, sparse_parent, create_latent(test_dict, sparse_parent, 4))
+    tmp_dir = str(tmp_path) + "/"
+    test_dict.update(tmp_dir=tmp_dir, prm_write_workers=workers)
+    template = create_prm_template(test_dict, id_list, prm_ens)
+    create_prm(test_dict, id_list, prm_ens, 4, template)
+    prm_array = np.asarray(prm_ens)
+    for j in range(4):
+        with open(tmp_dir + str(j) + ".prm", 'r') as f:
+            assert f.read() == reference_prm(id_list, prm_array, j)
+    write_prm_member(tmp_dir, template, prm_array, 2)
+    with open(tmp_dir + "2.prm", 'r') as f:
+        assert f.read() == reference_prm(id_list, prm_array, 2)
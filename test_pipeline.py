@@ -0,0 +1,83 @@
+import os
+import json
+import numpy as np
+import pytest
+import eki_test
+from archive import ExperimentArchive
+from io_ifc import load_checkpoint
+from utils import process_json
+from forcing import rain_hours, rain_file_name
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ENS = 4
+
+def write_config(tmp_path, name: str, **keys) -> str:
+    # test.json on a small sub-watershed, run by the fake executor in tmp_path
+    with open(os.path.join(REPO_DIR, "test.json"), 'r') as f:
+        test_dict = json.load(f)
+    test_dict.update(steps=2, meas_usgs="05463500", rvr="example_files/sub-watershed/05463500.rvr",
+                     prm="example_files/sub-watershed/05463500.prm", executor="fake", max_workers=4,
+                     out_dir=str(tmp_path / name / "out") + "/", tmp_dir=str(tmp_path / name / "tmp") + "/",
+                     cache_dir=str(tmp_path / "cache") + "/", background_writes=False)
+    test_dict.update(keys)
+    os.makedirs(test_dict["out_dir"], exist_ok=True)
+    os.makedirs(test_dict["tmp_dir"], exist_ok=True)
+    json_name = str(tmp_path / (name + ".json"))
+    with open(json_name, 'w') as f:
+        json.dump(test_dict, f)
+    return json_name
+
+def run(json_name: str, crash_run: int = None, resume: bool = False) -> None:
+    # Runs the test from a fixed seed, failing instead of starting run number 'crash_run' (1 for the first run),
+    # checking often for finished members
+    run_test = eki_test.run_test
+    calls = []
+    def crashing_run_test(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == crash_run:
+            raise RuntimeError("simulated failure")
+        return run_test(*args, poll_interval=0.05, **kwargs)
+    eki_test.run_test = crashing_run_test
+    np.random.seed(0 if not resume else 1)
+    try:
+        eki_test.main(json_name, ENS, resume)
+    finally:
+        eki_test.run_test = run_test
+
+@pytest.mark.parametrize("keys, crash_run, resume_step", [
+    ({}, 3, (0, "post")),
+    ({"window_hours": 1344, "window_overlap_hours": 48, "keep_particles": False, "stage_dir": "stage/"}, 5, (1, "post")),
+])
+def test_fake_run_and_resume(tmp_path, monkeypatch, keys, crash_run, resume_step):
+    monkeypatch.chdir(REPO_DIR)
+    if "stage_dir" in keys:
+        # Staged rainfall files of the period, empty since the fake executor does not read them
+        keys = dict(keys, stage_dir=str(tmp_path / keys["stage_dir"]) + "/", rain_dir=str(tmp_path / "rain") + "/")
+        os.makedirs(keys["rain_dir"])
+        for hour in rain_hours(process_json(os.path.join(REPO_DIR, "test.json"))):
+            open(rain_file_name(keys["rain_dir"], int(hour)), 'w').close()
+    full_json = write_config(tmp_path, "full", **keys)
+    crash_json = write_config(tmp_path, "crash", **keys)
+
+    run(full_json)
+    test_dict = process_json(full_json)
+    archive = ExperimentArchive(test_dict["out_dir"] + "archive/")
+    steps = 2 * (2 if "window_hours" in keys else 1)
+    assert sorted(archive.chunks()) == sorted((k, phase) for k in range(steps) for phase in ("prior", "post"))
+    checkpoint = load_checkpoint(test_dict)
+    assert (checkpoint["step"], checkpoint["phase"]) == (steps - 1, "post")
+
+    # A run failing part way resumes after its last checkpoint, with the same results as the full run
+    with pytest.raises(RuntimeError):
+        run(crash_json, crash_run=crash_run)
+    crash_dict = process_json(crash_json)
+    checkpoint = load_checkpoint(crash_dict)
+    assert (checkpoint["step"], checkpoint["phase"]) == resume_step
+    run(crash_json, resume=True)
+    resumed = ExperimentArchive(crash_dict["out_dir"] + "archive/")
+    assert sorted(resumed.chunks()) == sorted(archive.chunks())
+    for k, phase in archive.chunks():
+        np.testing.assert_array_equal(resumed.params(k, phase), archive.params(k, phase))
+        np.testing.assert_allclose(resumed.mean(k, phase), archive.mean(k, phase), rtol=1e-12)
+        if keys.get("keep_particles", True):
+            np.testing.assert_array_equal(resumed.particles(k, phase), archive.particles(k, phase))
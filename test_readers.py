@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from executor import fake_asynch
+from run import read_member_csv, read_member_h5
+
+h5py = pytest.importorskip("h5py")
+
+SAV_IDS = [406000, 404000, 405000]
+
+def write_member(tmp_dir: str, member: int, output_format: str) -> None:
+    # Inputs of one member, only the .gbl lines read by fake_asynch
+    with open(tmp_dir + "meas.sav", 'w') as f:
+        f.write("\n".join(str(i) for i in SAV_IDS) + "\n")
+    with open(tmp_dir + "init.rec", 'w') as f:
+        f.write("0\n")
+    with open(tmp_dir + str(member) + ".prm", 'w') as f:
+        f.write("%d\n\n" % len(SAV_IDS))
+        for k, link_id in enumerate(SAV_IDS):
+            f.write("%d\n%f %f %f\n" % (link_id, 0.1 * (member + 1), 0.2 * k, 0.3))
+    gbl_lines = ["609", "2020-06-01 00:00", "2020-06-21 00:00",
+                 "0 " + tmp_dir + str(member) + ".prm",
+                 "2 " + tmp_dir + "init.rec",
+                 {"csv": "2", "h5": "5"}[output_format] + " 60 " + tmp_dir + str(member) + "." + output_format,
+                 "1 " + tmp_dir + "meas.sav"]
+    with open(tmp_dir + str(member) + ".gbl", 'w') as f:
+        f.write("\n".join(gbl_lines) + "\n")
+    fake_asynch(tmp_dir + str(member) + ".gbl")
+
+@pytest.fixture
+def tmp_dir(tmp_path):
+    return str(tmp_path) + "/"
+
+def test_readers_match(tmp_dir):
+    for j in range(2):
+        write_member(tmp_dir, j, "csv")
+        write_member(tmp_dir, j, "h5")
+        from_csv = read_member_csv(tmp_dir, j)
+        from_h5 = read_member_h5(tmp_dir, j)
+        assert from_csv.shape == (481, len(SAV_IDS))
+        np.testing.assert_allclose(from_h5, from_csv, rtol=1e-6)
+
+def test_h5_row_order(tmp_dir):
+    # Rows ordered by time then link instead of link then time, read into a preallocated array
+    write_member(tmp_dir, 0, "h5")
+    expected = read_member_h5(tmp_dir, 0)
+    with h5py.File(tmp_dir + "0.h5", 'r') as f:
+        table = f["outputs"][()]
+    with h5py.File(tmp_dir + "0.h5", 'w') as f:
+        f.create_dataset("outputs", data=table[np.lexsort((table["LinkID"], table["Time"]))])
+    out = np.empty(expected.shape)
+    assert read_member_h5(tmp_dir, 0, out) is out
+    np.testing.assert_array_equal(out, expected)
+
+def test_h5_sav_order(tmp_dir):
+    # Columns follow the given link IDs
+    write_member(tmp_dir, 0, "h5")
+    expected = read_member_h5(tmp_dir, 0)
+    order = [2, 0, 1]
+    np.testing.assert_array_equal(read_member_h5(tmp_dir, 0, sav_ids=np.array(SAV_IDS)[order]), expected[:, order])
+
+@pytest.mark.parametrize("sav_ids, message", [
+    (SAV_IDS[:2], "links not in the saved links: \\[405000\\]"),
+    (SAV_IDS + [407000], "saved links missing or with fewer times: \\[407000\\]"),
+])
+def test_h5_link_mismatch(tmp_dir, sav_ids, message):
+    # An extra or missing link in the table is an error, not a misaligned reshape
+    write_member(tmp_dir, 0, "h5")
+    with pytest.raises(ValueError, match=message):
+        read_member_h5(tmp_dir, 0, sav_ids=np.array(sav_ids))
+
+def test_h5_missing_times(tmp_dir):
+    write_member(tmp_dir, 0, "h5")
+    with h5py.File(tmp_dir + "0.h5", 'r') as f:
+        table = f["outputs"][()]
+    with h5py.File(tmp_dir + "0.h5", 'w') as f:
+        f.create_dataset("outputs", data=table[1:])
+    with pytest.raises(ValueError, match="fewer times: \\[406000\\]"):
+        read_member_h5(tmp_dir, 0)
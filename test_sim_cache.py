@@ -0,0 +1,28 @@
+import os
+import pytest
+from sim_cache import SimulationCache
+
+@pytest.fixture
+def tmp_dir(tmp_path):
+    return str(tmp_path) + "/"
+
+def test_key_follows_forcing_files(tmp_dir):
+    # Rewriting a rainfall file in place changes the key, though the directory itself is unchanged
+    rain_dir = tmp_dir + "rain/"
+    os.makedirs(rain_dir)
+    with open(rain_dir + "0.bin", 'wb') as f:
+        f.write(b"\0" * 16)
+    with open(tmp_dir + "0.prm", 'w') as f:
+        f.write("1\n\n1\n0.1 0.2\n")
+    with open(tmp_dir + "0.gbl", 'w') as f:
+        f.write("609\n5 " + rain_dir + "\n")
+    cache = SimulationCache(tmp_dir + "cache/")
+    key = cache.member_key(tmp_dir, 0)
+    assert cache.member_key(tmp_dir, 0) == key
+
+    dir_stat = os.stat(rain_dir)
+    with open(rain_dir + "0.bin", 'wb') as f:
+        f.write(b"\1" * 32)
+    os.utime(rain_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    assert os.stat(rain_dir).st_mtime_ns == dir_stat.st_mtime_ns
+    assert cache.member_key(tmp_dir, 0) != key
@@ -0,0 +1,20 @@
+import os
+import pytest
+from staging import InputStage
+
+def test_add_dir_missing(tmp_path):
+    # A directory that cannot be read or a missing file is an error, not a member run with part of its inputs
+    source_dir = str(tmp_path / "rain") + "/"
+    stage = InputStage(str(tmp_path / "stage") + "/")
+    with pytest.raises(FileNotFoundError, match="cannot be read"):
+        stage.add_dir(source_dir, ["0.bin"])
+    os.makedirs(source_dir)
+    for name in ["0.bin", "3600.bin"]:
+        open(source_dir + name, 'w').close()
+    with pytest.raises(FileNotFoundError, match="1 of its 3 files are missing: 7200.bin"):
+        stage.add_dir(source_dir, ["0.bin", "3600.bin", "7200.bin"])
+    assert stage.files == []
+
+    staged_dir = stage.add_dir(source_dir, ["0.bin", "3600.bin"])
+    stage.stage()
+    assert sorted(os.listdir(staged_dir)) == ["0.bin", "3600.bin"]
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from utils import LinkIndex, relabel, process_json, get_ids, get_subwatershed
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def reference_subwatershed(test_dict, id_list_use):
+    # get_subwatershed before the list scans were replaced, the reference for its output
+    watershed_vals = np.genfromtxt(test_dict["watershed_csv"], delimiter=',', skip_header=True)
+    idx_sort = np.argsort(watershed_vals[:, 0])
+    id_list = watershed_vals[idx_sort, 0]
+    id_divs = (watershed_vals[idx_sort, test_dict["watershed_depth"] - 3] - 1).astype(int)
+    id_tmp = []
+    id_div_tmp = []
+    for i, id_val in enumerate(id_list):
+        if id_val in id_list_use:
+            id_tmp.append(id_val)
+            id_div_tmp.append(id_divs[i])
+    id_div_tmp = np.array(id_div_tmp)
+    divs_new = 0
+    for i in range(np.max(id_div_tmp) + 1):
+        if np.sum(id_div_tmp == i) > 0:
+            id_div_tmp[id_div_tmp == i] = divs_new
+            divs_new += 1
+    id_num = len(id_tmp)
+    return coo_matrix((np.ones(id_num), (id_div_tmp, np.arange(id_num))), shape=(len(np.unique(id_div_tmp)), id_num))
+
+@pytest.mark.parametrize("seed", range(3))
+def test_link_index(seed):
+    # Positions and membership are those of a scan of the list, for unsorted IDs and missing queries
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(100000, 500, replace=False)
+    query = np.concatenate([rng.choice(ids, 300), rng.integers(0, 100001, 300), [-1, 100001]])
+    ids_list = ids.tolist()
+    expected = np.array([ids_list.index(q) if q in ids_list else -1 for q in query])
+    index = LinkIndex(ids)
+    np.testing.assert_array_equal(index.position(query), expected)
+    np.testing.assert_array_equal(index.contains(query), np.isin(query, ids))
+    np.testing.assert_array_equal(index.position(query.reshape(2, -1)), expected.reshape(2, -1))
+    assert len(index) == 500
+    np.testing.assert_array_equal(LinkIndex([]).position(query), -1)
+
+def test_relabel():
+    labels = np.random.default_rng(0).choice([3, 7, 8, 20, 41], (30, 4))
+    new_labels, num = relabel(labels)
+    assert num == 5
+    for new, old in enumerate([3, 7, 8, 20, 41]):
+        np.testing.assert_array_equal(new_labels == new, labels == old)
+
+@pytest.mark.parametrize("usgs", ["05463500", "05458900", "05464220"])
+def test_get_subwatershed(tmp_path, monkeypatch, usgs):
+    monkeypatch.chdir(REPO_DIR)
+    test_dict = process_json("test.json")
+    test_dict.update(prm="example_files/sub-watershed/" + usgs + ".prm", cache_dir=str(tmp_path / "cache") + "/")
+    id_list = get_ids(test_dict)
+    sparse_parent = get_subwatershed(test_dict, id_list)
+    expected = reference_subwatershed(test_dict, id_list)
+    assert sparse_parent.shape == expected.shape
+    np.testing.assert_array_equal(sparse_parent.toarray(), expected.toarray())
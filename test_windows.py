@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+from windows import assimilation_windows, check_window_observations
+
+def test_window_observations():
+    # Windows without observations or without positive flow are rejected before any run
+    test_dict = {"time_start": "2016-07-01 00:00", "time_end": "2016-07-11 00:00", "window_hours": 96, "window_overlap_hours": 24}
+    windows = assimilation_windows(test_dict)
+    y = np.ones(windows[-1].offset + windows[-1].length)
+    check_window_observations(windows, y)
+
+    y[windows[1].offset:windows[1].offset + windows[1].length] = 0.0
+    with pytest.raises(ValueError, match="1 of the 3 assimilation windows .*: " + windows[1].start + " to " + windows[1].end + " \\(no positive flow\\)"):
+        check_window_observations(windows, y)
+    with pytest.raises(ValueError, match="\\(no observations\\)"):
+        check_window_observations(windows, np.ones(windows[-1].offset))
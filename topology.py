@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import os
+import sys
+import numpy as np
+from typing import List, Tuple, Dict, Union
+from network import RvrData, load_rvr, load_prm, load_rec, network_cache_dir
+from utils import LinkIndex
+
+class Topology:
+    """
+    River network topology from a .rvr file, as compressed sparse row (CSR) arrays.
+
+    The children of the link at position k (in .rvr file order) are at positions
+    children[offsets[k]:offsets[k+1]], -1 for children missing from the file.
+
+    Args:
+        rvr (RvrData): Parsed .rvr file, see network.load_rvr.
+    """
+
+    def __init__(self, rvr: RvrData):
+        self.rvr = rvr
+        self.ids = rvr.ids
+        self.offsets = rvr.offsets
+        self.index = LinkIndex(rvr.ids)
+        self.children = self.index.position(rvr.children)
+
+    def upstream(self, link_id: int) -> np.ndarray:
+        """
+        Get the links upstream of a link (the link itself included), by a breadth first search over the children.
+
+        Args:
+            link_id (int): Link ID of the outlet.
+
+        Returns:
+            np.ndarray: Positions of the upstream links, in .rvr file order.
+        """
+        outlet = self.index.position([link_id])
+        if outlet[0] < 0:
+            raise ValueError("Link " + str(link_id) + " is not in the .rvr file")
+
+        visited = np.zeros(len(self.ids), dtype=bool)
+        visited[outlet] = True
+        frontier = outlet
+        while len(frontier) > 0:
+            # Gathers the children of every link of the frontier at once
+            starts = self.offsets[frontier]
+            counts = self.offsets[frontier + 1] - starts
+            first = np.cumsum(counts) - counts
+            children = self.children[np.repeat(starts - first, counts) + np.arange(np.sum(counts))]
+            children = children[children >= 0]
+            frontier = np.unique(children[~visited[children]])
+            visited[frontier] = True
+        return np.flatnonzero(visited)
+
+def write_rvr(rvr_name: str, topology: Topology, links: np.ndarray) -> None:
+    """
+    Write the .rvr file of a subset of the network, which must contain every link upstream of its links.
+
+    Args:
+        rvr_name (str): Name of the .rvr file to write.
+        topology (Topology): Topology of the full network.
+        links (np.ndarray): Positions of the links to write.
+
+    Returns:
+        None
+    """
+    rvr = topology.rvr
+    with open(rvr_name, 'w') as f:
+        f.write("%d\n\n" % len(links))
+        for k in links.tolist():
+            children = rvr.children[rvr.offsets[k]:rvr.offsets[k + 1]].tolist()
+            f.write("%d\n%s\n\n" % (rvr.ids[k], " ".join(str(i) for i in [len(children)] + children)))
+
+def write_subnetwork(test_dict: dict, outlet: int, out_name: str) -> dict:
+    """
+    Write consistent .rvr, .prm, .rec and .sav files for the network upstream of a link.
+
+    The files of the full network are the 'rvr', 'prm', 'rec' and 'meas_sav' of the test dictionary,
+    the subset files are written as '<out_name>.rvr', ... The .rvr keeps the file order of the full network.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional key 'cache_dir'.
+        outlet (int): Link ID of the outlet of the subnetwork.
+        out_name (str): Path and prefix of the files to write.
+
+    Returns:
+        dict: The 'rvr', 'prm', 'rec' and 'meas_sav' keys pointing to the subset files.
+    """
+    cache_dir = network_cache_dir(test_dict)
+    topology = Topology(load_rvr(test_dict['rvr'], cache_dir))
+    links = topology.upstream(outlet)
+    link_index = LinkIndex(topology.ids[links])
+
+    # River network
+    write_rvr(out_name + ".rvr", topology, links)
+
+    # Parameters, every link of the subnetwork must have them
+    prm = load_prm(test_dict['prm'], cache_dir)
+    keep = link_index.contains(prm.ids)
+    if np.sum(keep) != len(links):
+        raise ValueError("The .prm file does not have the parameters of every link upstream of " + str(outlet))
+    with open(out_name + ".prm", 'w') as f:
+        f.write("%d\n\n" % len(links))
+        for id_val, values in zip(prm.ids[keep].tolist(), prm.values[keep].tolist()):
+            f.write("%d\n%s\n\n" % (id_val, " ".join(str(item) for item in values)))
+
+    # Initial states
+    rec = load_rec(test_dict['rec'], cache_dir)
+    keep = link_index.contains(rec.ids)
+    with open(out_name + ".rec", 'w') as f:
+        f.write("%s\n%d\n%s\n\n" % (rec.header[0], np.sum(keep), rec.header[2]))
+        for id_val, state in zip(rec.ids[keep].tolist(), rec.states[keep].tolist()):
+            f.write("%d\n%s\n\n" % (id_val, state))
+
+    # Saved links
+    sav_ids = np.array(np.genfromtxt(test_dict['meas_sav'], delimiter=','), ndmin=1).astype(np.int64)
+    with open(out_name + ".sav", 'w') as f:
+        for id_val in sav_ids[link_index.contains(sav_ids)].tolist():
+            f.write("%d\n" % id_val)
+
+    return {'rvr': out_name + ".rvr", 'prm': out_name + ".prm", 'rec': out_name + ".rec", 'meas_sav': out_name + ".sav"}
+
+def main(rvr_name: str, prm_name: str, rec_name: str, sav_name: str, outlet: int, out_name: str) -> None:
+    test_dict = {'rvr': rvr_name, 'prm': prm_name, 'rec': rec_name, 'meas_sav': sav_name}
+    os.makedirs(os.path.dirname(out_name) or '.', exist_ok=True)
+    files = write_subnetwork(test_dict, outlet, out_name)
+    print("Wrote " + ", ".join(files.values()))
+
+if __name__ == "__main__":
+    # Usage: python topology.py full.rvr full.prm full.rec full.sav outlet_link_id out_prefix
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]), sys.argv[6])
@@ -3,6 +3,7 @@ import json
 from scipy.sparse import coo_matrix
 from typing import List, Tuple, Dict, Union
 import numpy as np
+from network import load_prm, network_cache_dir
 
 ## Utility functions
 
@@ -32,22 +33,77 @@ def time_to_epoch(time: str) -> float:
     """
     return parser.parse(time).timestamp()
 
+class LinkIndex:
+    """
+    Index of a set of link IDs for vectorized membership and position lookups.
+
+    The IDs are kept sorted, so each lookup is a binary search (np.searchsorted) instead of
+    a scan of the list.
+
+    Args:
+        ids (np.ndarray): Link IDs, in any order.
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self.ids = np.array(ids, ndmin=1)
+        self.order = np.argsort(self.ids, kind='stable')
+        self.sorted_ids = self.ids[self.order]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def position(self, query: np.ndarray) -> np.ndarray:
+        """
+        Get the position of each queried ID in the indexed IDs.
+
+        Args:
+            query (np.ndarray): Link IDs to look up.
+
+        Returns:
+            np.ndarray: Index of each ID in 'ids', -1 for IDs not in the index.
+        """
+        query = np.asarray(query)
+        if len(self.ids) == 0:
+            return np.full(query.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, query), len(self.ids) - 1)
+        return np.where(self.sorted_ids[pos] == query, self.order[pos], -1)
+
+    def contains(self, query: np.ndarray) -> np.ndarray:
+        """
+        Check which of the queried IDs are in the index.
+
+        Args:
+            query (np.ndarray): Link IDs to look up.
+
+        Returns:
+            np.ndarray: Boolean mask, True for the IDs in the index.
+        """
+        return self.position(query) >= 0
+
+def relabel(labels: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Relabel values to consecutive integers from 0, keeping their order.
+
+    Args:
+        labels (np.ndarray): Values to relabel.
+
+    Returns:
+        Tuple[np.ndarray, int]: The new labels and the number of distinct values.
+    """
+    unique_labels, new_labels = np.unique(labels, return_inverse=True)
+    return new_labels.reshape(np.shape(labels)), len(unique_labels)
+
 def get_ids(test_dict: dict) -> List[int]:
     """
     Get the list of IDs from the PRM file specified in the test dictionary.
 
     Args:
-        test_dict (dict): Test dictionary containing required parameters.
+        test_dict (dict): Test dictionary containing required parameters, uses the optional key 'cache_dir'.
 
     Returns:
         List[int]: Sorted list of IDs extracted from the PRM file.
     """
-    prm_name = test_dict['prm']
-    with open(prm_name, 'r') as f:
-        prm_lines = [line for line in f.readlines() if line.strip()]
-    id_list_prm = [int(i.strip('\n')) for i in prm_lines[1::2]]
-    id_list = np.sort(id_list_prm)
-    return id_list
+    return load_prm(test_dict['prm'], network_cache_dir(test_dict)).ids
 
 
 def get_subwatershed(test_dict, id_list_use):
@@ -83,28 +139,14 @@ def get_subwatershed(test_dict, id_list_use):
 
     id_divs = (watershed_vals[idx_sort, idx_col] - 1).astype(int)
 
-    id_tmp = []
-    id_div_tmp = []
-    
     # Get only ids in id_list_use
-    for i, id_val in enumerate(id_list):
-        if id_val in id_list_use:
-            id_tmp.append(id_val)
-            id_div_tmp.append(id_divs[i])
-    id_tmp = np.array(id_tmp)
-    id_div_tmp = np.array(id_div_tmp)
+    keep = LinkIndex(id_list_use).contains(id_list)
+    id_tmp = id_list[keep]
     
     # Assigns value from 0 to max to each for divisions, used to eliminate unused indices
-    divs_new = 0
-    max_div = np.max(id_div_tmp)
-    for i in range(max_div + 1):
-        count_i = np.sum(id_div_tmp == i)
-        if count_i > 0:
-            id_div_tmp[id_div_tmp == i] = divs_new
-            divs_new += 1
+    id_div_tmp, subws_num = relabel(id_divs[keep])
 
     id_num = len(id_tmp)
-    subws_num = len(np.unique(id_div_tmp))
     
     # Create sparse matrix to convert from full parameters to sparse representation
     val_vals = np.ones(id_num)
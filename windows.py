@@ -0,0 +1,98 @@
+from datetime import datetime
+import numpy as np
+from typing import List, Tuple, Dict, Union, NamedTuple
+from utils import time_to_epoch
+
+## Sliding assimilation windows
+# The parameters are assimilated window after window ('steps' EKI iterations in each), every run of a window
+# starting from the states of the members at its start, saved by the last run of the previous window.
+
+class Window(NamedTuple):
+    """
+    Assimilation window, times formatted as in the test dictionary.
+
+    Attributes:
+        start (str): Start of the window.
+        end (str): End of the window.
+        next_start (str): Start of the next window, where the states of the members are saved, None for the last window.
+        offset (int): Index of the first output time of the window in the outputs (and observations) of the whole period.
+        length (int): Number of output times of the window.
+    """
+    start: str
+    end: str
+    next_start: Union[str, None]
+    offset: int
+    length: int
+
+# Print interval of the outputs in seconds, as in the hydrograph line of the .gbl
+OUTPUT_INTERVAL = 3600
+
+def epoch_to_time(epoch: float) -> str:
+    """
+    Convert an epoch timestamp to a time string, the inverse of utils.time_to_epoch.
+
+    Args:
+        epoch (float): Epoch timestamp.
+
+    Returns:
+        str: Time string ('%Y-%m-%d %H:%M').
+    """
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M")
+
+def assimilation_windows(test_dict: dict) -> List[Window]:
+    """
+    Split the simulated period into assimilation windows of 'window_hours' hours, each starting 'window_hours'
+    minus 'window_overlap_hours' hours after the previous one, the last one ending at 'time_end'.
+
+    Args:
+        test_dict (dict): Test dictionary containing required parameters, uses the optional keys 'window_hours'
+                          (a single window over the whole period if missing or None) and 'window_overlap_hours' (0 by default).
+
+    Returns:
+        List[Window]: The assimilation windows.
+    """
+    start_time = int(time_to_epoch(test_dict['time_start']))
+    end_time = int(time_to_epoch(test_dict['time_end']))
+    window_hours = test_dict.get('window_hours', None)
+    if window_hours is None:
+        return [Window(test_dict['time_start'], test_dict['time_end'], None, 0, (end_time - start_time) // OUTPUT_INTERVAL + 1)]
+
+    overlap_hours = test_dict.get('window_overlap_hours', 0)
+    if not 0 <= overlap_hours < window_hours:
+        raise ValueError("window_overlap_hours must be at least 0 and less than window_hours")
+
+    windows = []
+    window_start = start_time
+    while True:
+        window_end = min(window_start + window_hours * 3600, end_time)
+        next_start = window_start + (window_hours - overlap_hours) * 3600
+        last = window_end >= end_time
+        windows.append(Window(epoch_to_time(window_start), epoch_to_time(window_end), None if last else epoch_to_time(next_start),
+                              (window_start - start_time) // OUTPUT_INTERVAL, (window_end - window_start) // OUTPUT_INTERVAL + 1))
+        if last:
+            return windows
+        window_start = next_start
+
+def check_window_observations(windows: List[Window], y: np.ndarray) -> None:
+    """
+    Check that every window has observations with some positive flow, which the events of its measurement
+    operator are found in, raising ValueError naming the windows without any before the first run.
+
+    Args:
+        windows (List[Window]): The assimilation windows.
+        y (np.ndarray): Observations of the whole period, one per output time.
+
+    Returns:
+        None
+    """
+    y = np.asarray(y, dtype=float).reshape(-1)
+    empty = []
+    for window in windows:
+        y_window = y[window.offset:window.offset + window.length]
+        if len(y_window) == 0:
+            empty.append(window.start + " to " + window.end + " (no observations)")
+        elif not np.any(y_window > 0):
+            empty.append(window.start + " to " + window.end + " (no positive flow)")
+    if empty:
+        raise ValueError(str(len(empty)) + " of the " + str(len(windows)) + " assimilation windows have no events to assimilate, "
+                         "change 'window_hours' or the simulated period: " + ", ".join(empty[:5]) + (", ..." if len(empty) > 5 else ""))